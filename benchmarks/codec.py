@@ -0,0 +1,82 @@
+"""
+Compare wire codecs on typical messages.
+
+Run from the directory containing the SDK checkout (named sdk here):
+    python -m sdk.benchmarks.codec [--number 20000]
+"""
+import argparse
+import timeit
+
+from ..lib.codec import available_codecs
+
+MESSAGES = {
+    'service callback': {
+        'command': 'service callback',
+        'payload': {
+            'command': 'weather',
+            'params': 'Saint Petersburg',
+            'chat': 'RXRI6S0N',
+            'user': 'VZXTDQ44',
+            'bot': 'bot_hash_0123456789',
+            'update_id': 857463521
+        }
+    },
+    'callback query': {
+        'command': 'callback query',
+        'payload': {
+            'chat': 'RXRI6S0N',
+            'user': 'VZXTDQ44',
+            'bot': 'bot_hash_0123456789',
+            'data': 'next_page 3',
+            'message_id': 4812,
+            'update_id': 857463522
+        }
+    },
+    'send to service': {
+        'token': 'a1b2c3d4e5f6',
+        'command': 'send to service',
+        'payload': {
+            'chat_hash': 'RXRI6S0N',
+            'text': 'Погода в Санкт-Петербурге: *+12°C*, облачно. ' * 4,
+            'parse_mode': 'Markdown',
+            'disable_web_page_preview': True,
+            'bot': None,
+            'want_response': None,
+            'update_id': 857463521,
+            'markup': {
+                'inline_keyboard': [
+                    [{'text': str(i), 'callback_data': 'a1b2c3d4e5f6 page {}'.format(i)} for i in range(1, 6)],
+                    [{'text': '<', 'callback_data': 'a1b2c3d4e5f6 prev'},
+                     {'text': '>', 'callback_data': 'a1b2c3d4e5f6 next'}]
+                ]
+            }
+        }
+    }
+}
+
+
+def run(number):
+    codecs = available_codecs()
+    baseline = {}
+
+    print("{:<18} {:<8} {:>12} {:>12} {:>10}".format('message', 'codec', 'encode, us', 'decode, us', 'speedup'))
+
+    for title, message in MESSAGES.items():
+        for codec in reversed(codecs):
+            body = codec.encode(message)
+            assert codec.decode(body) == message
+
+            encode = timeit.timeit(lambda: codec.encode(message), number=number) / number * 1e6
+            decode = timeit.timeit(lambda: codec.decode(body), number=number) / number * 1e6
+
+            total = encode + decode
+            baseline.setdefault(title, total)
+
+            print("{:<18} {:<8} {:>12.2f} {:>12.2f} {:>9.1f}x".format(title, codec.name, encode, decode,
+                                                                      baseline[title] / total))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=20000, help='iterations per measurement')
+    run(parser.parse_args().number)
@@ -0,0 +1,116 @@
+"""
+Measure SDK overhead of incoming message processing without RabbitMQ and MongoDB.
+
+Messages go through LoopbackTransport -> Broker.callback -> API.process -> handler,
+handlers read MemoryDb and reply with send_text_to_chat.
+Latency is measured from publish to handler end. All messages are published at once,
+so it includes time spent in the queue.
+
+Run from the directory containing the SDK checkout (named sdk here):
+    python -m sdk.benchmarks.throughput [--messages 20000] [--concurrency 1] [--chats 100] [--batched]
+"""
+import argparse
+import time
+
+from ..codexbot_sdk import CodexBot
+from ..lib.codec import get_codec
+from ..lib.transport import LoopbackTransport
+
+APPLICATION_NAME = 'benchmark'
+
+
+def message(command, chat, sent_at):
+    payload = {
+        'chat': 'chat_{}'.format(chat),
+        'user': 'user_{}'.format(chat),
+        'bot': 'bot_hash_0123456789',
+        'update_id': 857463521,
+        'sent_at': sent_at
+    }
+
+    if command == 'service callback':
+        payload.update({'command': 'weather', 'params': 'Saint Petersburg'})
+    elif command == 'callback query':
+        payload.update({'data': 'next_page 3', 'message_id': 4812})
+    else:
+        payload.update({'text': 'Saint Petersburg'})
+
+    return {'command': command, 'payload': payload}
+
+
+def percentile(values, percent):
+    index = max(0, int(round(percent / 100 * len(values))) - 1)
+    return values[index]
+
+
+class Benchmark:
+
+    def __init__(self, concurrency, chats, batched):
+        self.chats = chats
+        self.codec = get_codec()
+        self.transport = LoopbackTransport()
+        self.latencies = []
+
+        self.sdk = CodexBot(APPLICATION_NAME, '127.0.0.1', 0, None, {'backend': 'memory'}, token='benchmark',
+                            concurrency=concurrency, transport=self.transport,
+                            publisher_config={} if batched else None)
+        self.sdk.db.insert('settings', [{'chat': 'chat_{}'.format(chat), 'city': 'Saint Petersburg'}
+                                        for chat in range(chats)])
+
+        self.sdk.register_commands([('weather', 'Weather', self.handler)])
+        self.sdk.set_callback_query_handler(self.handler)
+        self.sdk.set_user_answer_handler(self.handler)
+
+    async def handler(self, payload):
+        settings = self.sdk.db.find_one('settings', {'chat': payload['chat']})
+        await self.sdk.send_text_to_chat(payload['chat'], 'Weather in {}'.format(settings['city']))
+        self.latencies.append(time.perf_counter() - payload['sent_at'])
+
+    async def run(self, command, number):
+        self.latencies = []
+        started = time.perf_counter()
+
+        for i in range(number):
+            body = self.codec.encode(message(command, i % self.chats, time.perf_counter()))
+            await self.transport.publish(body, APPLICATION_NAME)
+
+        await self.transport.join(APPLICATION_NAME)
+        if self.sdk.broker.publisher is not None:
+            await self.sdk.broker.publisher.flush()
+
+        seconds = time.perf_counter() - started
+        self.transport.queue('core').messages.clear()
+
+        latencies = sorted(self.latencies)
+        assert len(latencies) == number, "{} of {} messages processed".format(len(latencies), number)
+
+        return [number / seconds] + [percentile(latencies, percent) * 1e3 for percent in (50, 90, 99, 100)]
+
+
+def run(number, concurrency, chats, batched):
+    benchmark = Benchmark(concurrency, chats, batched)
+    event_loop = benchmark.sdk.event_loop
+
+    print("codec: {}, concurrency: {}, chats: {}, batched publishing: {}".format(benchmark.codec.name, concurrency,
+                                                                                  chats, batched))
+    print("{:<18} {:>10} {:>10} {:>10} {:>10} {:>10}".format('message', 'msgs/sec', 'p50, ms', 'p90, ms',
+                                                             'p99, ms', 'max, ms'))
+
+    for command in ('service callback', 'callback query', 'user answer'):
+        # Warm up caches and lazily created objects
+        event_loop.run_until_complete(benchmark.run(command, min(number, 1000)))
+
+        result = event_loop.run_until_complete(benchmark.run(command, number))
+        print("{:<18} {:>10.0f} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}".format(command, *result))
+
+    event_loop.run_until_complete(benchmark.sdk.shutdown())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=20000, help='messages of every type')
+    parser.add_argument('--concurrency', type=int, default=1, help='CodexBot concurrency')
+    parser.add_argument('--chats', type=int, default=100, help='number of distinct chats')
+    parser.add_argument('--batched', action='store_true', help='enable batched publishing')
+    args = parser.parse_args()
+    run(args.messages, args.concurrency, args.chats, args.batched)
@@ -1,18 +1,39 @@
 import asyncio
+import time
 
-from .lib.scheduler import Scheduler
-from .lib.db import Db
+from .lib.broadcast import Broadcaster
+from .lib.cpu_pool import CpuPool
+from .lib.keyboard import KeyboardTemplate, KeyboardBuilder, prefix_callback_data
+from .lib.error_reporter import ErrorReporter
+from .lib.lanes import use_lane
 from .lib.logging import Logging
-from .lib.server import Server, http_response
+from .lib.metrics import REGISTRY
+from .lib.middleware import Timeout, ConcurrencyLimit
+from .lib.sessions import SessionStore
 from .components.broker import Broker
-from hawkcatcher import Hawk
+
+# Scheduler (apscheduler), Db (pymongo), Server (aiohttp) and Hawk (hawkcatcher) are imported on first use
 
 
 class CodexBot:
-    # Make decorator for HTTP callback public
-    http_response = http_response
 
-    def __init__(self, application_name, host, port, rabbitmq_url, db_config, token, hawk_token=None):
+    # Metrics registry
+    metrics = REGISTRY
+
+    # Keyboard templates for send_inline_keyboard_to_chat and send_keyboard_to_chat
+    KeyboardTemplate = KeyboardTemplate
+    KeyboardBuilder = KeyboardBuilder
+
+    # Middlewares for use_middleware
+    Timeout = Timeout
+    ConcurrencyLimit = ConcurrencyLimit
+
+    # Send messages in the bulk lane: with self.sdk.use_lane('bulk'): ...
+    use_lane = staticmethod(use_lane)
+
+    def __init__(self, application_name, host, port, rabbitmq_url, db_config, token, hawk_token=None,
+                 concurrency=1, prefetch_count=None, publisher_config=None, transport=None, logging_config=None,
+                 lane_weights=None, max_priority=None, dedup_config=None, cpu_pool_config=None, session_config=None):
         """
         Enable python error catcher for https://hawk.so
 
@@ -22,69 +43,362 @@ class CodexBot:
         > except:
         >     if self.sdk.hawk:
         >         self.sdk.hawk.catch()
-        """
-        self.hawk = Hawk(hawk_token) if hawk_token is not None else None
 
-        """
+        Errors are reported by ErrorReporter in a background thread, so catch() doesn't block the event loop
+
         Initiates SDK
+
+        :param concurrency: number of incoming messages processed at the same time.
+                            Messages from the same chat are still processed one by one in order
+        :param prefetch_count: number of unacknowledged messages RabbitMQ delivers to the app
+        :param publisher_config: enables batched publishing with publisher confirms, e.g.
+                                 {'max_batch_size': 100, 'flush_interval': 0.005, 'max_queue_size': 10000}
+                                 send_* methods then return a future resolved when the broker confirms the message
+        :param transport: message transport, RabbitMQ by default. Pass LoopbackTransport() to run without RabbitMQ
+        :param logging_config: Logging options, e.g. {'level': logging.INFO, 'background': True, 'rate': 10}.
+                               Message payloads are logged with {'payload_level': logging.DEBUG}
+        :param lane_weights: share of workers and publishes of interactive and bulk lanes when both are busy,
+                             {'interactive': 4, 'bulk': 1} by default. Broadcasts and batched jobs use the bulk lane
+        :param max_priority: declare the app queue with x-max-priority (the existing queue must be deleted first)
+        :param dedup_config: ack redelivered and duplicate messages without processing, e.g.
+                             {'size': 100000, 'ttl': 3600, 'persistent': True}. persistent keeps processed message ids
+                             in Db, so messages redelivered after a crash are skipped too. True means defaults
+        :param cpu_pool_config: process pool for run_cpu, e.g. {'workers': 2, 'max_pending': 8, 'timeout': 30}
+        :param session_config: dialog sessions of wait_user_answer with a step, e.g.
+                               {'size': 10000, 'ttl': 3600, 'persistent': True, 'flush_interval': 1.0}
+
+        In a running event loop use CodexBot.create() instead
+        """
+        self.configure(application_name, host, port, rabbitmq_url, db_config, token, hawk_token,
+                       concurrency=concurrency, prefetch_count=prefetch_count, publisher_config=publisher_config,
+                       transport=transport, logging_config=logging_config,
+                       lane_weights=lane_weights, max_priority=max_priority, dedup_config=dedup_config,
+                       cpu_pool_config=cpu_pool_config, session_config=session_config)
+        self.event_loop.run_until_complete(self.start_components())
+
+    @classmethod
+    async def create(cls, application_name, host, port, rabbitmq_url, db_config, token, hawk_token=None,
+                     commands=None, **options):
         """
+        Initiate SDK in a running event loop. Db and RabbitMQ connections are opened concurrently,
+        time of every phase is saved to sdk.startup_timings
+
+            > sdk = await CodexBot.create(APPLICATION_NAME, host, port, rabbitmq_url, DB, TOKEN,
+            >                             commands=[('weather', 'Weather forecast', self.weather)])
+
+        :param commands: commands to register, see register_commands
+        :param options: other CodexBot arguments: concurrency, transport...
+        """
+        sdk = cls.__new__(cls)
+        sdk.configure(application_name, host, port, rabbitmq_url, db_config, token, hawk_token, **options)
+        await sdk.start_components(commands)
+        return sdk
+
+    def configure(self, application_name, host, port, rabbitmq_url, db_config, token, hawk_token=None,
+                  concurrency=1, prefetch_count=None, publisher_config=None, transport=None, logging_config=None,
+                  lane_weights=None, max_priority=None, dedup_config=None, cpu_pool_config=None, session_config=None):
         if not token:
             raise Exception("Please, pass your app`s token.\nYou can get it from our bot by /newapp command")
 
         self.host = host
         self.port = port
 
-        queue_name = application_name
-
         # Get event loop
         self.event_loop = asyncio.get_event_loop()
 
         self.application_name = application_name
+        self.queue_name = application_name
+        self.rabbitmq_url = rabbitmq_url
         self.token = token
+        self.db_config = db_config
+        self.logging_config = logging_config
+        self.cpu_pool_config = cpu_pool_config
+        self.session_config = session_config
+        self.broker_options = {
+            'concurrency': concurrency,
+            'prefetch_count': prefetch_count,
+            'publisher_config': publisher_config,
+            'transport': transport,
+            'lane_weights': lane_weights,
+            'max_priority': max_priority,
+            'dedup_config': dedup_config
+        }
 
         self.user_answer_handler = None
         self.callback_query_handler = None
 
+        # Seconds spent in every startup phase
+        self.startup_timings = {}
+
+        self.hawk = self.init_error_reporter(hawk_token) if hawk_token is not None else None
         self.logging = self.init_logging()
-        self.db = self.init_db(db_config)
-        self.scheduler = self.init_scheduler()
-        self.server = self.init_server()
-        self.broker = self.init_broker(application_name, queue_name, rabbitmq_url, self.hawk)
+        self.db = None
+        self.broker = None
+        self.broadcaster = None
+        self.cpu_pool = self.init_cpu_pool()
+        self.sessions = self.init_sessions()
+        self.__scheduler = None
+        self.__server = None
+
+    async def start_components(self, commands=None):
+        """
+        Connect Db and broker concurrently and start consuming
+        """
+        started = time.perf_counter()
+
+        self.broker = self.init_broker(self.application_name, self.queue_name, self.rabbitmq_url, self.hawk,
+                                       connect=False, **self.broker_options)
+        self.broadcaster = self.init_broadcaster()
+
+        # pymongo is imported and MongoClient is created in a thread, while the broker connects
+        db, _ = await asyncio.gather(
+            self.__timed('db', self.event_loop.run_in_executor(None, self.init_db, self.db_config)),
+            self.__timed('broker', self.broker.open())
+        )
+        self.db = self.broker.api.db = self.sessions.db = db
+
+        await self.__timed('consume', self.broker.consume())
+
+        if commands:
+            await self.__timed('commands', self.broker.api.register_commands(commands))
+
+        self.startup_timings['total'] = time.perf_counter() - started
+
+    async def __timed(self, phase, awaitable):
+        started = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.startup_timings[phase] = time.perf_counter() - started
+
+    @property
+    def scheduler(self):
+        # Created on first use, so apps without scheduled jobs don't import apscheduler
+        if self.__scheduler is None:
+            started = time.perf_counter()
+            self.__scheduler = self.init_scheduler()
+            self.startup_timings['scheduler'] = time.perf_counter() - started
+        return self.__scheduler
+
+    @property
+    def server(self):
+        # Created on first use, so apps without HTTP routes don't import aiohttp
+        if self.__server is None:
+            started = time.perf_counter()
+            self.__server = self.init_server()
+            self.startup_timings['server'] = time.perf_counter() - started
+        return self.__server
+
+    @staticmethod
+    def http_response(function=None, **options):
+        """
+        Decorator for HTTP callbacks: @CodexBot.http_response or @CodexBot.http_response(cache_ttl=30),
+        see lib.server.http_response
+        """
+        from .lib.server import http_response
+        return http_response(function, **options)
 
-        self.broker.start()
+    def init_error_reporter(self, hawk_token):
+        # Hawk is created in the reporter thread
+        return ErrorReporter(hawk_token=hawk_token)
 
     def init_logging(self):
-        return Logging()
+        return Logging(**(self.logging_config or {}))
+
+    def init_cpu_pool(self):
+        return CpuPool(**(self.cpu_pool_config or {}))
+
+    def init_sessions(self):
+        return SessionStore(**(self.session_config or {}))
 
     def init_server(self):
+        from .lib.server import Server
         return Server(self.event_loop, self.host, self.port)
 
-    def init_broker(self, application_name, queue_name, rabbitmq_url, hawk):
-        return Broker(self, self.event_loop, application_name, queue_name, rabbitmq_url, hawk)
+    def init_broker(self, application_name, queue_name, rabbitmq_url, hawk,
+                    concurrency=1, prefetch_count=None, publisher_config=None, transport=None, connect=True,
+                    lane_weights=None, max_priority=None, dedup_config=None):
+        return Broker(self, self.event_loop, application_name, queue_name, rabbitmq_url, hawk,
+                      concurrency=concurrency, prefetch_count=prefetch_count, publisher_config=publisher_config,
+                      transport=transport, connect=connect, lane_weights=lane_weights, max_priority=max_priority,
+                      dedup_config=dedup_config)
+
+    def init_broadcaster(self):
+        return Broadcaster(self)
 
     def init_db(self, db_config):
         self.logging.debug("Initialize db.")
         db_name = "module_{}".format(self.application_name)
-        return Db(db_name, db_config["host"], db_config["port"])
+
+        # Pass {'backend': 'async'} to get non-blocking AsyncDb with awaitable methods
+        if db_config.get("backend") == "async":
+            from .lib.db import AsyncDb
+            db = AsyncDb(db_name, db_config["host"], db_config["port"], pool_size=db_config.get("pool_size", 10))
+        # Pass {'backend': 'memory'} to keep data in memory, for tests and benchmarks without MongoDB
+        elif db_config.get("backend") == "memory":
+            from .lib.memory_db import MemoryDb
+            db = MemoryDb(db_name)
+        else:
+            from .lib.db import Db
+            db = Db(db_name, db_config["host"], db_config["port"], pool_size=db_config.get("pool_size", 100))
+
+        # Pass {'write_behind': {'batch_size': 500, 'flush_interval': 1.0, 'max_queue_size': 10000}}
+        # to queue writes and execute them with bulk_write
+        write_behind_config = db_config.get("write_behind")
+        if write_behind_config:
+            from .lib.db import WriteBehindDb
+            db = WriteBehindDb(db, **(write_behind_config if isinstance(write_behind_config, dict) else {}))
+
+        # Pass {'cache': {'size': 1000, 'ttl': 60, 'collections': {...}}} to cache find_one results
+        cache_config = db_config.get("cache")
+        if cache_config:
+            from .lib.db import CachedDb
+            db = CachedDb(db, **(cache_config if isinstance(cache_config, dict) else {}))
+
+        return db
 
     def init_scheduler(self):
+        from .lib.scheduler import Scheduler
         scheduler_object = Scheduler(sdk=self)
         return scheduler_object
 
     def log(self, message):
         self.logging.debug(message)
 
-    def start_server(self):
-        self.server.start()
+    def start_server(self, workers=1, reuse_port=False):
+        """
+        Run HTTP server
+
+        :param workers: number of server processes. Broker consumer and scheduler run only in the first worker,
+                        other workers serve HTTP requests and can send messages
+        :param reuse_port: every worker binds its own socket with SO_REUSEPORT
+        """
+        if workers > 1:
+            # Connections of this process are reopened in the workers
+            self.event_loop.run_until_complete(self.broker.stop())
+
+        self.server.start(workers=workers, reuse_port=reuse_port, on_worker_start=self.init_worker)
+
+    def init_worker(self, index, event_loop):
+        """
+        Prepare SDK in the forked server worker
+        :param index: worker number
+        :param event_loop: worker event loop
+        """
+        self.event_loop = event_loop
+
+        # MongoClient and AMQP connections are not fork-safe
+        self.db = self.init_db(self.db_config)
+        self.broker.api.db = self.db
+        self.sessions.db = self.db
+        self.broker.attach(event_loop)
+
+        # Worker processes of the parent pool are not inherited
+        self.cpu_pool = self.init_cpu_pool()
+
+        if index == 0:
+            self.broker.start()
+            if self.__scheduler is not None:
+                self.__scheduler.attach(event_loop)
 
     def set_routes(self, routes):
         self.server.set_routes(routes)
 
-    def set_path_to_static(self, route, path):
-        self.server.add_static(route, path)
+    def enable_metrics(self, path='/metrics'):
+        """
+        Serve SDK metrics in Prometheus text format: handler and Db latency, broker and scheduler stats.
+        Custom metrics can be added with self.sdk.metrics.counter(...), gauge(...), histogram(...)
+
+        :param path: route path
+        """
+        self.server.add_metrics_route(self.metrics, path)
+
+    def set_path_to_static(self, route, path, max_age=None, **options):
+        """
+        :param max_age: Cache-Control max-age in seconds
+        :param options: add_static options, e.g. append_version=True
+        """
+        self.server.add_static(route, path, max_age=max_age, **options)
 
     def register_commands(self, commands):
-        self.event_loop.run_until_complete(self.broker.api.register_commands(commands))
+        """
+        Register commands in the core
+        :param commands: list of (command, description, handler) or (command, description, handler, options).
+                         Options limit the handler:
+                            {'timeout': 10,                 # seconds
+                             'concurrency': 5,              # handlers running at the same time,
+                                                            # needs CodexBot(..., concurrency > 1)
+                             'max_waiting': 20,             # waiting messages, new ones are rejected
+                             'fallback': 'Busy, try later', # reply text or async function(payload)
+                             'middlewares': [...],          # see use_middleware
+                             'lane': 'bulk'}                # heavy command: don't delay interactive messages
+        :return: task in a running event loop
+        """
+        registration = self.broker.api.register_commands(commands)
+
+        if self.event_loop.is_running():
+            return asyncio.ensure_future(registration)
+
+        self.event_loop.run_until_complete(registration)
+
+    def use_middleware(self, middleware):
+        """
+        Add middleware for all command, callback query and user answer handlers
+
+        Example:
+            async def log_time(payload, call_next):
+                started = time.time()
+                await call_next(payload)
+                logging.info("Handled in {}".format(time.time() - started))
+
+            self.sdk.use_middleware(log_time)
+            self.sdk.use_middleware(CodexBot.ConcurrencyLimit(100, max_waiting=1000))
+
+        :param middleware: async function(payload, call_next)
+        """
+        self.broker.api.use(middleware)
+
+    async def run_cpu(self, function, *args, timeout=None, **kwargs):
+        """
+        Run CPU-bound function in the process pool without blocking the event loop.
+        Function, arguments and result must be picklable, so pass data, not the SDK
+
+        Example:
+            def render_chart(points):
+                ...
+                return png
+
+            async def chart(self, payload):
+                png = await self.sdk.run_cpu(render_chart, points, timeout=10)
+
+        :param timeout: seconds, cpu_pool_config timeout by default. Raises asyncio.TimeoutError
+        :return: function result
+        """
+        return await self.cpu_pool.run(function, *args, timeout=timeout, **kwargs)
+
+    async def shutdown(self):
+        """
+        Gracefully stop SDK: finish received messages and flush outgoing ones
+        """
+        await self.broker.stop()
+        if self.__scheduler is not None:
+            await self.__scheduler.stop()
+
+        await self.cpu_pool.close()
+        await self.sessions.close()
+
+        # Write queued operations of WriteBehindDb
+        if hasattr(self.db, 'flush'):
+            flush = self.db.flush()
+            if flush is not None:
+                await flush
+
+        self.db.close()
+
+        if self.hawk:
+            await self.event_loop.run_in_executor(None, self.hawk.stop)
+
+        self.logging.stop()
 
     def set_user_answer_handler(self, handler):
         self.user_answer_handler = handler
@@ -92,7 +406,22 @@ class CodexBot:
     def set_callback_query_handler(self, handler):
         self.callback_query_handler = handler
 
-    async def wait_user_answer(self, user, chat, prompt='', bot=None):
+    def set_step_handler(self, step, handler):
+        """
+        Handle user answers to wait_user_answer with the step
+        :param handler: async function(payload, session). session.data is kept between steps
+        """
+        self.sessions.set_step_handler(step, handler)
+
+    async def wait_user_answer(self, user, chat, prompt='', bot=None, step=None, data=None):
+        """
+        Ask the core to send the next user message as an answer
+        :param step: answer goes to the handler of set_step_handler instead of the user answer handler.
+                     Dialog is over after a step handler which doesn't wait for the next answer
+        :param data: dict merged into the session data
+        """
+        if step is not None:
+            await self.sessions.start(bot, chat, user, step, data)
         await self.broker.api.wait_user_answer(user, chat, prompt=prompt, bot=bot)
 
     async def send_text_to_chat(self, chat_hash, message,
@@ -129,7 +458,7 @@ class CodexBot:
         if remove_keyboard:
             payload['markup'] = {'remove_keyboard': {'remove_keyboard': True, 'selective': False}}
 
-        await self.send_to_chat(payload)
+        return await self.send_to_chat(payload)
 
     async def send_image_to_chat(self,
                                  chat_hash,
@@ -143,7 +472,7 @@ class CodexBot:
             "bot": bot
         }
 
-        await self.send_to_chat(payload)
+        return await self.send_to_chat(payload)
 
     async def send_inline_keyboard_to_chat(self,
                                            chat_hash,
@@ -153,11 +482,12 @@ class CodexBot:
                                            update_id=None,
                                            parse_mode=None,
                                            disable_web_page_preview=None,
-                                           want_response=None):
+                                           want_response=None,
+                                           keyboard_fields=None):
         """
         Send inline keyboard to chat
 
-        :param keyboard:  array of button rows
+        :param keyboard:  array of button rows or KeyboardTemplate. It is not modified
         Each row is array of buttons
         Button is a dict:
             - text -- button label
@@ -183,12 +513,15 @@ class CodexBot:
         :param update_id:
         :param disable_web_page_preview:
         :param want_response:
+        :param keyboard_fields: values for KeyboardTemplate placeholders
         :return:
         """
 
-        for row in keyboard:
-            for button in row:
-                button['callback_data'] = self.token + ' ' + button['callback_data']
+        if isinstance(keyboard, KeyboardTemplate):
+            keyboard = keyboard.render(keyboard_fields, token=self.token)
+        else:
+            prefix = self.token + ' '
+            keyboard = [[prefix_callback_data(button, prefix) for button in row] for row in keyboard]
 
         payload = {
             "chat_hash": chat_hash,
@@ -203,18 +536,19 @@ class CodexBot:
             "want_response": want_response
         }
 
-        await self.send_to_chat(payload)
+        return await self.send_to_chat(payload)
 
     async def send_keyboard_to_chat(self,
                                     chat_hash,
                                     message,
                                     keyboard,
                                     bot=None,
-                                    parse_mode=None):
+                                    parse_mode=None,
+                                    keyboard_fields=None):
         """
         Set custom keyboard
 
-        :param keyboard:
+        :param keyboard: dict or KeyboardTemplate
 
         keyboard = {
             'keyboard': [
@@ -229,9 +563,13 @@ class CodexBot:
         :param string message:
         :param bot:
         :param string parse_mode:
+        :param keyboard_fields: values for KeyboardTemplate placeholders
         :return:
         """
 
+        if isinstance(keyboard, KeyboardTemplate):
+            keyboard = keyboard.markup(keyboard_fields)
+
         payload = {
             "chat_hash": chat_hash,
             "text": message,
@@ -242,7 +580,29 @@ class CodexBot:
             "bot": bot
         }
 
-        await self.send_to_chat(payload)
+        return await self.send_to_chat(payload)
 
-    async def send_to_chat(self, payload):
-        await self.broker.api.send('send to service', payload)
+    async def broadcast(self, chats, message_factory, bot=None, on_progress=None):
+        """
+        Send messages to many chats within per-bot and per-chat rate limits
+
+        Example:
+            stats = await self.sdk.broadcast(
+                subscribers(),                                          # Iterable or async iterator of chat hashes
+                lambda chat_hash: {'text': 'Good morning!'}             # Payload for send_to_chat
+            )
+
+        :param chats: iterable or async iterator of chat hashes. It is read as messages are sent
+        :param message_factory: function(chat_hash) returning payload for send_to_chat (may be a coroutine).
+                                None means skip the chat
+        :param bot: bot hash for payloads without 'bot'
+        :param on_progress: function(stats) called after every sent message
+        :return: stats {'sent', 'failed', 'skipped', 'errors': [(chat_hash, error)], 'seconds'}
+        """
+        return await self.broadcaster.broadcast(chats, message_factory, bot=bot, on_progress=on_progress)
+
+    async def send_to_chat(self, payload, lane=None):
+        """
+        :param lane: interactive or bulk. Defaults to the lane of the current task
+        """
+        return await self.broker.api.send('send to service', payload, lane=lane)
@@ -1,14 +1,33 @@
-import json
 import logging
+import time
 
-from ..lib.logging import Logging
+from ..lib.codec import get_codec
+from ..lib.lanes import INTERACTIVE, BULK
+from ..lib.logging import Logging, PAYLOAD_LOGGER
+from ..lib.metrics import REGISTRY
+from ..lib.middleware import compose, from_options
+
+PROCESS_SECONDS = REGISTRY.histogram('codexbot_api_process_seconds', 'Incoming message processing time', ['method'])
+PROCESS_ERRORS = REGISTRY.counter('codexbot_api_errors_total', 'Incoming message processing errors', ['method'])
+HANDLER_SECONDS = REGISTRY.histogram('codexbot_handler_seconds', 'Command handler execution time', ['command'])
+
+payload_logger = logging.getLogger(PAYLOAD_LOGGER)
 
 
 class API:
 
-    def __init__(self, broker, app_name, hawk):
+    # Lanes of incoming messages by method. Commands are interactive unless registered with {'lane': 'bulk'}
+    LANES = {
+        'show message': BULK
+    }
+
+    def __init__(self, broker, app_name, hawk, codec=None):
+        """
+        :param codec: wire codec. The fastest installed JSON library is used by default
+        """
 
         self.hawk = hawk
+        self.codec = codec or get_codec()
         self.app_name = app_name
         self.broker = broker
         self.token = app_name
@@ -16,6 +35,13 @@ class API:
         self.logging = Logging()
         self.commands_list = {}
 
+        # Middlewares for all handlers and for commands from register_commands options
+        self.middlewares = []
+        self.command_middlewares = {}
+        self.command_lanes = {}
+        # name => (handler, handler wrapped with middlewares)
+        self.pipelines = {}
+
         # Methods list (command => processor)
         self.methods = {
             'show message': self.show_message,
@@ -25,45 +51,143 @@ class API:
         }
 
     async def process(self, message_data):
+        started = time.perf_counter()
+        method = None
+
         try:
-            message_data = json.loads(message_data)
-            payload = message_data['payload']
-            command = message_data.get('command', 'show message')
-            await self.methods[command](payload)
+            if not isinstance(message_data, dict):
+                message_data = self.decode(message_data)
+            method = message_data.get('command', 'show message')
+            await self.dispatch(message_data)
         except Exception as e:
+            PROCESS_ERRORS.inc(method=method)
             if self.hawk:
                 self.hawk.catch()
             logging.error("API Message Process error: {}".format(e))
 
-    async def send(self, command, payload):
-
-        data = json.dumps({'token': self.broker.core.token,
-                           'command': command,
-                           'payload': payload})
-        await self.broker.send(data)
+        PROCESS_SECONDS.observe(time.perf_counter() - started, method=method)
+
+    def decode(self, message_data):
+        return self.codec.decode(message_data)
+
+    @staticmethod
+    def get_ordering_key(message_data):
+        """
+        Messages with the same key must be processed in order
+        :param message_data: decoded message
+        :return: chat hash or None
+        """
+        payload = message_data.get('payload')
+        if isinstance(payload, dict):
+            return payload.get('chat')
+        return None
+
+    def get_lane(self, message_data):
+        """
+        :param message_data: decoded message
+        :return: interactive or bulk
+        """
+        command = message_data.get('command', 'show message')
+        if command == 'service callback':
+            payload = message_data.get('payload')
+            if isinstance(payload, dict):
+                return self.command_lanes.get(payload.get('command'), INTERACTIVE)
+        return API.LANES.get(command, INTERACTIVE)
+
+    async def dispatch(self, message_data):
+        payload = message_data['payload']
+        command = message_data.get('command', 'show message')
+        await self.methods[command](payload)
+
+    async def send(self, command, payload, lane=None):
+
+        data = self.codec.encode({'token': self.broker.core.token,
+                                  'command': command,
+                                  'payload': payload})
+        return await self.broker.send(data, lane=lane)
 
     async def register_commands(self, commands):
+        """
+        :param commands: list of (command, description, handler) or (command, description, handler, options).
+                         Options: {'timeout': 10, 'concurrency': 5, 'max_waiting': 20,
+                                   'fallback': 'Too many requests, try later', 'middlewares': [...],
+                                   'lane': 'bulk'}
+                         fallback is a reply text or async function(payload) called on timeout and load shedding
+        """
         commands_to_send = []
-        for cmd, desc, clb in commands:
+        for command in commands:
+            cmd, desc, clb = command[:3]
+            options = command[3] if len(command) > 3 else {}
+
+            if options.get('concurrency') and self.broker.concurrency == 1:
+                logging.warning("Concurrency option of {} has no effect: broker handles messages one by one, "
+                                "pass concurrency to CodexBot".format(cmd))
+
             self.commands_list[cmd] = clb
+            self.command_middlewares[cmd] = from_options(cmd, options, self.fallback(options.get('fallback')))
+            self.command_lanes[cmd] = options.get('lane', INTERACTIVE)
+            self.pipelines.pop(cmd, None)
             commands_to_send.append((cmd, desc))
         await self.send('register commands', commands_to_send)
 
+    def use(self, middleware):
+        """
+        Add middleware for all handlers
+        :param middleware: async function(payload, call_next). It calls await call_next(payload) to run the handler
+        """
+        self.middlewares.append(middleware)
+        self.pipelines = {}
+
+    def pipeline(self, name, handler):
+        """
+        :return: handler wrapped with middlewares
+        """
+        pipeline = self.pipelines.get(name)
+        if pipeline is None or pipeline[0] is not handler:
+            middlewares = self.middlewares + self.command_middlewares.get(name, [])
+            pipeline = self.pipelines[name] = (handler, compose(middlewares, handler))
+        return pipeline[1]
+
+    def fallback(self, reply):
+        """
+        :param reply: text or async function(payload)
+        :return: async function(payload) or None
+        """
+        if reply is None or callable(reply):
+            return reply
+
+        async def send_reply(payload):
+            await self.broker.core.send_text_to_chat(payload['chat'], reply, bot=payload.get('bot'))
+
+        return send_reply
+
     # API COMMANDS
 
     async def show_message(self, data):
-        logging.info(data)
+        payload_logger.info("Show message: %s", data)
 
     async def service_callback(self, data):
-        await self.commands_list[data['command']](data)
+        command = data['command']
+        with HANDLER_SECONDS.time(command=command):
+            await self.pipeline(command, self.commands_list[command])(data)
 
     async def user_answer(self, data):
+        # Answer to wait_user_answer with a step goes to the step handler
+        if await self.broker.core.sessions.route(data, self.run_step):
+            return
+
         if self.broker.core.user_answer_handler:
-            await self.broker.core.user_answer_handler(data)
+            await self.pipeline('user answer', self.broker.core.user_answer_handler)(data)
+
+    async def run_step(self, handler, payload, session):
+        async def call(payload):
+            await handler(payload, session)
+
+        await compose(self.middlewares, call)(payload)
 
     async def wait_user_answer(self, user, chat, prompt='', bot=None):
         await self.send('wait user answer', {'user': user, 'chat': chat, 'prompt': prompt, 'bot': bot})
 
     async def callback_query(self, data):
         if self.broker.core.callback_query_handler:
-            await self.broker.core.callback_query_handler(data)
+            await self.pipeline('callback query', self.broker.core.callback_query_handler)(data)
@@ -1,19 +1,49 @@
+import inspect
 import logging
-
-from aio_pika import IncomingMessage
+import time
 
 from .api import API
-from ..lib.rabbitmq import init_receiver, add_message_to_queue, connect
+from ..lib.dispatcher import OrderedDispatcher
+from ..lib.lanes import PRIORITIES, current_lane, use_lane
+from ..lib.logging import PAYLOAD_LOGGER
+from ..lib.metrics import REGISTRY
+from ..lib.publisher import Publisher
+
+RECEIVED = REGISTRY.counter('codexbot_broker_received_total', 'Received messages', ['queue'])
+ACK_SECONDS = REGISTRY.histogram('codexbot_broker_ack_seconds', 'Time from message receive to ack', ['queue'])
+PUBLISH_SECONDS = REGISTRY.histogram('codexbot_broker_publish_seconds', 'Message publish time with confirm')
+IN_FLIGHT = REGISTRY.gauge('codexbot_broker_in_flight', 'Received messages not acked yet', ['queue'])
+DUPLICATES = REGISTRY.counter('codexbot_broker_duplicates_total', 'Duplicate messages acked without processing',
+                              ['queue'])
+PUBLISHER_QUEUE = REGISTRY.gauge('codexbot_publisher_queue_size', 'Messages buffered or being published', ['queue'])
+
+payload_logger = logging.getLogger(PAYLOAD_LOGGER)
 
 
 class Broker:
 
-    def __init__(self, core, event_loop, application_name, queue_name, rabbitmq_url, hawk):
+    def __init__(self, core, event_loop, application_name, queue_name, rabbitmq_url, hawk,
+                 concurrency=1, prefetch_count=None, publisher_config=None, transport=None, connect=True,
+                 lane_weights=None, max_priority=None, dedup_config=None):
         """
         Application broker initialization
         :param core:
         :param event_loop:
         :param queue_name: - passed from sdk constructor
+        :param concurrency: - number of messages processed at the same time.
+                              Messages from the same chat are always processed in order
+        :param prefetch_count: - number of unacknowledged messages delivered by RabbitMQ. Defaults to 2 * concurrency
+        :param publisher_config: - enables batched publishing. Dict with Publisher options:
+                                   max_batch_size, flush_interval, max_queue_size
+        :param transport: - Transport instance. Defaults to AmqpTransport with rabbitmq_url.
+                            LoopbackTransport runs the broker without RabbitMQ
+        :param connect: - connect in the constructor. Pass False and await open() in a running event loop
+        :param lane_weights: - share of workers and publishes of interactive and bulk lanes when both are busy.
+                               Defaults to {'interactive': 4, 'bulk': 1}
+        :param max_priority: - declare the queue with x-max-priority, so messages published by the core
+                               with higher priority are delivered first. The existing queue must be deleted first
+        :param dedup_config: - skip redelivered and duplicate messages. Dict with Deduplicator options:
+                               size, ttl, persistent. True means defaults
         """
         logging.info("Broker started with queue_name " + queue_name)
         self.hawk = hawk
@@ -23,20 +53,182 @@ class Broker:
         self.rabbitmq_url = rabbitmq_url
         self.api = API(self, application_name, hawk)
 
-        self.channel = self.event_loop.run_until_complete(connect(url=rabbitmq_url))
+        self.concurrency = concurrency
+        self.prefetch_count = prefetch_count or 1
+        if concurrency > 1:
+            self.prefetch_count = prefetch_count or 2 * concurrency
+        self.publisher_config = publisher_config
+        self.lane_weights = lane_weights
+        self.max_priority = max_priority
+        self.custom_transport = transport
+        self.deduplicator = None
+        if dedup_config:
+            from ..lib.dedup import Deduplicator
+            self.deduplicator = Deduplicator(**(dedup_config if isinstance(dedup_config, dict) else {}))
+        self.dispatcher = None
+        self.transport = None
+        self.publisher = None
+
+        if connect:
+            self.connect()
+
+    def connect(self):
+        self.event_loop.run_until_complete(self.open())
+
+    async def open(self):
+        """
+        Open connection and create dispatcher and publisher on the broker event loop
+        """
+        self.dispatcher = None
+        if self.concurrency > 1:
+            self.dispatcher = OrderedDispatcher(self.concurrency, max_in_flight=self.prefetch_count,
+                                                weights=self.lane_weights)
+
+        if self.custom_transport is not None:
+            self.transport = self.custom_transport
+        else:
+            # aio_pika is imported only when RabbitMQ is used
+            from ..lib.rabbitmq import AmqpTransport
+            self.transport = AmqpTransport(self.rabbitmq_url)
+        await self.transport.connect()
+
+        self.publisher = None
+        if self.publisher_config is not None:
+            config = dict(self.publisher_config)
+            config.setdefault('weights', self.lane_weights)
+            self.publisher = Publisher(self.publish, routing_key='core', **config)
+
+        # Removed by stop(), e.g. before forking server workers
+        REGISTRY.add_collector(self.collect_metrics)
+
+    def attach(self, event_loop):
+        """
+        Reconnect on another event loop. Used in forked server workers:
+        connections of the parent process can't be used there
+        """
+        if self.custom_transport is None:
+            from ..lib.rabbitmq import ConnectionManager
+            ConnectionManager.managers = {}
+        self.event_loop = event_loop
+        self.connect()
+
+    async def callback(self, message):
+        RECEIVED.inc(queue=self.queue_name)
+
+        dedup_key = None
+        if self.deduplicator is not None:
+            dedup_key = self.deduplicator.key(message)
+            if await self.deduplicator.seen(dedup_key, message.redelivered, self.api.db,
+                                            content=self.deduplicator.by_content(message)):
+                DUPLICATES.inc(queue=self.queue_name)
+                await self.ack(message)
+                return
+
+        if self.dispatcher is not None:
+            return await self.dispatch(message, dedup_key)
+
+        started = time.perf_counter()
 
-    async def callback(self, message: IncomingMessage):
         try:
-            logging.debug(" [x] Received %r" % message.body)
-            await self.api.process(message.body.decode("utf-8"))
-            message.ack()
+            payload_logger.debug(" [x] Received %r", message.body)
+            await self.process(message.body, dedup_key)
+            await self.ack(message)
+            ACK_SECONDS.observe(time.perf_counter() - started, queue=self.queue_name)
         except Exception as e:
             if self.hawk:
                 self.hawk.catch()
             logging.error("Broker callback error: {}".format(e))
 
-    async def send(self, message):
-        await add_message_to_queue(message, 'core', self.channel)
+    @staticmethod
+    async def ack(message):
+        """
+        Acknowledge the message. ack() of aio_pika messages is a coroutine, of LoopbackMessage it isn't
+        """
+        result = message.ack()
+        if inspect.isawaitable(result):
+            await result
+
+    async def process(self, message_data, dedup_key=None):
+        """
+        Process message and remember it for deduplication.
+        If processing is interrupted, the redelivered message is processed again
+        """
+        try:
+            await self.api.process(message_data)
+        except BaseException:
+            if dedup_key is not None:
+                self.deduplicator.forget(dedup_key)
+            raise
+
+        if dedup_key is not None:
+            await self.deduplicator.remember(dedup_key, self.api.db)
+
+    async def dispatch(self, message, dedup_key=None):
+        """
+        Pass message to the dispatcher. It is acknowledged as soon as its processing is finished
+        """
+        started = time.perf_counter()
+
+        try:
+            payload_logger.debug(" [x] Received %r", message.body)
+            message_data = self.api.decode(message.body)
+            key = self.api.get_ordering_key(message_data)
+            lane = self.api.get_lane(message_data)
+        except Exception as e:
+            if self.hawk:
+                self.hawk.catch()
+            logging.error("Broker callback error: {}".format(e))
+            await self.ack(message)
+            return
+
+        async def job():
+            # Replies are sent in the lane of the message
+            with use_lane(lane):
+                await self.process(message_data, dedup_key)
+            await self.ack(message)
+            ACK_SECONDS.observe(time.perf_counter() - started, queue=self.queue_name)
+
+        await self.dispatcher.submit(key, job, lane)
+
+    async def send(self, message, lane=None):
+        """
+        Send message to the core
+        :param lane: interactive or bulk. Defaults to the lane of the current task
+        :return: with batched publishing -- future resolved when the broker confirms the message
+        """
+        lane = lane or current_lane()
+        if self.publisher is not None:
+            return await self.publisher.publish(message, lane=lane)
+        await self.publish(message, 'core', PRIORITIES.get(lane))
+
+    async def publish(self, message, routing_key, priority=None):
+        with PUBLISH_SECONDS.time():
+            await self.transport.publish(message, routing_key, priority=priority)
+
+    def collect_metrics(self):
+        if self.dispatcher is not None:
+            IN_FLIGHT.set(self.dispatcher.pending, queue=self.queue_name)
+        if self.publisher is not None:
+            PUBLISHER_QUEUE.set(self.publisher.queue_size, queue=self.queue_name)
+
+    async def stop(self):
+        """
+        Finish processing of received messages and publish buffered ones
+        """
+        await self.transport.cancel(self.queue_name)
+        if self.dispatcher is not None:
+            await self.dispatcher.join()
+        if self.publisher is not None:
+            await self.publisher.flush()
+        await self.transport.close()
+
+        REGISTRY.remove_collector(self.collect_metrics)
+        IN_FLIGHT.remove(queue=self.queue_name)
+        PUBLISHER_QUEUE.remove(queue=self.queue_name)
 
     def start(self):
-        self.event_loop.run_until_complete(init_receiver(self.callback, self.queue_name, self.rabbitmq_url))
+        self.event_loop.run_until_complete(self.consume())
+
+    async def consume(self):
+        await self.transport.consume(self.queue_name, self.callback, prefetch_count=self.prefetch_count,
+                                     max_priority=self.max_priority)
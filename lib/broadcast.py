@@ -0,0 +1,93 @@
+import asyncio
+import inspect
+import logging
+import time
+
+from .lanes import BULK
+from .rate_limiter import RateLimiter
+
+
+class Broadcaster:
+
+    # Number of saved errors in broadcast stats
+    MAX_ERRORS = 100
+
+    def __init__(self, sdk, rate=30, chat_rate=1, concurrency=20):
+        """
+        Send messages to many chats within messenger rate limits.
+        Limits are shared by all broadcasts of the app.
+
+        :param sdk: CodexBot instance
+        :param rate: messages per second for each bot
+        :param chat_rate: messages per second for each chat
+        :param concurrency: number of messages sent at the same time
+        """
+        self.sdk = sdk
+        self.bot_limiter = RateLimiter(rate, max_keys=1000)
+        self.chat_limiter = RateLimiter(chat_rate, capacity=1)
+        self.concurrency = concurrency
+
+    async def broadcast(self, chats, message_factory, bot=None, on_progress=None):
+        """
+        :param chats: iterable or async iterator of chat hashes. It is read as messages are sent
+        :param message_factory: function(chat_hash) returning payload for send_to_chat (may be a coroutine).
+                                None means skip the chat
+        :param bot: default bot hash for payloads without 'bot'
+        :param on_progress: function(stats) called after every sent message
+        :return: stats {'sent', 'failed', 'skipped', 'errors': [(chat_hash, error)], 'seconds'}
+        """
+        started = time.monotonic()
+        stats = {'sent': 0, 'failed': 0, 'skipped': 0, 'errors': []}
+        pending = set()
+
+        async def send(chat_hash):
+            try:
+                payload = await self.__resolve(message_factory(chat_hash))
+                if payload is None:
+                    stats['skipped'] += 1
+                    return
+
+                payload = dict(payload)
+                payload.setdefault('chat_hash', chat_hash)
+                payload.setdefault('bot', bot)
+
+                # Chat limit first, so a bot token isn't held while waiting for the chat
+                await self.chat_limiter.acquire((payload['bot'], chat_hash))
+                await self.bot_limiter.acquire(payload['bot'])
+
+                # Wait for publisher confirm, if publishing is batched
+                await self.__resolve(await self.sdk.send_to_chat(payload, lane=BULK))
+                stats['sent'] += 1
+            except Exception as e:
+                stats['failed'] += 1
+                if len(stats['errors']) < Broadcaster.MAX_ERRORS:
+                    stats['errors'].append((chat_hash, repr(e)))
+                logging.error("Broadcast to {} error: {}".format(chat_hash, e))
+
+            if on_progress is not None:
+                on_progress(stats)
+
+        async def schedule(chat_hash):
+            if len(pending) >= self.concurrency:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                pending.difference_update(done)
+            pending.add(asyncio.ensure_future(send(chat_hash)))
+
+        if hasattr(chats, '__aiter__'):
+            async for chat_hash in chats:
+                await schedule(chat_hash)
+        else:
+            for chat_hash in chats:
+                await schedule(chat_hash)
+
+        if pending:
+            await asyncio.wait(pending)
+
+        stats['seconds'] = time.monotonic() - started
+        return stats
+
+    @staticmethod
+    async def __resolve(value):
+        if inspect.isawaitable(value):
+            return await value
+        return value
@@ -0,0 +1,70 @@
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+
+    # Returned by get() when key is not cached, because None is a valid cached value
+    MISSING = object()
+
+    def __init__(self, max_size=1000, ttl=60):
+        """
+        Least recently used cache with time to live
+        :param max_size: max number of items. The least recently used item is evicted on overflow
+        :param ttl: item lifetime in seconds. None means forever
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.items = OrderedDict()
+
+        # Incremented on clear() so readers can detect invalidation during a query
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=MISSING):
+        item = self.items.get(key)
+
+        if item is None:
+            self.misses += 1
+            return default
+
+        value, expires_at = item
+        if expires_at is not None and expires_at < time.monotonic():
+            del self.items[key]
+            self.misses += 1
+            return default
+
+        self.items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+
+        self.items[key] = (value, expires_at)
+        self.items.move_to_end(key)
+
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key):
+        self.items.pop(key, None)
+
+    def clear(self):
+        self.items.clear()
+        self.generation += 1
+
+    def stats(self):
+        return {
+            'size': len(self.items),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+    def __len__(self):
+        return len(self.items)
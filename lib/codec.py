@@ -0,0 +1,82 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+class JsonCodec:
+    """
+    Standard library json. Always available
+    """
+    name = 'json'
+
+    @staticmethod
+    def encode(data):
+        return json.dumps(data).encode('utf-8')
+
+    @staticmethod
+    def decode(data):
+        if isinstance(data, (bytes, bytearray)):
+            data = data.decode('utf-8')
+        return json.loads(data)
+
+
+class OrjsonCodec:
+    """
+    orjson works with bytes directly. Data it can't serialize (non-string keys, huge ints) is passed to stdlib json
+    """
+    name = 'orjson'
+
+    @staticmethod
+    def encode(data):
+        try:
+            return orjson.dumps(data)
+        except TypeError:
+            return JsonCodec.encode(data)
+
+    @staticmethod
+    def decode(data):
+        return orjson.loads(data)
+
+
+class UjsonCodec:
+    name = 'ujson'
+
+    @staticmethod
+    def encode(data):
+        return ujson.dumps(data).encode('utf-8')
+
+    @staticmethod
+    def decode(data):
+        return ujson.loads(data)
+
+
+CODECS = [
+    (OrjsonCodec, orjson),
+    (UjsonCodec, ujson),
+    (JsonCodec, json)
+]
+
+
+def available_codecs():
+    return [codec for codec, module in CODECS if module is not None]
+
+
+def get_codec(name=None):
+    """
+    Get codec by name or the fastest installed one
+    :param name: 'orjson', 'ujson' or 'json'
+    :return: codec with encode(data) -> bytes and decode(bytes) -> data
+    """
+    for codec in available_codecs():
+        if name is None or codec.name == name:
+            return codec
+
+    raise Exception("Codec {} is not installed".format(name))
@@ -0,0 +1,114 @@
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from .metrics import REGISTRY
+
+CPU_PENDING = REGISTRY.gauge('codexbot_cpu_pool_pending', 'Tasks queued or running in the process pool')
+CPU_WAITING = REGISTRY.gauge('codexbot_cpu_pool_waiting', 'Tasks waiting for space in the process pool queue')
+CPU_SECONDS = REGISTRY.histogram('codexbot_cpu_pool_seconds', 'Task time in the process pool, including queue')
+CPU_TIMEOUTS = REGISTRY.counter('codexbot_cpu_pool_timeouts_total', 'Process pool tasks which timed out')
+
+
+class CpuPool:
+
+    def __init__(self, workers=None, max_pending=None, timeout=None, start_method=None):
+        """
+        Run CPU-bound functions in worker processes, so they don't block the event loop.
+        Function, arguments and result must be picklable: use module-level functions.
+        Processes are started on first use.
+
+        :param workers: number of processes. Defaults to the number of CPUs
+        :param max_pending: run() waits while so many tasks are queued or running. Defaults to 4 * workers.
+                            A timed out task keeps its place until the worker finishes it
+        :param timeout: default task timeout in seconds. None -- no timeout
+        :param start_method: multiprocessing start method: fork, spawn or forkserver (Python 3.7+)
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending or 4 * self.workers
+        self.timeout = timeout
+        self.start_method = start_method
+
+        self.executor = None
+        self.slots = None
+        self.pending = 0
+        self.waiting = 0
+
+    async def run(self, function, *args, timeout=None, **kwargs):
+        """
+        :param function: picklable function
+        :param timeout: seconds. On timeout asyncio.TimeoutError is raised,
+                        but the worker process finishes the task anyway and keeps its slot till then
+        :return: function result
+        """
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_pending)
+
+        started = time.perf_counter()
+
+        self.waiting += 1
+        CPU_WAITING.set(self.waiting)
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+            CPU_WAITING.set(self.waiting)
+
+        self.pending += 1
+        CPU_PENDING.set(self.pending)
+        try:
+            task = self.__executor().submit(functools.partial(function, *args, **kwargs))
+        except BaseException:
+            self.__release()
+            raise
+
+        # Cancelling the awaiting coroutine doesn't stop the worker, so the slot is released when the task is done
+        loop = asyncio.get_event_loop()
+        task.add_done_callback(lambda task: self.__release_threadsafe(loop))
+
+        timeout = timeout if timeout is not None else self.timeout
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(task), timeout)
+        except asyncio.TimeoutError:
+            CPU_TIMEOUTS.inc()
+            logging.warning("CPU task {} timed out after {}s".format(getattr(function, '__name__', function),
+                                                                     timeout))
+            raise
+        finally:
+            CPU_SECONDS.observe(time.perf_counter() - started)
+
+    async def close(self, wait=True):
+        """
+        Stop worker processes
+        :param wait: wait for running tasks
+        """
+        if self.executor is None:
+            return
+
+        executor, self.executor = self.executor, None
+        await asyncio.get_event_loop().run_in_executor(None, functools.partial(executor.shutdown, wait=wait))
+
+    def __release(self):
+        self.pending -= 1
+        CPU_PENDING.set(self.pending)
+        self.slots.release()
+
+    def __release_threadsafe(self, loop):
+        # Done callbacks run in the executor thread
+        try:
+            loop.call_soon_threadsafe(self.__release)
+        except RuntimeError:
+            # Event loop is closed
+            pass
+
+    def __executor(self):
+        if self.executor is None:
+            options = {}
+            if self.start_method is not None:
+                options['mp_context'] = multiprocessing.get_context(self.start_method)
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, **options)
+        return self.executor
@@ -1,19 +1,71 @@
+import asyncio
+import copy
+import functools
+import inspect
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from pymongo import MongoClient
+from bson import json_util
+from pymongo import MongoClient, InsertOne, UpdateOne, ReplaceOne, DeleteMany
+
+from .cache import LRUCache
+from .metrics import REGISTRY
+
+DB_SECONDS = REGISTRY.histogram('codexbot_db_seconds', 'Db call duration', ['method', 'collection'])
+
+
+async def maybe_await(result):
+    """
+    Helper for code working with both Db and AsyncDb
+        > document = await maybe_await(self.sdk.db.find_one(collection, params))
+    """
+    if inspect.isawaitable(result):
+        return await result
+    return result
+
+
+def timed(method):
+    """
+    Observe Db method duration by method and collection
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, collection, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return method(self, collection, *args, **kwargs)
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - started, method=name, collection=collection)
+
+    return wrapper
+
+
+def unwrap(db):
+    """
+    Get Db or AsyncDb from CachedDb and WriteBehindDb wrappers.
+    Use it for queries which must not be cached or deferred
+    """
+    while isinstance(db, (CachedDb, WriteBehindDb)):
+        db = db.db
+    return db
 
 
 class Db:
 
-    def __init__(self, dbname, host='127.0.0.1', port=27017):
+    is_async = False
+
+    def __init__(self, dbname, host='127.0.0.1', port=27017, pool_size=100):
         """
         Initialize DB class with host and port.
         :param dbname: Database (DB) name
         :param host: DB host
         :param port: DB port
+        :param pool_size: max number of connections to MongoDB
         """
         try:
-            self.client = MongoClient(host, port)
+            self.client = MongoClient(host, port, maxPoolSize=pool_size)
             self.db = self.client[dbname]
 
         except Exception as e:
@@ -27,6 +79,7 @@ class Db:
         """
         return self.db.get(name)
 
+    @timed
     def find_one(self, collection, params):
         """
         Find piece of data in collection with search params
@@ -45,6 +98,26 @@ class Db:
         """
         return self.db[collection].find(params)
 
+    def find_batches(self, collection, params, batch_size=1000):
+        """
+        Iterate over search results by lists of batch_size documents.
+        Documents are fetched from DB by batches, so the whole result is never loaded to memory
+        :param collection: collection name
+        :param params: JSON search params
+        :param batch_size: number of documents in a batch
+        :return: generator of lists of JSON results
+        """
+        batch = []
+        for document in self.db[collection].find(params).batch_size(batch_size):
+            batch.append(document)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+
+        if batch:
+            yield batch
+
+    @timed
     def insert(self, collection, data):
         """
 
@@ -54,8 +127,439 @@ class Db:
         """
         return self.db[collection].insert(data)
 
+    @timed
     def update(self, collection, find_params, update_params, upsert=False):
         return self.db[collection].update(find_params, update_params, upsert=upsert)
 
+    @timed
     def remove(self, collection, find_params={}):
         return self.db[collection].remove(find_params)
+
+    @timed
+    def bulk_write(self, collection, operations, ordered=True):
+        """
+        Execute list of pymongo write operations (InsertOne, UpdateOne...) in one request
+        :param collection: collection name
+        :param operations: list of operations
+        :param ordered: stop on the first error
+        :return: BulkWriteResult
+        """
+        return self.db[collection].bulk_write(operations, ordered=ordered)
+
+    def create_index(self, collection, keys, **kwargs):
+        """
+        Create index if it doesn't exist
+        :param collection: collection name
+        :param keys: field name or list of (field, direction) pairs
+        :param kwargs: index options: unique, expireAfterSeconds...
+        :return: index name
+        """
+        return self.db[collection].create_index(keys, **kwargs)
+
+    def close(self):
+        self.client.close()
+
+
+class AsyncDb:
+
+    is_async = True
+
+    def __init__(self, dbname, host='127.0.0.1', port=27017, pool_size=10):
+        """
+        Non-blocking DB. Same methods as Db, but awaitable.
+        Queries run in a dedicated bounded thread pool, so they never block the event loop.
+
+        :param dbname: Database (DB) name
+        :param host: DB host
+        :param port: DB port
+        :param pool_size: number of queries running at the same time (threads and MongoDB connections)
+        """
+        self.sync = Db(dbname, host, port, pool_size=pool_size)
+        self.executor = ThreadPoolExecutor(max_workers=pool_size)
+
+    async def __run(self, function, *args, **kwargs):
+        return await asyncio.get_event_loop().run_in_executor(self.executor, lambda: function(*args, **kwargs))
+
+    async def get(self, name):
+        return await self.__run(self.sync.get, name)
+
+    async def find_one(self, collection, params):
+        return await self.__run(self.sync.find_one, collection, params)
+
+    async def find(self, collection, params):
+        """
+        Find data in collection with search params
+        :return: List of JSON results
+        """
+        return await self.__run(lambda: list(self.sync.find(collection, params)))
+
+    def find_batches(self, collection, params, batch_size=1000):
+        """
+        Iterate over search results by lists of batch_size documents
+            > async for documents in db.find_batches(collection, params):
+            >     ...
+        """
+        return AsyncBatches(self.executor, self.sync.find_batches(collection, params, batch_size))
+
+    async def insert(self, collection, data):
+        return await self.__run(self.sync.insert, collection, data)
+
+    async def update(self, collection, find_params, update_params, upsert=False):
+        return await self.__run(self.sync.update, collection, find_params, update_params, upsert=upsert)
+
+    async def remove(self, collection, find_params={}):
+        return await self.__run(self.sync.remove, collection, find_params)
+
+    async def bulk_write(self, collection, operations, ordered=True):
+        return await self.__run(self.sync.bulk_write, collection, operations, ordered=ordered)
+
+    async def create_index(self, collection, keys, **kwargs):
+        return await self.__run(self.sync.create_index, collection, keys, **kwargs)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.sync.close()
+
+
+class AsyncBatches:
+
+    def __init__(self, executor, batches):
+        """
+        Async iterator over Db.find_batches generator. Every batch is fetched in the executor
+        """
+        self.executor = executor
+        self.batches = batches
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        batch = await asyncio.get_event_loop().run_in_executor(self.executor, next, self.batches, None)
+        if batch is None:
+            raise StopAsyncIteration
+        return batch
+
+
+class FlushedBatches:
+
+    def __init__(self, flush, batches):
+        """
+        Async iterator over find_batches results, which waits for queued writes first
+        :param flush: future of WriteBehindDb flush
+        :param batches: AsyncBatches
+        """
+        self.flush = flush
+        self.batches = batches
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.flush is not None:
+            flush, self.flush = self.flush, None
+            await flush
+        return await self.batches.__anext__()
+
+
+class CachedDb:
+
+    def __init__(self, db, size=1000, ttl=60, collections=None):
+        """
+        Read-through cache for find_one in front of Db or AsyncDb.
+        Cached collection is invalidated by any insert, update, remove or bulk_write in it.
+
+        Example:
+            CachedDb(Db(...), size=1000, ttl=60, collections={'settings': {'size': 10000, 'ttl': 600}})
+
+        :param db: Db or AsyncDb instance
+        :param size: default max number of cached documents per collection
+        :param ttl: default cache lifetime in seconds
+        :param collections: per-collection {'size': ..., 'ttl': ...}.
+                            If passed, only these collections are cached
+        """
+        self.db = db
+        self.size = size
+        self.ttl = ttl
+        self.collections = collections
+        self.caches = {}
+        self.is_async = db.is_async
+
+    def __getattr__(self, name):
+        # Everything else (find, get, close...) goes directly to the db
+        return getattr(self.db, name)
+
+    def find_one(self, collection, params):
+        cache = self.__cache(collection)
+        if cache is None:
+            return self.db.find_one(collection, params)
+
+        key = self.__key(params)
+        value = cache.get(key)
+
+        if value is not LRUCache.MISSING:
+            value = copy.deepcopy(value)
+            return self.__resolved(value) if self.is_async else value
+
+        generation = cache.generation
+        result = self.db.find_one(collection, params)
+
+        if self.is_async:
+            return self.__store_when_ready(cache, key, generation, result)
+
+        cache.set(key, copy.deepcopy(result))
+        return result
+
+    def find_batches(self, collection, params, batch_size=1000):
+        # Not cached, but goes through WriteBehindDb.find_batches when it is wrapped
+        return self.db.find_batches(collection, params, batch_size)
+
+    def insert(self, collection, data):
+        return self.__write(collection, self.db.insert, collection, data)
+
+    def update(self, collection, find_params, update_params, upsert=False):
+        return self.__write(collection, self.db.update, collection, find_params, update_params, upsert=upsert)
+
+    def remove(self, collection, find_params={}):
+        return self.__write(collection, self.db.remove, collection, find_params)
+
+    def bulk_write(self, collection, operations, ordered=True):
+        return self.__write(collection, self.db.bulk_write, collection, operations, ordered=ordered)
+
+    def invalidate(self, collection=None):
+        """
+        Drop cached documents of the collection or of all collections
+        """
+        caches = self.caches.values() if collection is None else [self.caches.get(collection)]
+        for cache in caches:
+            if cache is not None:
+                cache.clear()
+
+    def stats(self):
+        """
+        :return: {collection: {'size', 'hits', 'misses', 'evictions'}}
+        """
+        return {collection: cache.stats() for collection, cache in self.caches.items()}
+
+    def __cache(self, collection):
+        cache = self.caches.get(collection)
+        if cache is not None:
+            return cache
+
+        if self.collections is None:
+            options = {}
+        elif collection in self.collections:
+            options = self.collections[collection]
+        else:
+            return None
+
+        cache = self.caches[collection] = LRUCache(options.get('size', self.size), options.get('ttl', self.ttl))
+        return cache
+
+    def __write(self, collection, method, *args, **kwargs):
+        self.invalidate(collection)
+        result = method(*args, **kwargs)
+
+        if self.is_async:
+            return self.__invalidate_when_ready(collection, result)
+
+        return result
+
+    async def __invalidate_when_ready(self, collection, result):
+        try:
+            return await result
+        finally:
+            # Drop documents read while the write was in progress
+            self.invalidate(collection)
+
+    @staticmethod
+    async def __store_when_ready(cache, key, generation, result):
+        result = await result
+        if cache.generation == generation:
+            cache.set(key, copy.deepcopy(result))
+        return result
+
+    @staticmethod
+    async def __resolved(value):
+        return value
+
+    @staticmethod
+    def __key(params):
+        # Canonical form: the same query with keys in another order has the same key.
+        # Extended JSON keeps types, so ObjectId('x') and 'x' are different keys
+        return json_util.dumps(params, sort_keys=True)
+
+
+class WriteBehindDb:
+
+    def __init__(self, db, batch_size=500, flush_interval=1.0, max_queue_size=10000):
+        """
+        Queue insert, update and remove per collection and write them with bulk_write.
+        Queue of the collection is flushed before any read from it, so reads see the queued writes.
+
+        Writes return nothing (inserted ids and update results are not known until flush).
+        With AsyncDb writes are awaitable: they wait only when the queue is full.
+
+        :param db: Db or AsyncDb instance
+        :param batch_size: flush collection queue when it has so many operations
+        :param flush_interval: flush all queues at least every flush_interval seconds
+        :param max_queue_size: max number of queued operations in all collections.
+                               When it is reached, writes wait for flush
+        """
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self.is_async = db.is_async
+
+        self.queues = {}
+        self.queued = 0
+        self.writing = {}
+        self.flush_task = None
+
+        self.flushed = 0
+        self.failed = 0
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+    def insert(self, collection, data):
+        documents = data if isinstance(data, list) else [data]
+        return self.__enqueue(collection, [InsertOne(document) for document in documents])
+
+    def update(self, collection, find_params, update_params, upsert=False):
+        # Like legacy update(): document without operators replaces the found one
+        if all(key.startswith('$') for key in update_params):
+            operation = UpdateOne(find_params, update_params, upsert=upsert)
+        else:
+            operation = ReplaceOne(find_params, update_params, upsert=upsert)
+        return self.__enqueue(collection, [operation])
+
+    def remove(self, collection, find_params={}):
+        return self.__enqueue(collection, [DeleteMany(find_params)])
+
+    def find_one(self, collection, params):
+        if self.is_async:
+            return self.__read_when_written(self.db.find_one, collection, params)
+
+        self.flush(collection)
+        return self.db.find_one(collection, params)
+
+    def find(self, collection, params):
+        if self.is_async:
+            return self.__read_when_written(self.db.find, collection, params)
+
+        self.flush(collection)
+        return self.db.find(collection, params)
+
+    def find_batches(self, collection, params, batch_size=1000):
+        if self.is_async:
+            # Started now, so queued writes aren't lost if the batches are never iterated
+            flush = asyncio.ensure_future(self.flush(collection))
+            return FlushedBatches(flush, self.db.find_batches(collection, params, batch_size))
+
+        self.flush(collection)
+        return self.db.find_batches(collection, params, batch_size)
+
+    def flush(self, collection=None):
+        """
+        Write queued operations of the collection or of all collections.
+        With AsyncDb returns awaitable resolved when they are written
+        """
+        names = list(self.queues) if collection is None else [collection]
+
+        batches = []
+        for name in names:
+            operations = self.queues.pop(name, None)
+            if operations:
+                self.queued -= len(operations)
+                batches.append((name, operations))
+
+        if self.is_async:
+            return self.__flush_async(batches, names)
+
+        for name, operations in batches:
+            self.__write(name, operations)
+
+    def stats(self):
+        return {
+            'queued': self.queued,
+            'flushed': self.flushed,
+            'failed': self.failed
+        }
+
+    def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        self.db.close()
+
+    def __enqueue(self, collection, operations):
+        self.queues.setdefault(collection, []).extend(operations)
+        self.queued += len(operations)
+
+        if self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self.__flush_periodically())
+
+        flush = None
+        if self.queued >= self.max_queue_size:
+            # Backpressure: writer waits until everything is written
+            flush = self.flush()
+        elif len(self.queues[collection]) >= self.batch_size:
+            flush = self.flush(collection)
+            if self.is_async:
+                # Don't wait for the batch write, just start it
+                asyncio.ensure_future(flush)
+                flush = None
+
+        if self.is_async:
+            return flush if flush is not None else self.__done()
+
+    def __write(self, collection, operations):
+        try:
+            self.db.bulk_write(collection, operations)
+            self.flushed += len(operations)
+        except Exception as e:
+            self.failed += len(operations)
+            logging.error("Write-behind error in {}: {}".format(collection, e))
+
+    async def __flush_async(self, batches, names):
+        for name, operations in batches:
+            # Writes to the same collection go one after another
+            task = asyncio.ensure_future(self.__write_async(self.writing.get(name), name, operations))
+            task.add_done_callback(lambda task, name=name: self.__written(name, task))
+            self.writing[name] = task
+
+        pending = [self.writing[name] for name in names if name in self.writing]
+        if pending:
+            await asyncio.wait(pending)
+
+    async def __write_async(self, previous, collection, operations):
+        if previous is not None:
+            await asyncio.wait([previous])
+
+        try:
+            await self.db.bulk_write(collection, operations)
+            self.flushed += len(operations)
+        except Exception as e:
+            self.failed += len(operations)
+            logging.error("Write-behind error in {}: {}".format(collection, e))
+
+    def __written(self, collection, task):
+        if self.writing.get(collection) is task:
+            del self.writing[collection]
+
+    async def __read_when_written(self, method, collection, params):
+        await self.flush(collection)
+        return await method(collection, params)
+
+    async def __flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await maybe_await(self.flush())
+            except Exception as e:
+                logging.error("Write-behind flush error: {}".format(e))
+
+    @staticmethod
+    async def __done():
+        return None
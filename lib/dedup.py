@@ -0,0 +1,94 @@
+import hashlib
+import logging
+from datetime import datetime, timezone
+
+from .cache import LRUCache
+from .db import maybe_await
+
+
+class Deduplicator:
+
+    COLLECTION_NAME = 'processed_messages'
+
+    def __init__(self, size=100000, ttl=3600, persistent=False):
+        """
+        Remember processed messages by AMQP message_id or sha1 of the body, so duplicates are skipped.
+        Messages without message_id are checked only when redelivered: the same body may be
+        a new message, e.g. the same command sent by the user again.
+
+        Processed keys are kept in memory. With persistent=True they are also saved to Db
+        with a TTL index, and redelivered messages unknown in memory are checked there:
+        this catches messages redelivered to another process after a crash.
+
+        :param size: max number of keys in memory
+        :param ttl: seconds to remember a message
+        :param persistent: save keys to Db
+        """
+        self.cache = LRUCache(size, ttl)
+        self.ttl = ttl
+        self.persistent = persistent
+        self.indexed = False
+
+    @staticmethod
+    def key(message):
+        if getattr(message, 'message_id', None):
+            return message.message_id
+        return hashlib.sha1(message.body).hexdigest()
+
+    @staticmethod
+    def by_content(message):
+        """
+        :return: True if key of the message is a hash of its body
+        """
+        return not getattr(message, 'message_id', None)
+
+    async def seen(self, key, redelivered=False, db=None, content=False):
+        """
+        Check if message was processed. Not processed message is claimed,
+        so its copy received during processing is a duplicate too
+        :param redelivered: message was delivered before. Only such messages are checked in Db
+        :param content: key is a hash of the body. Only redelivered messages are checked
+        :return: True for duplicate
+        """
+        if content and not redelivered:
+            return False
+
+        if self.cache.get(key) is not LRUCache.MISSING:
+            return True
+
+        if self.persistent and redelivered and db is not None:
+            try:
+                if await maybe_await(db.find_one(Deduplicator.COLLECTION_NAME, {'_id': key})) is not None:
+                    self.cache.set(key, True)
+                    return True
+            except Exception as e:
+                logging.error("Dedup store error: {}".format(e))
+
+        self.cache.set(key, True)
+        return False
+
+    async def remember(self, key, db=None):
+        """
+        Save processed message key, so its redelivered copy is skipped
+        """
+        self.cache.set(key, True)
+
+        if not self.persistent or db is None:
+            return
+
+        try:
+            if not self.indexed:
+                self.indexed = True
+                await maybe_await(db.create_index(Deduplicator.COLLECTION_NAME, 'created_at',
+                                                  expireAfterSeconds=self.ttl))
+
+            await maybe_await(db.update(Deduplicator.COLLECTION_NAME, {'_id': key},
+                                        {'$set': {'created_at': datetime.now(timezone.utc)}}, upsert=True))
+        except Exception as e:
+            logging.error("Dedup store error: {}".format(e))
+
+    def forget(self, key):
+        """
+        Allow message processing again, e.g. when it was interrupted before ack
+        """
+        self.cache.delete(key)
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+from collections import deque
+
+from .lanes import INTERACTIVE, WeightedRoundRobin
+
+
+class OrderedDispatcher:
+
+    def __init__(self, concurrency=8, max_in_flight=None, weights=None):
+        """
+        Run jobs on a bounded pool of workers.
+        Jobs with the same key are executed one after another in the order they were submitted,
+        jobs with different keys are executed concurrently.
+        When all workers are busy, free ones are given to waiting jobs of lanes by weights.
+
+        :param concurrency: number of jobs running at the same time
+        :param max_in_flight: number of accepted but not finished jobs. submit() waits when the limit is reached
+        :param weights: lane weights, e.g. {'interactive': 4, 'bulk': 1}
+        """
+        self.concurrency = concurrency
+        self.max_in_flight = max_in_flight or concurrency
+        self.free_slots = concurrency
+        self.waiting = {}
+        self.lanes = WeightedRoundRobin(weights)
+        self.in_flight = asyncio.Semaphore(self.max_in_flight)
+        self.queues = {}
+        self.workers = set()
+        self.pending = 0
+
+    async def submit(self, key, job, lane=INTERACTIVE):
+        """
+        Enqueue job for key.
+
+        :param key: ordering key (for example chat hash). None means "no ordering"
+        :param job: coroutine function without arguments
+        :param lane: lane of the job
+        """
+        await self.in_flight.acquire()
+        self.pending += 1
+
+        if key is None:
+            key = object()
+
+        queue = self.queues.get(key)
+        if queue is not None:
+            queue.append((job, lane))
+            return
+
+        self.queues[key] = deque([(job, lane)])
+        worker = asyncio.ensure_future(self.__drain(key))
+        self.workers.add(worker)
+        worker.add_done_callback(self.workers.discard)
+
+    async def join(self):
+        """
+        Wait until all submitted jobs are finished
+        """
+        while self.workers:
+            await asyncio.wait(list(self.workers))
+
+    async def __drain(self, key):
+        queue = self.queues[key]
+        try:
+            while queue:
+                job, lane = queue.popleft()
+                try:
+                    await self.__acquire(lane)
+                    try:
+                        await job()
+                    finally:
+                        self.__release()
+                except Exception as e:
+                    logging.error("Dispatcher job error: {}".format(e))
+                finally:
+                    self.pending -= 1
+                    self.in_flight.release()
+        finally:
+            del self.queues[key]
+
+    async def __acquire(self, lane):
+        if self.free_slots > 0 and not any(self.waiting.values()):
+            self.free_slots -= 1
+            return
+
+        slot = asyncio.get_event_loop().create_future()
+        self.waiting.setdefault(lane, deque()).append(slot)
+        try:
+            await slot
+        except asyncio.CancelledError:
+            if slot.done() and not slot.cancelled():
+                # The slot was given right before cancellation
+                self.__release()
+            else:
+                self.waiting[lane].remove(slot)
+            raise
+
+    def __release(self):
+        # Give the slot to a waiting job of the lane picked by weights
+        lanes = [lane for lane, slots in self.waiting.items() if slots]
+        if not lanes:
+            self.free_slots += 1
+            return
+
+        self.waiting[self.lanes.next(lanes)].popleft().set_result(None)
@@ -0,0 +1,192 @@
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+import urllib.request
+from collections import OrderedDict
+
+from .metrics import REGISTRY
+
+ERRORS_CAPTURED = REGISTRY.counter('codexbot_errors_captured_total', 'Exceptions passed to the error reporter')
+REPORTS_SENT = REGISTRY.counter('codexbot_error_reports_sent_total', 'Error reports sent')
+REPORTS_DROPPED = REGISTRY.counter('codexbot_error_reports_dropped_total', 'Error reports dropped',
+                                   ['reason'])
+
+
+class ErrorReporter:
+
+    def __init__(self, hawk=None, send=None, max_pending=1000, rate=5, interval=60, hawk_token=None):
+        """
+        Report exceptions in a background thread. Has the same catch() method as Hawk:
+            > except:
+            >     if self.sdk.hawk:
+            >         self.sdk.hawk.catch()
+
+        catch() only remembers the exception. Exceptions with the same fingerprint (type and traceback
+        frames) are reported once per interval with the number of occurrences.
+        Threads don't survive fork, so a forked process starts its own thread on first use.
+
+        :param hawk: Hawk instance
+        :param send: function(report) used instead of Hawk, e.g. ErrorReporter.post_json(url).
+                     report is a dict: fingerprint, type, message, traceback, count, first_seen, last_seen
+        :param max_pending: max number of distinct not reported errors. New ones are dropped
+        :param rate: max reports per second
+        :param interval: seconds between reports of the same error
+        :param hawk_token: create Hawk in the background thread, so hawkcatcher isn't imported on startup
+        """
+        self.hawk = hawk
+        self.hawk_token = hawk_token
+        self.send = send
+        self.max_pending = max_pending
+        self.rate = rate
+        self.interval = interval
+        self.stopped = False
+
+        self.__start()
+
+    def catch(self):
+        """
+        Capture the exception being handled
+        """
+        exc_info = sys.exc_info()
+        if exc_info[0] is None:
+            return
+
+        self.__check_fork()
+
+        ERRORS_CAPTURED.inc()
+        fingerprint = self.fingerprint(exc_info)
+        now = time.time()
+
+        with self.lock:
+            error = self.pending.get(fingerprint)
+            if error is not None:
+                error['count'] += 1
+                error['last_seen'] = now
+                return
+
+            if len(self.pending) >= self.max_pending:
+                REPORTS_DROPPED.inc(reason='queue_full')
+                return
+
+            self.pending[fingerprint] = {'exc_info': exc_info, 'count': 1, 'first_seen': now, 'last_seen': now}
+
+        self.wake.set()
+
+    def stop(self, timeout=5):
+        """
+        Send pending reports and stop the thread
+        """
+        self.__check_fork()
+        self.stopped = True
+        self.wake.set()
+        self.thread.join(timeout)
+
+    @staticmethod
+    def fingerprint(exc_info):
+        exc_type, _, tb = exc_info
+        parts = [exc_type.__module__, exc_type.__qualname__]
+
+        while tb is not None:
+            code = tb.tb_frame.f_code
+            parts.append('{}:{}:{}'.format(code.co_filename, code.co_name, tb.tb_lineno))
+            tb = tb.tb_next
+
+        return hashlib.sha1('\n'.join(parts).encode()).hexdigest()
+
+    @staticmethod
+    def post_json(url, timeout=5):
+        """
+        :return: send function posting reports as JSON to url
+        """
+        def send(report):
+            request = urllib.request.Request(url, data=json.dumps(report).encode(),
+                                             headers={'Content-Type': 'application/json'})
+            urllib.request.urlopen(request, timeout=timeout).close()
+
+        return send
+
+    def __start(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.pending = OrderedDict()
+        self.reported_at = {}
+
+        self.thread = threading.Thread(target=self.__run, name='error-reporter', daemon=True)
+        self.thread.start()
+
+    def __check_fork(self):
+        # Errors pending in the parent are reported by the parent
+        if self.pid != os.getpid():
+            self.__start()
+
+    def __run(self):
+        if self.hawk is None and self.hawk_token is not None:
+            try:
+                from hawkcatcher import Hawk
+                self.hawk = Hawk(self.hawk_token)
+            except Exception as e:
+                logging.error("Hawk initialization error: {}".format(e))
+
+        while True:
+            self.wake.wait(1)
+            self.wake.clear()
+            stopped = self.stopped
+
+            for fingerprint, error in self.__due(force=stopped):
+                self.__report(fingerprint, error)
+                time.sleep(1 / self.rate)
+
+            if stopped:
+                return
+
+    def __due(self, force=False):
+        now = time.time()
+        due = []
+
+        with self.lock:
+            for fingerprint in list(self.pending):
+                if force or now - self.reported_at.get(fingerprint, 0) >= self.interval:
+                    due.append((fingerprint, self.pending.pop(fingerprint)))
+                    self.reported_at[fingerprint] = now
+
+            # Forget errors which aren't limited anymore
+            for fingerprint, reported_at in list(self.reported_at.items()):
+                if now - reported_at >= self.interval and fingerprint not in self.pending:
+                    del self.reported_at[fingerprint]
+
+        return due
+
+    def __report(self, fingerprint, error):
+        exc_type, exc, tb = error.pop('exc_info')
+
+        try:
+            if self.send is not None:
+                error.update({
+                    'fingerprint': fingerprint,
+                    'type': exc_type.__name__,
+                    'message': str(exc),
+                    'traceback': ''.join(traceback.format_exception(exc_type, exc, tb))
+                })
+                self.send(error)
+            elif self.hawk is not None:
+                self.__send_to_hawk(exc_type, exc, tb)
+            REPORTS_SENT.inc()
+        except Exception as e:
+            REPORTS_DROPPED.inc(reason='send_error')
+            logging.error("Error report failed: {}".format(e))
+
+    def __send_to_hawk(self, exc_type, exc, tb):
+        if hasattr(self.hawk, 'handler'):
+            self.hawk.handler(exc_type, exc, tb)
+            return
+
+        try:
+            raise exc.with_traceback(tb)
+        except Exception:
+            self.hawk.catch()
@@ -0,0 +1,158 @@
+import re
+from string import Formatter
+
+# Placeholder name, optionally followed by .attribute or [index]
+PLACEHOLDER = re.compile(r'[A-Za-z_]\w*(?:[.\[]|$)')
+
+
+class KeyboardTemplate:
+
+    def __init__(self, rows, **options):
+        """
+        Keyboard prepared once and sent many times.
+        Button string values can have {placeholders} filled on every send. Buttons without them are
+        prepared once per token and shared between messages, so don't modify rendered keyboards.
+        Values with other braces, e.g. JSON in callback_data, are sent as is. Use {{ and }} for braces
+        in values with placeholders.
+
+        Example:
+            pages = KeyboardTemplate([
+                [{'text': '<', 'callback_data': 'page {prev}'}, {'text': '>', 'callback_data': 'page {next}'}],
+                [{'text': 'Close', 'callback_data': 'close'}]
+            ])
+
+            await self.sdk.send_inline_keyboard_to_chat(chat, 'Page 2', pages, keyboard_fields={'prev': 1, 'next': 3})
+
+        :param rows: array of button rows. The passed rows are not modified
+        :param options: reply keyboard options: resize_keyboard, one_time_keyboard...
+        """
+        self.rows = [[dict(button) for button in row] for row in rows]
+        self.options = options
+        self.dynamic = any(self.__placeholders(button) for row in self.rows for button in row)
+        self.compiled = {}
+
+    def render(self, fields=None, token=None):
+        """
+        :param fields: values for placeholders
+        :param token: app token. callback_data of inline buttons is prefixed with it
+        :return: array of button rows
+        """
+        rows = self.compiled.get(token)
+        if rows is None:
+            rows = self.compiled[token] = self.__compile(token)
+
+        if not self.dynamic:
+            return rows
+
+        fields = fields or {}
+        return [[button if isinstance(button, dict) else button.render(fields) for button in row] for row in rows]
+
+    def markup(self, fields=None):
+        """
+        :return: reply keyboard with options: {'keyboard': rows, 'resize_keyboard': ...}
+        """
+        markup = dict(self.options)
+        markup['keyboard'] = self.render(fields)
+        return markup
+
+    def __compile(self, token):
+        prefix = token + ' ' if token else ''
+        rows = []
+
+        for row in self.rows:
+            compiled_row = []
+            for button in row:
+                placeholders = self.__placeholders(button)
+                if placeholders:
+                    compiled_row.append(DynamicButton(button, placeholders, prefix))
+                else:
+                    compiled_row.append(prefix_callback_data(button, prefix))
+            rows.append(compiled_row)
+
+        return rows
+
+    @staticmethod
+    def __placeholders(button):
+        return [key for key, value in button.items() if isinstance(value, str) and is_template(value)]
+
+
+class DynamicButton:
+
+    def __init__(self, button, keys, prefix):
+        """
+        Button with placeholders in some values
+        :param button: button dict
+        :param keys: keys of values with placeholders
+        :param prefix: callback_data prefix
+        """
+        self.button = button
+        self.keys = keys
+        self.prefix = prefix
+
+    def render(self, fields):
+        button = dict(self.button)
+        for key in self.keys:
+            button[key] = button[key].format(**fields)
+        return prefix_callback_data(button, self.prefix)
+
+
+class KeyboardBuilder:
+
+    def __init__(self):
+        """
+        Example:
+            keyboard = KeyboardBuilder() \\
+                .button('1', callback_data='page 1').button('2', callback_data='page 2') \\
+                .row() \\
+                .button('Site', url='https://ifmo.su') \\
+                .build()
+        """
+        self.rows = [[]]
+        self.keyboard_options = {}
+
+    def button(self, text, callback_data=None, url=None, **options):
+        button = {'text': text}
+        if callback_data is not None:
+            button['callback_data'] = callback_data
+        if url is not None:
+            button['url'] = url
+        button.update(options)
+
+        self.rows[-1].append(button)
+        return self
+
+    def row(self):
+        if self.rows[-1]:
+            self.rows.append([])
+        return self
+
+    def options(self, **options):
+        self.keyboard_options.update(options)
+        return self
+
+    def build(self):
+        return KeyboardTemplate([row for row in self.rows if row], **self.keyboard_options)
+
+
+def is_template(value):
+    """
+    :return: True if the string has {placeholders} and no other braces
+    """
+    try:
+        fields = [field for _, field, _, _ in Formatter().parse(value) if field is not None]
+    except ValueError:
+        # Single { or }
+        return False
+    return bool(fields) and all(PLACEHOLDER.match(field) for field in fields)
+
+
+def prefix_callback_data(button, prefix):
+    """
+    :return: copy of the button with prefixed callback_data
+    """
+    if not prefix or 'callback_data' not in button:
+        return button
+
+    button = dict(button)
+    button['callback_data'] = prefix + button['callback_data']
+    return button
@@ -0,0 +1,75 @@
+from contextlib import contextmanager
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    # Python < 3.7: lane must be passed explicitly
+    ContextVar = None
+
+# Replies to users: commands, button presses, answers
+INTERACTIVE = 'interactive'
+# Broadcasts, batched scheduler jobs and heavy commands
+BULK = 'bulk'
+
+# Share of slots and publishes a lane gets when both lanes are busy
+WEIGHTS = {INTERACTIVE: 4, BULK: 1}
+
+# AMQP message priority by lane. Used by queues declared with x-max-priority
+PRIORITIES = {INTERACTIVE: 5, BULK: 1}
+
+current = ContextVar('codexbot_lane', default=None) if ContextVar is not None else None
+
+
+def current_lane(default=INTERACTIVE):
+    """
+    :return: lane set by use_lane() for the current task
+    """
+    lane = current.get() if current is not None else None
+    return lane or default
+
+
+@contextmanager
+def use_lane(lane):
+    """
+    Messages sent inside the block and in tasks created there use the lane
+        > with use_lane(BULK):
+        >     await self.sdk.send_text_to_chat(...)
+    """
+    if current is None:
+        yield
+        return
+
+    token = current.set(lane)
+    try:
+        yield
+    finally:
+        current.reset(token)
+
+
+class WeightedRoundRobin:
+
+    def __init__(self, weights=None):
+        """
+        Smooth weighted round robin: with weights {'interactive': 4, 'bulk': 1} busy lanes are picked
+        in order i i b i i, never starving the bulk lane
+        """
+        self.weights = dict(weights or WEIGHTS)
+        self.current = {lane: 0 for lane in self.weights}
+
+    def next(self, lanes):
+        """
+        :param lanes: lanes with waiting work
+        :return: lane to serve
+        """
+        if len(lanes) == 1:
+            return lanes[0]
+
+        total = 0
+        for lane in lanes:
+            weight = self.weights.get(lane, 1)
+            self.current[lane] = self.current.get(lane, 0) + weight
+            total += weight
+
+        lane = max(lanes, key=lambda lane: self.current[lane])
+        self.current[lane] -= total
+        return lane
@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import math
+import random
+import time
+import uuid
+
+from pymongo import UpdateMany
+from pymongo.errors import DuplicateKeyError
+
+from .db import maybe_await
+
+
+class PartitionLeases:
+
+    LEASES_COLLECTION = 'application_schedules_leases'
+    REPLICAS_COLLECTION = 'application_schedules_replicas'
+
+    def __init__(self, db, partitions=64, ttl=30, on_update=None, replica_id=None):
+        """
+        Split partitions 0..partitions-1 between replicas of the app with lease documents in MongoDB.
+
+        Every ttl / 3 seconds replica:
+            - renews its heartbeat document
+            - takes its fair share: ceil(partitions / live replicas)
+            - renews its leases and releases the surplus
+            - claims free or expired partitions until it has the fair share
+        Leases of a dead replica expire after ttl and are claimed by the others.
+
+        :param db: Db or AsyncDb. Writes must not be deferred, so don't pass WriteBehindDb
+        :param partitions: number of partitions
+        :param ttl: lease lifetime in seconds
+        :param on_update: coroutine function(gained, lost) called after every renewal with sets of partitions
+        :param replica_id: unique replica name. Random by default
+        """
+        self.db = db
+        self.partitions = partitions
+        self.ttl = ttl
+        self.on_update = on_update
+        self.replica_id = replica_id or uuid.uuid4().hex
+
+        self.owned = set()
+        self.task = None
+
+    def owns(self, partition):
+        return partition in self.owned
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.__run())
+
+    def attach(self, event_loop):
+        """
+        Renew leases on another event loop. Used in forked server workers,
+        where the task of the parent process never runs
+        """
+        if self.task is not None:
+            self.task.cancel()
+            self.task = event_loop.create_task(self.__run())
+
+    async def stop(self):
+        """
+        Release all leases, so other replicas can take them without waiting for expiration
+        """
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+        lost, self.owned = self.owned, set()
+
+        await maybe_await(self.db.bulk_write(PartitionLeases.LEASES_COLLECTION, [
+            UpdateMany({'owner': self.replica_id}, {'$set': {'owner': None, 'expires_at': 0}})
+        ]))
+        await maybe_await(self.db.remove(PartitionLeases.REPLICAS_COLLECTION, {'_id': self.replica_id}))
+
+        if lost and self.on_update is not None:
+            await self.on_update(set(), lost)
+
+    async def renew(self):
+        now = time.time()
+        expires_at = now + self.ttl
+
+        # Heartbeat
+        await maybe_await(self.db.update(PartitionLeases.REPLICAS_COLLECTION,
+                                         {'_id': self.replica_id},
+                                         {'$set': {'expires_at': expires_at}},
+                                         upsert=True))
+
+        replicas = await maybe_await(self.db.find(PartitionLeases.REPLICAS_COLLECTION, {'expires_at': {'$gt': now}}))
+        share = math.ceil(self.partitions / max(1, len(list(replicas))))
+
+        leases = await maybe_await(self.db.find(PartitionLeases.LEASES_COLLECTION, {'expires_at': {'$gt': now}}))
+        owned, taken = set(), set()
+        for lease in leases:
+            (owned if lease['owner'] == self.replica_id else taken).add(lease['_id'])
+
+        # Give the surplus to new replicas
+        surplus = sorted(owned)[share:]
+        owned.difference_update(surplus)
+
+        operations = [UpdateMany({'_id': {'$in': list(owned)}, 'owner': self.replica_id},
+                                 {'$set': {'expires_at': expires_at}})]
+        if surplus:
+            operations.append(UpdateMany({'_id': {'$in': surplus}, 'owner': self.replica_id},
+                                         {'$set': {'owner': None, 'expires_at': 0}}))
+        await maybe_await(self.db.bulk_write(PartitionLeases.LEASES_COLLECTION, operations))
+
+        # Claim free partitions. Shuffle to avoid contention between replicas
+        free = [partition for partition in range(self.partitions) if partition not in owned and partition not in taken]
+        random.shuffle(free)
+
+        for partition in free:
+            if len(owned) >= share:
+                break
+
+            try:
+                # Fails with duplicate key if somebody else owns the live lease
+                await maybe_await(self.db.update(PartitionLeases.LEASES_COLLECTION,
+                                                 {'_id': partition,
+                                                  '$or': [{'owner': None}, {'expires_at': {'$lte': now}}]},
+                                                 {'$set': {'owner': self.replica_id, 'expires_at': expires_at}},
+                                                 upsert=True))
+                owned.add(partition)
+            except DuplicateKeyError:
+                pass
+
+        gained, lost = owned - self.owned, self.owned - owned
+        self.owned = owned
+
+        if gained or lost:
+            logging.info("Replica {} owns {} partitions".format(self.replica_id, len(owned)))
+
+        if self.on_update is not None:
+            await self.on_update(gained, lost)
+
+    async def __run(self):
+        while True:
+            try:
+                await self.renew()
+            except Exception as e:
+                logging.error("Partition leases error: {}".format(e))
+
+            await asyncio.sleep(self.ttl / 3)
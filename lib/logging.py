@@ -1,17 +1,157 @@
+import atexit
 import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+FORMAT = "%(filename)-20s:%(lineno)-4s %(funcName)20s() \t %(message)s "
+
+# Message bodies and payloads are logged here. Off by default, enable with Logging(payload_level=logging.DEBUG)
+PAYLOAD_LOGGER = 'codexbot.payload'
 
 
 class Logging:
 
-    def __init__(self):
-        logger = logging.getLogger('asyncio')
+    # Logging is configured once per process by the first instance
+    configured = False
+    listener = None
+    handler = None
+
+    def __init__(self, level=logging.DEBUG, background=False, payload_level=None,
+                 rate=None, sample=None, queue_size=10000):
+        """
+        Configure root logger. Next instances use the existing configuration.
+
+        Example:
+            CodexBot(..., logging_config={'level': logging.INFO, 'background': True, 'rate': 10})
+
+        :param level: root logger level
+        :param background: only put records to a queue on the event loop. They are formatted
+                           and written to stderr in a background thread
+        :param payload_level: level of 'codexbot.payload' logger with message bodies. None -- disabled
+        :param rate: max records per second from every line of code. Extra records are dropped
+        :param sample: log only every n-th record from every line of code
+        :param queue_size: max number of queued records in background mode. Extra records are dropped
+        Rate and sample limits are applied to records below WARNING.
+        If the root logger already has handlers, they are used without limits
+        """
+        if Logging.configured:
+            return
+        Logging.configured = True
+
+        logging.getLogger('asyncio').setLevel(logging.DEBUG)
+        logging.getLogger(PAYLOAD_LOGGER).setLevel(logging.CRITICAL + 1 if payload_level is None else payload_level)
+
+        if background:
+            stream_handler = logging.StreamHandler(sys.stderr)
+            stream_handler.setFormatter(logging.Formatter(FORMAT))
 
-        logger.setLevel(logging.DEBUG)
-        format_str = "%(filename)-20s:%(lineno)-4s %(funcName)20s() \t %(message)s "
+            handler = BackgroundHandler(queue.Queue(queue_size))
+            Logging.listener = logging.handlers.QueueListener(handler.queue, stream_handler)
+            Logging.listener.start()
+            atexit.register(Logging.stop)
+
+            root = logging.getLogger()
+            root.setLevel(level)
+            root.addHandler(handler)
+        else:
+            # Like basicConfig: handlers configured by the application are kept as is
+            handler = None
+            root = logging.getLogger()
+            if not root.handlers:
+                handler = logging.StreamHandler(sys.stderr)
+                handler.setFormatter(logging.Formatter(FORMAT))
+                root.setLevel(level)
+                root.addHandler(handler)
+
+        if handler is not None and (rate or sample):
+            handler.addFilter(RepeatFilter(rate=rate, sample=sample))
+        Logging.handler = handler
 
-        logging.basicConfig(level=logging.DEBUG, format=format_str)
         logging.debug("Logging initiated.")
 
+    @staticmethod
+    def stop():
+        """
+        Write queued records and stop the background thread
+        """
+        if Logging.listener is not None:
+            Logging.listener.stop()
+            Logging.listener = None
+
     @staticmethod
     def debug(message):
         logging.debug(message)
+
+
+class BackgroundHandler(logging.handlers.QueueHandler):
+
+    def __init__(self, records_queue):
+        """
+        Put records to the queue without formatting. Records are dropped when the queue is full
+        """
+        super().__init__(records_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Message is formatted by QueueListener handlers in the background thread,
+        # so don't log objects which are changed after the call
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RepeatFilter(logging.Filter):
+
+    def __init__(self, rate=None, sample=None, level=logging.WARNING):
+        """
+        Limit records from the same line of code
+        :param rate: max records per second
+        :param sample: pass only every n-th record
+        :param level: records of this level and above always pass
+        """
+        super().__init__()
+        self.rate = rate
+        self.sample = sample
+        self.level = level
+        self.lock = threading.Lock()
+        # (pathname, lineno) => [second, records in the second, suppressed, total records]
+        self.counters = {}
+
+    def filter(self, record):
+        if record.levelno >= self.level:
+            return True
+
+        now = int(time.monotonic())
+        key = (record.pathname, record.lineno)
+
+        with self.lock:
+            counter = self.counters.get(key)
+            if counter is None:
+                counter = self.counters[key] = [now, 0, 0, 0]
+
+            counter[3] += 1
+            if self.sample and (counter[3] - 1) % self.sample:
+                return False
+
+            if counter[0] != now:
+                counter[0] = now
+                counter[1] = 0
+
+            if self.rate and counter[1] >= self.rate:
+                counter[2] += 1
+                return False
+
+            counter[1] += 1
+            suppressed, counter[2] = counter[2], 0
+
+        if suppressed and isinstance(record.msg, str):
+            record.msg += " ({} similar messages suppressed)".format(suppressed)
+
+        return True
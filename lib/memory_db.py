@@ -0,0 +1,257 @@
+import copy
+import itertools
+
+MISSING = object()
+
+
+class MemoryDb:
+
+    is_async = False
+
+    def __init__(self, dbname='memory', host=None, port=None, pool_size=None):
+        """
+        In-memory stand-in for Db, for tests and benchmarks without MongoDB.
+        Supports equality and $in, $nin, $ne, $gt, $gte, $lt, $lte, $exists, $or, $and in queries,
+        $set, $unset, $inc, $setOnInsert in updates, and unique indexes.
+        Arguments are the same as for Db and ignored
+        """
+        self.dbname = dbname
+        self.collections = {}
+        self.indexes = {}
+        self.ids = itertools.count(1)
+
+    def get(self, name):
+        return self.collections.setdefault(name, [])
+
+    def find_one(self, collection, params):
+        for document in self.__find(collection, params):
+            return copy.deepcopy(document)
+        return None
+
+    def find(self, collection, params):
+        """
+        :return: List of JSON results
+        """
+        return [copy.deepcopy(document) for document in self.__find(collection, params)]
+
+    def find_batches(self, collection, params, batch_size=1000):
+        documents = self.find(collection, params)
+        for start in range(0, len(documents), batch_size):
+            yield documents[start:start + batch_size]
+
+    def insert(self, collection, data):
+        if isinstance(data, list):
+            return [self.__insert(collection, document) for document in data]
+        return self.__insert(collection, data)
+
+    def update(self, collection, find_params, update_params, upsert=False, multi=False):
+        """
+        Like legacy update(): only the first found document is updated unless multi is passed.
+        Document without operators replaces the found one
+        """
+        found = self.__find(collection, find_params)
+        if not multi:
+            found = found[:1]
+
+        for document in found:
+            updated = self.__updated(document, update_params)
+            self.__check_unique(collection, updated, document)
+            document.clear()
+            document.update(updated)
+
+        if found:
+            return {'n': len(found), 'nModified': len(found), 'updatedExisting': True, 'ok': 1}
+
+        if upsert:
+            document = self.__updated({key: value for key, value in find_params.items()
+                                       if not key.startswith('$') and not self.__is_operator(value)},
+                                      update_params, inserted=True)
+            return {'n': 1, 'nModified': 0, 'updatedExisting': False, 'upserted': self.__insert(collection, document),
+                    'ok': 1}
+
+        return {'n': 0, 'nModified': 0, 'updatedExisting': False, 'ok': 1}
+
+    def remove(self, collection, find_params={}):
+        documents = self.collections.get(collection, [])
+        kept = [document for document in documents if not self.__match(document, find_params)]
+        self.collections[collection] = kept
+        return {'n': len(documents) - len(kept), 'ok': 1}
+
+    def bulk_write(self, collection, operations, ordered=True):
+        """
+        Execute pymongo operations: InsertOne, UpdateOne, UpdateMany, ReplaceOne, DeleteOne, DeleteMany
+        :return: {'inserted', 'matched', 'upserted', 'deleted'} counts
+        """
+        result = {'inserted': 0, 'matched': 0, 'upserted': 0, 'deleted': 0}
+
+        for operation in operations:
+            name = type(operation).__name__
+
+            if name == 'InsertOne':
+                self.__insert(collection, copy.deepcopy(operation._doc))
+                result['inserted'] += 1
+            elif name in ('UpdateOne', 'UpdateMany', 'ReplaceOne'):
+                response = self.update(collection, operation._filter, operation._doc,
+                                       upsert=operation._upsert, multi=name == 'UpdateMany')
+                result['matched'] += response['n'] if response['updatedExisting'] else 0
+                result['upserted'] += 0 if response['updatedExisting'] else response['n']
+            elif name == 'DeleteOne':
+                document = self.find_one(collection, operation._filter)
+                if document is not None:
+                    result['deleted'] += self.remove(collection, {'_id': document['_id']})['n']
+            elif name == 'DeleteMany':
+                result['deleted'] += self.remove(collection, operation._filter)['n']
+            else:
+                raise ValueError("Unsupported operation " + name)
+
+        return result
+
+    def create_index(self, collection, keys, **kwargs):
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        fields = tuple(field for field, _ in keys)
+
+        if kwargs.get('unique'):
+            seen = set()
+            for document in self.collections.get(collection, []):
+                value = tuple(repr(self.__get(document, field)) for field in fields)
+                if value in seen:
+                    raise self.__duplicate_key(fields)
+                seen.add(value)
+            self.indexes.setdefault(collection, set()).add(fields)
+
+        return '_'.join('{}_{}'.format(field, direction) for field, direction in keys)
+
+    def close(self):
+        pass
+
+    def __find(self, collection, params):
+        return [document for document in self.collections.get(collection, []) if self.__match(document, params)]
+
+    def __insert(self, collection, document):
+        if '_id' not in document:
+            document['_id'] = next(self.ids)
+        document = copy.deepcopy(document)
+        self.__check_unique(collection, document)
+        self.collections.setdefault(collection, []).append(document)
+        return document['_id']
+
+    def __check_unique(self, collection, document, current=None):
+        for fields in self.indexes.get(collection, set()) | {('_id',)}:
+            value = [self.__get(document, field) for field in fields]
+            for other in self.collections.get(collection, []):
+                if other is not current and [self.__get(other, field) for field in fields] == value:
+                    raise self.__duplicate_key(fields)
+
+    @staticmethod
+    def __duplicate_key(fields):
+        # pymongo is imported only here, so MemoryDb works without it until a unique index is violated
+        from pymongo.errors import DuplicateKeyError
+        return DuplicateKeyError("E11000 duplicate key error: {}".format(fields), 11000)
+
+    @classmethod
+    def __updated(cls, document, update_params, inserted=False):
+        if not any(key.startswith('$') for key in update_params):
+            updated = copy.deepcopy(update_params)
+            if '_id' in document:
+                updated['_id'] = document['_id']
+            return updated
+
+        updated = copy.deepcopy(document)
+        for operator, fields in update_params.items():
+            if operator == '$setOnInsert' and not inserted:
+                continue
+            for field, value in fields.items():
+                if operator in ('$set', '$setOnInsert'):
+                    cls.__set(updated, field, copy.deepcopy(value))
+                elif operator == '$unset':
+                    cls.__unset(updated, field)
+                elif operator == '$inc':
+                    current = cls.__get(updated, field)
+                    cls.__set(updated, field, value + (0 if current is MISSING else current))
+                else:
+                    raise ValueError("Unsupported update operator " + operator)
+
+        return updated
+
+    @classmethod
+    def __match(cls, document, query):
+        for key, condition in query.items():
+            if key == '$or':
+                if not any(cls.__match(document, item) for item in condition):
+                    return False
+            elif key == '$and':
+                if not all(cls.__match(document, item) for item in condition):
+                    return False
+            elif cls.__is_operator(condition):
+                value = cls.__get(document, key)
+                if not all(cls.__compare(operator, value, argument) for operator, argument in condition.items()):
+                    return False
+            elif not cls.__equals(cls.__get(document, key), condition):
+                return False
+        return True
+
+    @classmethod
+    def __compare(cls, operator, value, argument):
+        if operator == '$exists':
+            return (value is not MISSING) == bool(argument)
+        if operator == '$ne':
+            return not cls.__equals(value, argument)
+        if operator == '$in':
+            return any(cls.__equals(value, item) for item in argument)
+        if operator == '$nin':
+            return not any(cls.__equals(value, item) for item in argument)
+
+        if value is MISSING or value is None:
+            return False
+        try:
+            if operator == '$gt':
+                return value > argument
+            if operator == '$gte':
+                return value >= argument
+            if operator == '$lt':
+                return value < argument
+            if operator == '$lte':
+                return value <= argument
+        except TypeError:
+            return False
+
+        raise ValueError("Unsupported query operator " + operator)
+
+    @staticmethod
+    def __equals(value, condition):
+        # Like MongoDB: None matches missing fields, scalar matches array items
+        if value is MISSING:
+            return condition is None
+        if isinstance(value, list) and not isinstance(condition, list):
+            return condition in value
+        return value == condition
+
+    @staticmethod
+    def __is_operator(value):
+        return isinstance(value, dict) and bool(value) and all(key.startswith('$') for key in value)
+
+    @staticmethod
+    def __get(document, field):
+        value = document
+        for part in field.split('.'):
+            if not isinstance(value, dict) or part not in value:
+                return MISSING
+            value = value[part]
+        return value
+
+    @staticmethod
+    def __set(document, field, value):
+        parts = field.split('.')
+        for part in parts[:-1]:
+            document = document.setdefault(part, {})
+        document[parts[-1]] = value
+
+    @staticmethod
+    def __unset(document, field):
+        parts = field.split('.')
+        for part in parts[:-1]:
+            document = document.get(part)
+            if not isinstance(document, dict):
+                return
+        document.pop(parts[-1], None)
@@ -0,0 +1,198 @@
+import threading
+import time
+from bisect import bisect_left
+
+
+class Metric:
+
+    type = 'untyped'
+
+    def __init__(self, name, description, labels=()):
+        """
+        :param name: metric name
+        :param description: help text
+        :param labels: label names. Values are passed as keyword arguments
+        """
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple('' if labels.get(label) is None else str(labels[label]) for label in self.labels)
+
+    def remove(self, **labels):
+        """
+        Forget values with these labels, e.g. of a stopped component
+        """
+        key = self.key(labels)
+        with self.lock:
+            self.values.pop(key, None)
+
+    def samples(self):
+        """
+        :return: list of (suffix, labels dict, value)
+        """
+        with self.lock:
+            return [('', dict(zip(self.labels, key)), value) for key, value in self.values.items()]
+
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+
+class Gauge(Metric):
+
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, value=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def dec(self, value=1, **labels):
+        self.inc(-value, **labels)
+
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    BUCKETS = (.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, description, labels=(), buckets=BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect_left(self.buckets, value)
+
+        with self.lock:
+            item = self.values.get(key)
+            if item is None:
+                # Counts by bucket (the last one is +Inf), sum
+                item = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            item[0][index] += 1
+            item[1] += value
+
+    def time(self, **labels):
+        """
+        Measure duration of the block
+            > with histogram.time(command='weather'):
+            >     ...
+        """
+        return Timer(self, labels)
+
+    def samples(self):
+        samples = []
+
+        with self.lock:
+            items = [(key, list(counts), total) for key, (counts, total) in self.values.items()]
+
+        for key, counts, total in items:
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                bucket_labels = dict(labels)
+                bucket_labels['le'] = str(bound)
+                samples.append(('_bucket', bucket_labels, cumulative))
+            samples.append(('_sum', labels, total))
+            samples.append(('_count', labels, cumulative))
+
+        return samples
+
+
+class Timer:
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+
+    def counter(self, name, description, labels=()):
+        return self.__register(Counter, name, description, labels)
+
+    def gauge(self, name, description, labels=()):
+        return self.__register(Gauge, name, description, labels)
+
+    def histogram(self, name, description, labels=(), buckets=Histogram.BUCKETS):
+        return self.__register(Histogram, name, description, labels, buckets=buckets)
+
+    def add_collector(self, collector):
+        """
+        :param collector: function called before rendering, e.g. to set gauges from current state.
+                          Adding the same collector again does nothing
+        """
+        if collector not in self.collectors:
+            self.collectors.append(collector)
+
+    def remove_collector(self, collector):
+        """
+        :param collector: function passed to add_collector
+        """
+        if collector in self.collectors:
+            self.collectors.remove(collector)
+
+    def render(self):
+        """
+        :return: metrics in Prometheus text format
+        """
+        for collector in self.collectors:
+            collector()
+
+        lines = []
+        for metric in self.metrics.values():
+            lines.append('# HELP {} {}'.format(metric.name, metric.description))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            for suffix, labels, value in metric.samples():
+                lines.append('{}{}{} {}'.format(metric.name, suffix, self.__labels(labels), value))
+
+        return '\n'.join(lines) + '\n'
+
+    def __register(self, metric_class, name, description, labels, **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = metric_class(name, description, labels, **kwargs)
+        return metric
+
+    @staticmethod
+    def __labels(labels):
+        if not labels:
+            return ''
+
+        def escape(value):
+            return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        return '{' + ','.join('{}="{}"'.format(name, escape(value)) for name, value in labels.items()) + '}'
+
+
+# Default registry used by the SDK components
+REGISTRY = Registry()
@@ -0,0 +1,114 @@
+import asyncio
+import logging
+
+from .metrics import REGISTRY
+
+TIMEOUTS = REGISTRY.counter('codexbot_handler_timeouts_total', 'Handlers cancelled by timeout', ['command'])
+SHED = REGISTRY.counter('codexbot_handler_shed_total', 'Messages rejected by load shedding', ['command'])
+WAITING = REGISTRY.gauge('codexbot_handler_waiting', 'Messages waiting for a concurrency slot', ['command'])
+
+
+def compose(middlewares, handler):
+    """
+    Wrap handler with middlewares. The first middleware is the outermost one
+    :param middlewares: list of async functions(payload, call_next)
+    :param handler: async function(payload)
+    :return: async function(payload)
+    """
+    for middleware in reversed(middlewares):
+        handler = wrap(middleware, handler)
+    return handler
+
+
+def wrap(middleware, handler):
+    async def call(payload):
+        return await middleware(payload, handler)
+    return call
+
+
+def from_options(command, options, fallback=None):
+    """
+    Build middlewares from register_commands options:
+        {'timeout': 10, 'concurrency': 5, 'max_waiting': 20, 'middlewares': [...]}
+    :param command: command name for metrics
+    :param fallback: async function(payload) called on timeout and load shedding
+    """
+    middlewares = list(options.get('middlewares', []))
+
+    if options.get('concurrency'):
+        middlewares.append(ConcurrencyLimit(options['concurrency'], max_waiting=options.get('max_waiting'),
+                                            fallback=fallback, name=command))
+    if options.get('timeout'):
+        middlewares.append(Timeout(options['timeout'], fallback=fallback, name=command))
+
+    return middlewares
+
+
+class Timeout:
+
+    def __init__(self, seconds, fallback=None, name=None):
+        """
+        Cancel handler after timeout
+        :param seconds: timeout
+        :param fallback: async function(payload) called after timeout, e.g. to reply "try later"
+        :param name: label for metrics
+        """
+        self.seconds = seconds
+        self.fallback = fallback
+        self.name = name
+
+    async def __call__(self, payload, call_next):
+        try:
+            return await asyncio.wait_for(call_next(payload), self.seconds)
+        except asyncio.TimeoutError:
+            TIMEOUTS.inc(command=self.name)
+            logging.warning("Handler {} timed out after {}s".format(self.name, self.seconds))
+            if self.fallback is not None:
+                await self.fallback(payload)
+
+
+class ConcurrencyLimit:
+
+    def __init__(self, limit, max_waiting=None, fallback=None, name=None):
+        """
+        Run at most limit handlers at the same time. Others wait for a slot.
+        When max_waiting messages are waiting, new ones are rejected at once with fallback.
+
+        Handlers run concurrently only with CodexBot(..., concurrency=N). With the default concurrency=1
+        messages are handled one by one, so the limit is never reached and nothing is rejected
+
+        :param limit: number of handlers running at the same time
+        :param max_waiting: max number of waiting messages. None -- no limit, 0 -- reject when all slots are busy
+        :param fallback: async function(payload) called for rejected messages, e.g. to reply "too busy"
+        :param name: label for metrics
+        """
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.fallback = fallback
+        self.name = name
+        self.waiting = 0
+        self.semaphore = None
+
+    async def __call__(self, payload, call_next):
+        if self.semaphore is None:
+            # Created on the event loop which runs handlers
+            self.semaphore = asyncio.Semaphore(self.limit)
+
+        if self.max_waiting is not None and self.semaphore.locked() and self.waiting >= self.max_waiting:
+            SHED.inc(command=self.name)
+            if self.fallback is not None:
+                await self.fallback(payload)
+            return
+
+        self.waiting += 1
+        WAITING.set(self.waiting, command=self.name)
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+            WAITING.set(self.waiting, command=self.name)
+
+        try:
+            return await call_next(payload)
+        finally:
+            self.semaphore.release()
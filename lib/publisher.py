@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from .lanes import INTERACTIVE, PRIORITIES, WEIGHTS, WeightedRoundRobin, current_lane
+
+
+class Publisher:
+
+    def __init__(self, send, routing_key='core', max_batch_size=100, flush_interval=0.005, max_queue_size=10000,
+                 weights=None, max_bulk_queue_size=None):
+        """
+        Buffer outgoing messages and publish them in batches.
+        All publishes of a batch are pipelined on the channel, so the batch costs one round trip of broker confirms.
+
+        Messages are buffered by lanes. Batches take messages of the lanes by weights,
+        so interactive replies don't wait behind a broadcast.
+
+        :param send: coroutine function send(data, routing_key, priority) which publishes one message and
+                     returns when the broker confirms it
+        :param routing_key: default routing key
+        :param max_batch_size: flush when so many messages are buffered
+        :param flush_interval: flush buffered messages not later than this (seconds)
+        :param max_queue_size: publish() waits while so many messages are buffered or being published
+        :param weights: lane weights, e.g. {'interactive': 4, 'bulk': 1}
+        :param max_bulk_queue_size: publish() to other lanes than interactive waits while so many messages are queued,
+                                    so they always leave space for interactive ones. Defaults to max_queue_size / 2
+        """
+        self.send = send
+        self.routing_key = routing_key
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self.max_bulk_queue_size = max_bulk_queue_size or max(1, max_queue_size // 2)
+
+        self.buffers = {lane: deque() for lane in (weights or WEIGHTS)}
+        self.buffered = 0
+        self.lanes = WeightedRoundRobin(weights)
+        self.queue_size = 0
+        self.has_space = asyncio.Event()
+        self.has_space.set()
+        self.flush_handle = None
+        self.flushes = set()
+
+        # Stats
+        self.published = 0
+        self.failed = 0
+        self.batches = 0
+        self.last_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+
+    async def publish(self, data, routing_key=None, lane=None):
+        """
+        Add message to the buffer
+        :param data: message body
+        :param routing_key: queue name. Defaults to publisher routing key
+        :param lane: lane of the message. Defaults to the lane of the current task or interactive
+        :return: future resolved when the broker confirms the message
+        """
+        lane = lane or current_lane()
+        limit = self.max_queue_size if lane == INTERACTIVE else self.max_bulk_queue_size
+
+        while self.queue_size >= limit:
+            self.has_space.clear()
+            await self.has_space.wait()
+
+        future = asyncio.get_event_loop().create_future()
+        self.buffers.setdefault(lane, deque()).append((data, routing_key or self.routing_key, PRIORITIES.get(lane),
+                                                       future))
+        self.buffered += 1
+        self.queue_size += 1
+
+        if self.buffered >= self.max_batch_size:
+            self.__flush_soon(0)
+        elif self.flush_handle is None:
+            self.__flush_soon(self.flush_interval)
+
+        return future
+
+    async def flush(self):
+        """
+        Publish everything buffered and wait for the pending batches
+        """
+        self.__start_flush()
+        while self.flushes:
+            await asyncio.wait(list(self.flushes))
+
+    def stats(self):
+        return {
+            'queue_size': self.queue_size,
+            'buffered': {lane: len(buffer) for lane, buffer in self.buffers.items()},
+            'published': self.published,
+            'failed': self.failed,
+            'batches': self.batches,
+            'last_flush_latency': self.last_flush_latency,
+            'avg_flush_latency': self.total_flush_latency / self.batches if self.batches else 0.0
+        }
+
+    def __flush_soon(self, delay):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+        self.flush_handle = asyncio.get_event_loop().call_later(delay, self.__start_flush)
+
+    def __start_flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        while self.buffered:
+            task = asyncio.ensure_future(self.__publish_batch(self.__take_batch()))
+            self.flushes.add(task)
+            task.add_done_callback(self.flushes.discard)
+
+    def __take_batch(self):
+        batch = []
+        lanes = [lane for lane, buffer in self.buffers.items() if buffer]
+
+        while lanes and len(batch) < self.max_batch_size:
+            lane = self.lanes.next(lanes)
+            buffer = self.buffers[lane]
+            batch.append(buffer.popleft())
+            if not buffer:
+                lanes.remove(lane)
+
+        self.buffered -= len(batch)
+        return batch
+
+    async def __publish_batch(self, batch):
+        started = time.monotonic()
+
+        results = await asyncio.gather(*[self.send(data, routing_key, priority)
+                                         for data, routing_key, priority, _ in batch],
+                                       return_exceptions=True)
+
+        for (_, _, _, future), result in zip(batch, results):
+            if isinstance(result, BaseException):
+                self.failed += 1
+                logging.error("Publish error: {}".format(result))
+                if not future.done():
+                    future.set_exception(result)
+                    # Error is already logged, so don't complain about unretrieved exception
+                    future.exception()
+            else:
+                self.published += 1
+                if not future.done():
+                    future.set_result(result)
+
+        self.batches += 1
+        self.last_flush_latency = time.monotonic() - started
+        self.total_flush_latency += self.last_flush_latency
+
+        self.queue_size -= len(batch)
+        self.has_space.set()
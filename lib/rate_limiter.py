@@ -0,0 +1,67 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class TokenBucket:
+
+    def __init__(self, rate, capacity=None):
+        """
+        Token bucket: rate tokens per second, up to capacity tokens saved for bursts
+        :param rate: tokens per second
+        :param capacity: max number of tokens. Defaults to rate
+        """
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def reserve(self):
+        """
+        Take a token now or reserve the next one
+        :return: seconds to wait before using the token
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+
+        return -self.tokens / self.rate
+
+    async def acquire(self):
+        delay = self.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
+
+class RateLimiter:
+
+    def __init__(self, rate, capacity=None, max_keys=10000):
+        """
+        Token buckets by key (bot, chat...)
+        :param rate: tokens per second for every key
+        :param capacity: bucket capacity
+        :param max_keys: number of buckets kept. Least recently used buckets are dropped
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+
+    def bucket(self, key):
+        bucket = self.buckets.get(key)
+
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.capacity)
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+
+        return bucket
+
+    async def acquire(self, key):
+        await self.bucket(key).acquire()
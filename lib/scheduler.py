@@ -1,10 +1,55 @@
+import asyncio
+import inspect
+import json
+import logging
+import time
+import zlib
+from datetime import datetime, timezone
+
+from apscheduler.events import EVENT_JOB_SUBMITTED
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.cron import CronTrigger
+from pymongo.errors import OperationFailure
+
+from .db import maybe_await, unwrap
+from .lanes import BULK, use_lane
+from .leases import PartitionLeases
+from .metrics import REGISTRY
+
+JOB_LAG_SECONDS = REGISTRY.histogram('codexbot_scheduler_lag_seconds', 'Delay between job scheduled and actual run time')
+JOBS = REGISTRY.gauge('codexbot_scheduler_jobs', 'Scheduled jobs', ['application'])
+
+
+class BatchJob:
+
+    def __init__(self, processor, trigger_params, chunk_size, spread):
+        """
+        Jobs with the same processor and trigger run by one scheduled tick
+        :param processor: function(list of jobs args)
+        :param trigger_params: cron params
+        :param chunk_size: max number of jobs passed to one processor call
+        :param spread: seconds to spread processor calls over
+        """
+        self.processor = processor
+        self.trigger_params = trigger_params
+        self.chunk_size = chunk_size
+        self.spread = spread
+        self.members = {}
 
 
 class Scheduler:
 
     COLLECTION_NAME = 'application_schedules'
 
+    # Jobs are split into partitions by id for sharded mode
+    PARTITIONS = 64
+
+    # Jobs are loaded from DB by batches of this size on restore
+    RESTORE_BATCH_SIZE = 1000
+
+    # Number of batched jobs passed to one processor call
+    BATCH_CHUNK_SIZE = 100
+
     def __init__(self, sdk):
         """
         Initialize apscheduler and start
@@ -12,34 +57,335 @@ class Scheduler:
         :param sdk:
         """
         self.sdk = sdk
-        self.scheduler = AsyncIOScheduler()
+        self.scheduler = self.__create_scheduler()
         self.scheduler.start()
 
-    def restore(self, processor):
+        REGISTRY.add_collector(self.__collect_metrics)
+
+        # Shared triggers by trigger params and signatures of added jobs to skip unchanged ones
+        self.triggers = {}
+        self.signatures = {}
+
+        # Batched jobs: BatchJob by (processor, trigger) and by job id,
+        # (processor, chunk_size, spread) by processor name
+        self.batches = {}
+        self.batch_members = {}
+        self.batch_processors = {}
+
+        # Sharded mode
+        self.leases = None
+        self.processor = None
+        self.synced_at = 0
+
+        self.ensure_indexes()
+
+    def __create_scheduler(self, **options):
+        scheduler = AsyncIOScheduler(**options)
+        scheduler.add_listener(self.__job_submitted, EVENT_JOB_SUBMITTED)
+        return scheduler
+
+    def __collect_metrics(self):
+        JOBS.set(len(self.scheduler.get_jobs()), application=self.sdk.application_name)
+
+    @staticmethod
+    def __job_submitted(event):
+        now = datetime.now(timezone.utc)
+        for run_time in event.scheduled_run_times:
+            JOB_LAG_SECONDS.observe((now - run_time).total_seconds())
+
+    def ensure_indexes(self):
+        """
+        Create unique index on job id and index for sharded mode sync.
+        Runs immediately when the event loop is not running yet, otherwise returns task
+        """
+        task = asyncio.ensure_future(self.__ensure_indexes(), loop=self.sdk.event_loop)
+
+        if not self.sdk.event_loop.is_running():
+            return self.sdk.event_loop.run_until_complete(task)
+
+        return task
+
+    async def __ensure_indexes(self):
+        db = unwrap(self.sdk.db)
+
+        try:
+            try:
+                await maybe_await(db.create_index(Scheduler.COLLECTION_NAME, 'id', unique=True))
+            except OperationFailure as e:
+                # Duplicate jobs saved before the index existed
+                if e.code != 11000:
+                    raise
+                await self.__remove_duplicates(db)
+                await maybe_await(db.create_index(Scheduler.COLLECTION_NAME, 'id', unique=True))
+
+            await maybe_await(db.create_index(Scheduler.COLLECTION_NAME, [('partition', 1), ('updated_at', 1)]))
+        except Exception as e:
+            if self.sdk.hawk:
+                self.sdk.hawk.catch()
+            logging.error("Scheduler indexes error: {}".format(e))
+
+    async def __remove_duplicates(self, db):
+        """
+        Keep the last saved document of every job
+        """
+        last = {}
+        duplicates = []
+
+        jobs = await maybe_await(db.find(Scheduler.COLLECTION_NAME, {}))
+        for job in jobs:
+            if job['id'] in last:
+                duplicates.append(min(last[job['id']], job['_id']))
+            last[job['id']] = max(last.get(job['id'], job['_id']), job['_id'])
+
+        if duplicates:
+            logging.warning("Removing {} duplicate scheduler jobs".format(len(duplicates)))
+            await maybe_await(db.remove(Scheduler.COLLECTION_NAME, {'_id': {'$in': duplicates}}))
+
+    def attach(self, event_loop):
+        """
+        Move jobs to a new scheduler running on the event loop. Used in forked server workers
+
+        :param event_loop:
+        """
+        jobs = self.scheduler.get_jobs()
+
+        self.scheduler = self.__create_scheduler(event_loop=event_loop)
+        for job in jobs:
+            self.scheduler.add_job(
+                job.func,
+                trigger=job.trigger,
+                id=job.id,
+                name=job.name,
+                args=job.args,
+                kwargs=job.kwargs,
+                misfire_grace_time=job.misfire_grace_time,
+                coalesce=job.coalesce,
+                max_instances=job.max_instances,
+                replace_existing=True
+            )
+        self.scheduler.start()
+
+        if self.leases is not None:
+            self.leases.attach(event_loop)
+
+    def restore(self, processor, batch_size=RESTORE_BATCH_SIZE):
         """
         Restore jobs from DB.
-            - Get all jobs
+            - Stream jobs by batches
             - Get callback, returned by processor function by payload
-            - Run scheduler job
+            - Run scheduler job. Jobs already running with the same trigger and args are skipped
 
         Example:
             self.sdk.scheduler.restore(say_hello)
 
         :param processor: function, which returns appropriate callback to call for the job (by payload)
+        :param batch_size: number of jobs loaded from DB at once
+        :return: stats {'jobs', 'added', 'skipped', 'seconds'} (task resolved with stats with AsyncDb)
         """
-        # Get jobs from db
-        jobs = self.sdk.db.find(Scheduler.COLLECTION_NAME, {})
+        started = time.monotonic()
+        stats = {'jobs': 0, 'added': 0, 'skipped': 0}
+
+        batches = self.sdk.db.find_batches(Scheduler.COLLECTION_NAME,
+                                           {'removed': {'$ne': True}, 'batch': {'$ne': True}},
+                                           batch_size)
+
+        return self.__restore(batches, lambda jobs: self.__add_jobs(processor, jobs, stats), stats, started)
+
+    def restore_batched(self, processor, chunk_size=BATCH_CHUNK_SIZE, spread=0, batch_size=RESTORE_BATCH_SIZE):
+        """
+        Restore jobs added with add_batched() for the processor.
+        In sharded mode only jobs of owned partitions are restored, and the processor is used for
+        jobs of partitions gained later, so call it on every replica
+
+        Example:
+            self.sdk.scheduler.restore_batched(say_hello_to_all, chunk_size=500, spread=60)
+
+        :param processor: function called with list of jobs args
+        :param chunk_size: max number of jobs passed to one processor call
+        :param spread: seconds to spread processor calls of one tick over
+        :param batch_size: number of jobs loaded from DB at once
+        :return: stats {'jobs', 'added', 'skipped', 'seconds'} (task resolved with stats with AsyncDb)
+        """
+        started = time.monotonic()
+        stats = {'jobs': 0, 'added': 0, 'skipped': 0}
+
+        name = self.__processor_name(processor)
+        self.batch_processors[name] = (processor, chunk_size, spread)
+
+        # Jobs saved without processor name are restored with any processor
+        query = {'removed': {'$ne': True}, 'batch': True, 'processor': {'$in': [name, None]}}
+        if self.leases is not None:
+            query['partition'] = {'$in': list(self.leases.owned)}
+
+        batches = self.sdk.db.find_batches(Scheduler.COLLECTION_NAME, query, batch_size)
 
-        # Run jobs
+        def add_jobs(jobs):
+            for job in jobs:
+                self.__add_to_batch(name, job['id'], job['args'], job['trigger_params'])
+                stats['jobs'] += 1
+                stats['added'] += 1
+
+        return self.__restore(batches, add_jobs, stats, started)
+
+    def __restore(self, batches, add_jobs, stats, started):
+        if self.sdk.db.is_async:
+            return asyncio.ensure_future(self.__restore_async(batches, add_jobs, stats, started))
+
+        for jobs in batches:
+            add_jobs(jobs)
+
+        return self.__restored(stats, started)
+
+    async def __restore_async(self, batches, add_jobs, stats, started):
+        async for jobs in batches:
+            add_jobs(jobs)
+
+        return self.__restored(stats, started)
+
+    @staticmethod
+    def __restored(stats, started):
+        stats['seconds'] = time.monotonic() - started
+        logging.info("Restored {jobs} scheduler jobs ({added} added, {skipped} unchanged) in {seconds:.3f}s"
+                     .format(**stats))
+        return stats
+
+    def __add_jobs(self, processor, jobs, stats=None):
         for job in jobs:
-            self.scheduler.add_job(
-                processor,
-                id=job['id'],
-                args=job['args'],
-                trigger='cron',
-                replace_existing=True,
-                **job['trigger_params']
-            )
+            self.__remove_from_batch(job['id'])
+            added = self.__add_job(processor, job['id'], job['args'], job['trigger_params'])
+
+            if stats is not None:
+                stats['jobs'] += 1
+                stats['added' if added else 'skipped'] += 1
+
+    def __add_job(self, callback, job_id, args, trigger_params):
+        """
+        Add APScheduler job unless the same one is already added
+        :return: True if job was added
+        """
+        trigger_key = self.__trigger_key(trigger_params)
+        signature = (callback, trigger_key, json.dumps(args, sort_keys=True, default=str))
+
+        if self.signatures.get(job_id) == signature and self.scheduler.get_job(job_id) is not None:
+            return False
+
+        trigger = self.triggers.get(trigger_key)
+        if trigger is None:
+            trigger = self.triggers[trigger_key] = CronTrigger(**trigger_params)
+
+        self.scheduler.add_job(
+            callback,
+            id=job_id,
+            args=args,
+            trigger=trigger,
+            replace_existing=True
+        )
+        self.signatures[job_id] = signature
+        return True
+
+    @staticmethod
+    def __trigger_key(trigger_params):
+        return json.dumps(trigger_params, sort_keys=True)
+
+    def restore_sharded(self, processor, lease_ttl=30, replica_id=None):
+        """
+        Run jobs on several replicas of the app. Instead of restore(), every replica claims
+        a share of job partitions with lease documents in DB and runs only jobs of its partitions.
+        When a replica stops or dies, its partitions are taken by the others.
+
+        Jobs added on a replica are run by the owner of their partition with processor as callback
+        (like restored ones). Owners pick up added and removed jobs on every lease renewal.
+        Batched jobs are split by partitions too: a tick of the batch on every replica
+        processes only jobs of its partitions, with processors passed to restore_batched().
+
+        Example:
+            self.sdk.scheduler.restore_sharded(say_hello)
+
+        :param processor: function to call for the jobs (like in restore)
+        :param lease_ttl: seconds after which partitions of a dead replica are taken by others
+        :param replica_id: unique replica name. Random by default
+        """
+        self.processor = processor
+
+        # Batched jobs are loaded again by owned partitions
+        for job_id in list(self.batch_members):
+            self.__remove_from_batch(job_id)
+
+        self.leases = PartitionLeases(unwrap(self.sdk.db), Scheduler.PARTITIONS, lease_ttl,
+                                      on_update=self.__rebalance, replica_id=replica_id)
+        self.leases.start()
+
+    async def stop(self):
+        """
+        Stop scheduler and release partitions in sharded mode
+        """
+        if self.leases is not None:
+            await self.leases.stop()
+        if self.scheduler.running:
+            self.scheduler.shutdown(wait=False)
+
+        REGISTRY.remove_collector(self.__collect_metrics)
+        JOBS.remove(application=self.sdk.application_name)
+
+    async def __rebalance(self, gained, lost):
+        synced_at = time.time()
+
+        for job in self.scheduler.get_jobs():
+            if job.id in self.signatures and self.__partition(job.id) in lost:
+                self.signatures.pop(job.id, None)
+                job.remove()
+
+        for job_id in list(self.batch_members):
+            if self.__partition(job_id) in lost:
+                self.__remove_from_batch(job_id)
+
+        # Jobs saved before sharded mode have no partition
+        if not self.synced_at:
+            legacy = await maybe_await(self.sdk.db.find(Scheduler.COLLECTION_NAME, {'partition': {'$exists': False}}))
+            for job in list(legacy):
+                await maybe_await(self.sdk.db.update(Scheduler.COLLECTION_NAME,
+                                                     {'_id': job['_id']},
+                                                     {'$set': {'partition': self.__partition(job['id'])}}))
+
+        if gained:
+            await maybe_await(self.sdk.db.remove(Scheduler.COLLECTION_NAME, {
+                'partition': {'$in': list(gained)},
+                'removed': True
+            }))
+            jobs = await maybe_await(self.sdk.db.find(Scheduler.COLLECTION_NAME, {
+                'partition': {'$in': list(gained)},
+                'removed': {'$ne': True},
+                'batch': {'$ne': True}
+            }))
+            self.__add_jobs(self.processor, jobs)
+
+            if self.batch_processors:
+                jobs = await maybe_await(self.sdk.db.find(Scheduler.COLLECTION_NAME, {
+                    'partition': {'$in': list(gained)},
+                    'removed': {'$ne': True},
+                    'batch': True
+                }))
+                self.__add_batched_jobs(jobs)
+
+        # Jobs changed by other replicas since the last sync. Lease ttl is a margin for clock skew
+        owned = list(self.leases.owned - gained)
+        if owned and self.synced_at:
+            jobs = await maybe_await(self.sdk.db.find(Scheduler.COLLECTION_NAME, {
+                'partition': {'$in': owned},
+                'updated_at': {'$gte': self.synced_at - self.leases.ttl}
+            }))
+            for job in list(jobs):
+                if job.get('removed'):
+                    self.signatures.pop(job['id'], None)
+                    if not self.__remove_from_batch(job['id']) and self.scheduler.get_job(job['id']) is not None:
+                        self.scheduler.remove_job(job['id'])
+                    await maybe_await(self.sdk.db.remove(Scheduler.COLLECTION_NAME, {'_id': job['_id']}))
+                elif job.get('batch'):
+                    self.__add_batched_jobs([job])
+                else:
+                    self.__add_jobs(self.processor, [job])
+
+        self.synced_at = synced_at
 
     def add(self, callback, payload, args, trigger_params=None):
         """
@@ -74,41 +420,179 @@ class Scheduler:
         :param trigger_params: {'minute': '*', 'hour': '*/2'}
         """
         job_id = self.__create_id(payload)
+        partition = self.__partition(job_id)
 
         try:
-            # Save job to db
-            self.sdk.db.insert(
+            # Save job to db. Job with the same id is replaced
+            self.__db(
+                'update',
                 Scheduler.COLLECTION_NAME,
-                {
+                {'id': job_id},
+                {'$set': {
                     'id': job_id,
                     'trigger_params': trigger_params,
-                    'args': args
-                }
+                    'args': args,
+                    'batch': False,
+                    'partition': partition,
+                    'updated_at': time.time(),
+                    'removed': False
+                }},
+                True
             )
 
+            # In sharded mode the job is run by the owner of its partition
+            if self.leases is not None and not self.leases.owns(partition):
+                return
+
             # Run job
-            self.scheduler.add_job(
-                callback,
-                id=job_id,
-                args=args,
-                trigger='cron',
-                replace_existing=True,
-                **trigger_params
+            self.__remove_from_batch(job_id)
+            self.__add_job(callback, job_id, args, trigger_params)
+        except Exception as e:
+            if self.sdk.hawk:
+                self.sdk.hawk.catch()
+            self.sdk.logging.debug("Error: {}".format(e))
+
+    def add_batched(self, processor, payload, args, trigger_params, chunk_size=BATCH_CHUNK_SIZE, spread=0):
+        """
+        Add job which is run together with other jobs of the same processor and trigger.
+        Instead of a scheduler job per chat, there is one tick calling processor with chunks of jobs args.
+
+        Example:
+            async def say_hello_to_all(jobs_args):
+                for payload, data in jobs_args:
+                    await self.sdk.send_text_to_chat(payload['chat'], data['message'])
+
+            self.sdk.scheduler.add_batched(
+                say_hello_to_all,                                           # Called with list of jobs args
+                payload,                                                    # Job identify by chat and bot
+                args=[payload, data],
+                trigger_params={'minute': '0', 'hour': '*/6', 'jitter': 30}, # 'jitter' delays the tick randomly
+                chunk_size=500,
+                spread=60                                                   # Calls are spread over a minute
             )
+
+        Batched jobs are restored with restore_batched(). In sharded mode the job is run
+        by the owner of its partition, which must restore_batched() the processor.
+
+        :param processor: function called with list of jobs args
+        :param payload: chat and bot
+        :param args: job arguments
+        :param trigger_params: cron params
+        :param chunk_size: max number of jobs passed to one processor call
+        :param spread: seconds to spread processor calls of one tick over
+        """
+        job_id = self.__create_id(payload)
+        partition = self.__partition(job_id)
+        name = self.__processor_name(processor)
+
+        try:
+            self.__db(
+                'update',
+                Scheduler.COLLECTION_NAME,
+                {'id': job_id},
+                {'$set': {
+                    'id': job_id,
+                    'trigger_params': trigger_params,
+                    'args': args,
+                    'batch': True,
+                    'processor': name,
+                    'partition': partition,
+                    'updated_at': time.time(),
+                    'removed': False
+                }},
+                True
+            )
+
+            self.batch_processors[name] = (processor, chunk_size, spread)
+
+            # In sharded mode the job is run by the owner of its partition
+            if self.leases is not None and not self.leases.owns(partition):
+                return
+
+            self.__add_to_batch(name, job_id, args, trigger_params)
         except Exception as e:
             if self.sdk.hawk:
                 self.sdk.hawk.catch()
             self.sdk.logging.debug("Error: {}".format(e))
 
+    def __add_batched_jobs(self, jobs):
+        for job in jobs:
+            name = job.get('processor')
+            # Jobs saved without processor name belong to the only restored processor
+            if name is None and len(self.batch_processors) == 1:
+                name = next(iter(self.batch_processors))
+
+            if name in self.batch_processors:
+                self.__add_to_batch(name, job['id'], job['args'], job['trigger_params'])
+
+    def __add_to_batch(self, name, job_id, args, trigger_params):
+        processor, chunk_size, spread = self.batch_processors[name]
+        self.__remove_from_batch(job_id)
+
+        # Job could be added with add() before
+        if self.signatures.pop(job_id, None) is not None and self.scheduler.get_job(job_id) is not None:
+            self.scheduler.remove_job(job_id)
+
+        trigger_key = self.__trigger_key(trigger_params)
+        batch_id = 'batch:{}:{}'.format(name, trigger_key)
+
+        batch = self.batches.get(batch_id)
+        if batch is None:
+            batch = self.batches[batch_id] = BatchJob(processor, trigger_params, chunk_size, spread)
+
+            trigger = self.triggers.get(trigger_key)
+            if trigger is None:
+                trigger = self.triggers[trigger_key] = CronTrigger(**trigger_params)
+
+            self.scheduler.add_job(self.__run_batch, id=batch_id, args=[batch], trigger=trigger, replace_existing=True)
+
+        batch.chunk_size, batch.spread = chunk_size, spread
+        batch.members[job_id] = args
+        self.batch_members[job_id] = batch_id
+
+    def __remove_from_batch(self, job_id):
+        """
+        :return: True if job was batched
+        """
+        batch_id = self.batch_members.pop(job_id, None)
+        if batch_id is None:
+            return False
+
+        batch = self.batches[batch_id]
+        del batch.members[job_id]
+
+        if not batch.members:
+            del self.batches[batch_id]
+            self.scheduler.remove_job(batch_id)
+
+        return True
+
+    async def __run_batch(self, batch):
+        jobs_args = list(batch.members.values())
+        chunks = [jobs_args[i:i + batch.chunk_size] for i in range(0, len(jobs_args), batch.chunk_size)]
+
+        for index, chunk in enumerate(chunks):
+            if index and batch.spread:
+                await asyncio.sleep(batch.spread / len(chunks))
+
+            try:
+                # Messages of batched jobs don't delay replies to users
+                with use_lane(BULK):
+                    await maybe_await(batch.processor(chunk))
+            except Exception as e:
+                if self.sdk.hawk:
+                    self.sdk.hawk.catch()
+                logging.error("Batch job error: {}".format(e))
+
     def find(self, payload):
         """
         Return saved scheduler data from DB by chat_id
         :param payload: chat and bot
-        :return: data from db
+        :return: data from db (awaitable with AsyncDb)
         """
         job_id = self.__create_id(payload)
 
-        result = self.sdk.db.find_one(Scheduler.COLLECTION_NAME, {'id': job_id})
+        result = self.__db('find_one', Scheduler.COLLECTION_NAME, {'id': job_id})
 
         return result
 
@@ -125,15 +609,52 @@ class Scheduler:
         :return: remove result
         """
         job_id = self.__create_id(payload)
+        self.signatures.pop(job_id, None)
+
+        batched = False
 
         try:
-            self.scheduler.remove_job(job_id)
+            batched = self.__remove_from_batch(job_id)
+            if not batched and (self.scheduler.get_job(job_id) is not None or self.leases is None):
+                self.scheduler.remove_job(job_id)
         except Exception as e:
             if self.sdk.hawk:
                 self.sdk.hawk.catch()
             self.sdk.logging.debug("Error during remove job: {}".format(e))
 
-        return self.sdk.db.remove(Scheduler.COLLECTION_NAME, {'id': job_id})
+        # In sharded mode the owner of the partition removes the job and its document
+        if not batched and self.leases is not None and not self.leases.owns(self.__partition(job_id)):
+            return self.__db('update', Scheduler.COLLECTION_NAME, {'id': job_id},
+                             {'$set': {'removed': True, 'updated_at': time.time()}})
+
+        return self.__db('remove', Scheduler.COLLECTION_NAME, {'id': job_id})
+
+    def __db(self, method, *args):
+        """
+        Call Db method. With AsyncDb the query is scheduled on the event loop and its future is returned
+        """
+        result = getattr(self.sdk.db, method)(*args)
+
+        if inspect.isawaitable(result):
+            result = asyncio.ensure_future(result)
+            result.add_done_callback(self.__check_db_result)
+
+        return result
+
+    @staticmethod
+    def __check_db_result(future):
+        if not future.cancelled() and future.exception() is not None:
+            logging.error("Scheduler db error: {}".format(future.exception()))
+
+    @staticmethod
+    def __processor_name(processor):
+        # The same in every process and after restart, unlike id(processor)
+        name = getattr(processor, '__qualname__', type(processor).__qualname__)
+        return '{}.{}'.format(getattr(processor, '__module__', None), name)
+
+    @staticmethod
+    def __partition(job_id):
+        return zlib.crc32(str(job_id).encode()) % Scheduler.PARTITIONS
 
     def __create_id(self, payload):
         job_id = payload.get('chat')
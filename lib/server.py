@@ -1,56 +1,246 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import os
+import signal
+import socket
+import time
+from collections.abc import Mapping
+from urllib.parse import parse_qsl
+
 import aiohttp.web
+from multidict import MultiDict, MultiDictProxy
 
+from .cache import LRUCache
+from .metrics import REGISTRY
 
-def http_response(function):
-    async def wrapper(self, request):
-        text = await request.text()
-        headers = request.headers
-        params = request.match_info
-        query = request.query
-        
-        try:
-            post = await request.post()
-        except Exception as e:
-            post = {}
+HTTP_CACHE = REGISTRY.counter('codexbot_http_cache_total', 'HTTP response cache lookups', ['result'])
+
+
+class Request(Mapping):
+
+    KEYS = ('text', 'post', 'json', 'params', 'headers', 'query')
+
+    def __init__(self, request, body=b'', post=None):
+        """
+        Request passed to http_response handlers.
+        Body is read once. text, post and json are parsed on first access and cached.
+        Works as a dict too: request['json'], request.get('query')
+
+        :param request: aiohttp request
+        :param body: request body
+        :param post: already parsed form (multipart requests)
+        """
+        self.request = request
+        self.body = body
+        self.params = request.match_info
+        self.headers = request.headers
+        self.query = request.query
+
+        self.__text = None
+        self.__post = post
+        self.__json = None
+
+    @classmethod
+    async def read(cls, request):
+        if not request.body_exists:
+            return cls(request)
+
+        # Multipart form can't be parsed from the raw body later
+        if request.content_type.startswith('multipart/'):
+            try:
+                post = await request.post()
+            except Exception as e:
+                post = {}
+            return cls(request, post=post)
+
+        return cls(request, await request.read())
+
+    @property
+    def text(self):
+        if self.__text is None:
+            try:
+                self.__text = self.body.decode(self.request.charset or 'utf-8')
+            except Exception as e:
+                self.__text = ''
+        return self.__text
+
+    @property
+    def post(self):
+        if self.__post is None:
+            form = []
+            if self.request.content_type == 'application/x-www-form-urlencoded':
+                form = parse_qsl(self.text, keep_blank_values=True)
+            self.__post = MultiDictProxy(MultiDict(form))
+        return self.__post
+
+    @property
+    def json(self):
+        if self.__json is None:
+            try:
+                self.__json = json.loads(self.text)
+            except Exception as e:
+                self.__json = {}
+        return self.__json
+
+    def __getitem__(self, key):
+        if key not in Request.KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(Request.KEYS)
+
+    def __len__(self):
+        return len(Request.KEYS)
 
-        try:
-            json = await request.json()
-        except Exception as e:
-            json = {}
 
+class Body:
+
+    def __init__(self, text, content_type=None, gzip_min_size=None):
+        """
+        Response body with ETag, optionally precompressed
+        :param gzip_min_size: also keep gzipped body if it is so large. None -- don't compress
+        """
+        self.body = text.encode('utf-8')
+        self.content_type = content_type or 'text/plain'
+        self.etag = 'W/"{}"'.format(hashlib.sha1(self.body).hexdigest())
+        self.gzipped = None
+        if gzip_min_size is not None and len(self.body) >= gzip_min_size:
+            self.gzipped = gzip.compress(self.body)
+
+    def response(self, request, max_age=None):
+        """
+        :return: 304 Not Modified if request has the ETag in If-None-Match, otherwise response with the body
+        """
+        headers = {'Access-Control-Allow-Origin': '*', 'ETag': self.etag}
+        if max_age:
+            headers['Cache-Control'] = 'public, max-age={}'.format(int(max_age))
+        if self.gzipped is not None:
+            headers['Vary'] = 'Accept-Encoding'
+
+        if self.matches(request.headers.get('If-None-Match')):
+            return aiohttp.web.Response(status=304, headers=headers)
+
+        body = self.body
+        if self.gzipped is not None and 'gzip' in request.headers.get('Accept-Encoding', ''):
+            headers['Content-Encoding'] = 'gzip'
+            body = self.gzipped
+
+        return aiohttp.web.Response(body=body, content_type=self.content_type, charset='utf-8', headers=headers)
+
+    def matches(self, if_none_match):
+        if not if_none_match:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        # Weak comparison: W/"x" matches "x"
+        return '*' in tags or self.etag[2:] in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+
+
+def http_response(function=None, cache_ttl=None, cache_size=1000, gzip_min_size=1024):
+    """
+    Decorator for HTTP callbacks. Callback gets Request and returns {'text': ..., 'status': ..., 'content-type': ...}
+
+        > @CodexBot.http_response
+        > async def index(self, request):
+
+    GET responses have an ETag, request with it in If-None-Match gets 304 Not Modified.
+    With cache_ttl GET responses are cached by path and query, so repeat requests don't call the callback,
+    and concurrent requests for the same uncached response call it once:
+
+        > @CodexBot.http_response(cache_ttl=30)
+        > async def widget(self, request):
+
+    :param cache_ttl: seconds to cache responses. None -- don't cache
+    :param cache_size: max number of cached responses
+    :param gzip_min_size: cached bodies of this size and larger are also kept gzipped for clients accepting gzip
+    """
+    if function is None:
+        return lambda function: http_response(function, cache_ttl, cache_size, gzip_min_size)
+
+    cache = LRUCache(cache_size, cache_ttl) if cache_ttl else None
+    # key => task computing the response
+    computing = {}
+
+    async def call(self, request):
         try:
-            result = await function(self, {
-                'text': text,
-                'post': post,
-                'json': json,
-                'params': params,
-                'headers': headers,
-                'query': query
-            })
+            return await function(self, await Request.read(request))
         except Exception as e:
-            self.sdk.hawk.catch()
+            if self.sdk.hawk:
+                self.sdk.hawk.catch()
+            logging.error("HTTP handler error: {}".format(e))
+            return None
+
+    async def cached_call(self, request, key):
+        result = await call(self, request)
+        if result is None or result.get('status', 200) == 404:
+            return result
+
+        body = Body(result.get('text', ''), result.get('content-type'), gzip_min_size)
+        cache.set(key, body)
+        return body
+
+    def respond(request, result):
+        if result is None:
             return aiohttp.web.HTTPInternalServerError()
 
         response_text = result.get('text', '')
         response_status = result.get('status', 200)
         response_content_type = result.get('content-type')
 
-        if response_status != 404:
-            return aiohttp.web.Response(text=response_text, content_type=response_content_type, headers={
-                'Access-Control-Allow-Origin': '*'
-            })
-        else:
+        if response_status == 404:
             return aiohttp.web.HTTPNotFound(text=response_text, content_type=response_content_type)
 
+        if request.method in ('GET', 'HEAD'):
+            return Body(response_text, response_content_type).response(request)
+
+        return aiohttp.web.Response(text=response_text, content_type=response_content_type, headers={
+            'Access-Control-Allow-Origin': '*'
+        })
+
+    async def wrapper(self, request):
+        if cache is None or request.method not in ('GET', 'HEAD'):
+            return respond(request, await call(self, request))
+
+        key = (request.path, tuple(sorted(request.query.items())))
+
+        body = cache.get(key)
+        if body is LRUCache.MISSING:
+            HTTP_CACHE.inc(result='miss')
+            task = computing.get(key)
+            if task is None:
+                # Not cancelled with the request, because other requests may wait for it
+                task = computing[key] = asyncio.ensure_future(cached_call(self, request, key))
+                task.add_done_callback(lambda task: computing.pop(key, None))
+            body = await asyncio.shield(task)
+        else:
+            HTTP_CACHE.inc(result='hit')
+
+        if not isinstance(body, Body):
+            return respond(request, body)
+        return body.response(request, cache_ttl)
+
     return wrapper
 
 
 class Server:
 
+    # Don't restart workers more often than once per this number of seconds
+    RESTART_DELAY = 1
+
     def __init__(self, event_loop, host='127.0.0.1', port=1339):
         self.event_loop = event_loop
         self.host, self.port = host, port
-        self.web_server = aiohttp.web.Application(loop=self.event_loop)
+        self.web_server = self.__application()
+
+        # Routes are kept to build applications in worker processes
+        self.routes = []
+        self.statics = []
+
+        self.workers = {}
+        self.stopping = False
 
     def set_routes(self, routes):
         """
@@ -59,13 +249,140 @@ class Server:
         :return:
         """
         for route in routes:
+            self.routes.append(route)
             self.web_server.router.add_route(*route)
 
-    def add_static(self, route, path):
-        self.web_server.router.add_static(route, path)
+    def add_metrics_route(self, registry, path='/metrics'):
+        """
+        Serve metrics in Prometheus text format
+        :param registry: metrics Registry
+        :param path: route path
+        """
+        async def metrics(request):
+            return aiohttp.web.Response(text=registry.render(), content_type='text/plain',
+                                        headers={'X-Content-Type-Options': 'nosniff'})
+
+        self.set_routes([('GET', path, metrics)])
+
+    def add_static(self, route, path, max_age=None, **options):
+        """
+        Serve files. Responses have Last-Modified, and requests with If-Modified-Since get 304 Not Modified
+        :param max_age: Cache-Control max-age in seconds
+        :param options: add_static options, e.g. append_version=True adds ?v=hash to URLs built by the router
+        """
+        self.statics.append((route, path, max_age, options))
+        self.web_server.router.add_static(route, path, **options)
+
+    def start(self, workers=1, reuse_port=False, on_worker_start=None):
+        """
+        Run server.
+
+        :param workers: number of server processes. With workers > 1 this process only supervises
+                        the workers: restarts exited ones and stops them on SIGINT/SIGTERM
+        :param reuse_port: every worker binds its own socket with SO_REUSEPORT and the kernel balances connections.
+                           Otherwise workers accept connections from one socket bound before fork
+        :param on_worker_start: function(index, event_loop) called in the worker process before the server starts
+        """
+        if workers <= 1:
+            aiohttp.web.run_app(self.web_server, host=self.host, port=self.port, loop=self.event_loop)
+            return
+
+        sock = None if reuse_port else self.__bind()
 
-    def start(self):
-        aiohttp.web.run_app(self.web_server, host=self.host, port=self.port)
+        signal.signal(signal.SIGTERM, self.__stop_workers)
+        signal.signal(signal.SIGINT, self.__stop_workers)
+
+        for index in range(workers):
+            self.__spawn(index, sock, on_worker_start)
+
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+
+            index, started_at = self.workers.pop(pid, (None, None))
+            if index is None or self.stopping:
+                continue
+
+            logging.warning("Server worker {} exited with status {}. Restarting".format(index, status))
+
+            # Don't loop when a worker fails on start
+            time.sleep(max(0, started_at + Server.RESTART_DELAY - time.monotonic()))
+
+            if not self.stopping:
+                self.__spawn(index, sock, on_worker_start)
 
     def redirect(self, redirect_uri):
-        return aiohttp.web.HTTPFound(redirect_uri)
\ No newline at end of file
+        return aiohttp.web.HTTPFound(redirect_uri)
+
+    def __spawn(self, index, sock, on_worker_start):
+        pid = os.fork()
+
+        if pid:
+            self.workers[pid] = (index, time.monotonic())
+            return
+
+        status = 0
+        try:
+            self.__run_worker(index, sock, on_worker_start)
+        except Exception as e:
+            logging.error("Server worker {} error: {}".format(index, e))
+            status = 1
+        finally:
+            os._exit(status)
+
+    def __run_worker(self, index, sock, on_worker_start):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+        self.event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.event_loop)
+
+        if on_worker_start is not None:
+            on_worker_start(index, self.event_loop)
+
+        self.web_server = self.__application()
+        for route in self.routes:
+            self.web_server.router.add_route(*route)
+        for route, path, _, options in self.statics:
+            self.web_server.router.add_static(route, path, **options)
+
+        if sock is None:
+            sock = self.__bind(reuse_port=True)
+
+        # run_app stops gracefully on SIGINT and SIGTERM. It runs on the loop of the broker and scheduler
+        aiohttp.web.run_app(self.web_server, sock=sock, loop=self.event_loop)
+
+    def __application(self):
+        # Bound to the loop passed to run_app
+        application = aiohttp.web.Application()
+        application.on_response_prepare.append(self.__cache_static)
+        return application
+
+    async def __cache_static(self, request, response):
+        if response.status not in (200, 304):
+            return
+        for route, _, max_age, _ in self.statics:
+            if max_age is not None and request.path.startswith(route.rstrip('/') + '/'):
+                response.headers.setdefault('Cache-Control', 'public, max-age={}'.format(int(max_age)))
+                return
+
+    def __bind(self, reuse_port=False):
+        family = socket.AF_INET6 if ':' in self.host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(128)
+        sock.setblocking(False)
+        return sock
+
+    def __stop_workers(self, signum, frame):
+        self.stopping = True
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
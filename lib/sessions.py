@@ -0,0 +1,261 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+from .cache import LRUCache
+from .metrics import REGISTRY
+
+SESSION_LOADS = REGISTRY.counter('codexbot_session_loads_total', 'Dialog sessions loaded from Db')
+SESSION_WRITES = REGISTRY.counter('codexbot_session_writes_total', 'Dialog sessions written to Db')
+
+
+class Session:
+
+    def __init__(self, key, step=None, data=None):
+        """
+        Dialog state of a user in a chat
+        :param key: bot:chat:user
+        :param step: name of the step handler waiting for the user answer. None -- dialog is over
+        :param data: dict saved between steps
+        """
+        self.key = key
+        self.step = step
+        self.data = data if data is not None else {}
+
+    def to_document(self):
+        return {'_id': self.key, 'step': self.step, 'data': self.data, 'updated_at': datetime.now(timezone.utc)}
+
+    @staticmethod
+    def from_document(document):
+        return Session(document['_id'], document.get('step'), document.get('data'))
+
+
+class SessionStore:
+
+    COLLECTION_NAME = 'sessions'
+
+    def __init__(self, db=None, size=10000, ttl=3600, persistent=True, flush_interval=1.0, batch_size=500,
+                 miss_ttl=5):
+        """
+        Dialog sessions keyed by (bot, chat, user). Hot sessions are kept in memory, so a dialog step
+        doesn't read Db. Changed sessions are written to Db in batches every flush_interval seconds,
+        and expire there by a TTL index.
+
+        Example:
+            self.sdk.set_step_handler('city', self.city)
+
+            async def weather(self, payload):
+                await self.sdk.wait_user_answer(payload['user'], payload['chat'], prompt='Which city?',
+                                                bot=payload['bot'], step='city', data={'units': 'C'})
+
+            async def city(self, payload, session):
+                # session.data == {'units': 'C'}. Call wait_user_answer with a step to continue the dialog
+                ...
+
+        :param db: Db for persistent sessions
+        :param size: max number of sessions in memory
+        :param ttl: seconds since the last change before session expires
+        :param persistent: save sessions to Db
+        :param flush_interval: seconds between Db writes
+        :param batch_size: write at once when so many sessions are changed
+        :param miss_ttl: seconds to remember that Db has no session of the user, so messages outside dialogs
+                         don't read Db. A dialog started on another replica is seen there after this time
+        """
+        self.db = db
+        self.cache = LRUCache(size, ttl)
+        # Keys not found in Db
+        self.missing = LRUCache(size, miss_ttl)
+        self.ttl = ttl
+        self.persistent = persistent
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+
+        # step name => async function(payload, session)
+        self.steps = {}
+
+        # key => changed Session, or None for removed one
+        self.dirty = {}
+        self.flush_task = None
+        self.indexed = False
+
+    @staticmethod
+    def key(bot, chat, user):
+        # None and '' are the same missing bot
+        return '{}:{}:{}'.format(bot or '', chat, user)
+
+    def set_step_handler(self, step, handler):
+        """
+        :param handler: async function(payload, session) called with the user answer
+        """
+        self.steps[step] = handler
+
+    async def get(self, bot, chat, user):
+        """
+        :return: Session or None
+        """
+        key = SessionStore.key(bot, chat, user)
+
+        session = self.cache.get(key)
+        if session is not LRUCache.MISSING:
+            return session
+
+        # Evicted from memory, but not written yet
+        if key in self.dirty:
+            session = self.dirty[key]
+        elif self.persistent and self.db is not None and self.missing.get(key) is LRUCache.MISSING:
+            session = await self.__load(key)
+        else:
+            session = None
+
+        if session is not None:
+            self.cache.set(key, session)
+        return session
+
+    async def start(self, bot, chat, user, step, data=None):
+        """
+        Wait for the user answer in the step handler. Data is merged into the current session data
+        :return: Session
+        """
+        session = await self.get(bot, chat, user)
+        if session is None:
+            session = Session(SessionStore.key(bot, chat, user))
+
+        session.step = step
+        session.data.update(data or {})
+        self.save(session)
+        return session
+
+    def save(self, session):
+        self.cache.set(session.key, session)
+        self.missing.delete(session.key)
+        self.__changed(session.key, session)
+
+    def finish(self, session):
+        """
+        Forget the session
+        """
+        session.step = None
+        self.cache.delete(session.key)
+        self.__changed(session.key, None)
+
+    async def route(self, payload, call):
+        """
+        Pass the user answer to the step handler of the session
+        :param call: async function(handler, payload, session) which runs the handler
+        :return: False if there is no session waiting for the answer
+        """
+        if not self.steps:
+            return False
+
+        bot, chat, user = payload.get('bot'), payload.get('chat'), payload.get('user')
+        session = await self.get(bot, chat, user)
+        if session is None and bot:
+            # Dialog started by wait_user_answer without bot, while the answer has one
+            session = await self.get(None, chat, user)
+        if session is None or session.step not in self.steps:
+            return False
+
+        step = session.step
+        session.step = None
+        try:
+            await call(self.steps[step], payload, session)
+        except BaseException:
+            # The answer can be sent again
+            session.step = step
+            self.save(session)
+            raise
+
+        # Handler continues the dialog by wait_user_answer with a step
+        if session.step is None:
+            self.finish(session)
+        else:
+            self.save(session)
+        return True
+
+    async def flush(self):
+        """
+        Write changed sessions to Db
+        """
+        if not self.dirty or self.db is None:
+            return
+
+        # pymongo is needed only for persistent sessions
+        from pymongo import ReplaceOne, DeleteOne
+        from .db import maybe_await, unwrap
+
+        changed, self.dirty = self.dirty, {}
+        operations = [ReplaceOne({'_id': key}, session.to_document(), upsert=True) if session is not None
+                      else DeleteOne({'_id': key}) for key, session in changed.items()]
+
+        # Sessions are cached here, so CachedDb and WriteBehindDb are bypassed
+        db = unwrap(self.db)
+        try:
+            if not self.indexed and self.ttl is not None:
+                self.indexed = True
+                await maybe_await(db.create_index(SessionStore.COLLECTION_NAME, 'updated_at',
+                                                  expireAfterSeconds=self.ttl))
+            await maybe_await(db.bulk_write(SessionStore.COLLECTION_NAME, operations, ordered=False))
+            SESSION_WRITES.inc(len(operations))
+        except Exception as e:
+            logging.error("Session store error: {}".format(e))
+
+            # Written by the next flush. Sessions changed meanwhile are newer
+            for key, session in changed.items():
+                self.dirty.setdefault(key, session)
+
+    async def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush()
+
+    def stats(self):
+        stats = self.cache.stats()
+        stats['dirty'] = len(self.dirty)
+        return stats
+
+    def __changed(self, key, session):
+        if not self.persistent or self.db is None:
+            return
+
+        self.dirty[key] = session
+
+        if self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self.__flush_periodically())
+
+        if len(self.dirty) >= self.batch_size:
+            asyncio.ensure_future(self.flush())
+
+    async def __load(self, key):
+        from .db import maybe_await, unwrap
+
+        try:
+            document = await maybe_await(unwrap(self.db).find_one(SessionStore.COLLECTION_NAME, {'_id': key}))
+        except Exception as e:
+            logging.error("Session store error: {}".format(e))
+            return None
+
+        SESSION_LOADS.inc()
+        if document is None:
+            self.missing.set(key, True)
+            return None
+
+        # TTL index is cleaned up once a minute
+        updated_at = document.get('updated_at')
+        if updated_at is not None and updated_at.tzinfo is None:
+            # pymongo returns naive UTC datetimes unless the client is tz_aware
+            updated_at = updated_at.replace(tzinfo=timezone.utc)
+        if self.ttl is not None and updated_at is not None and \
+                updated_at < datetime.now(timezone.utc) - timedelta(seconds=self.ttl):
+            self.missing.set(key, True)
+            return None
+
+        return Session.from_document(document)
+
+    async def __flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error("Session store flush error: {}".format(e))
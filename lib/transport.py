@@ -0,0 +1,169 @@
+import asyncio
+import itertools
+import logging
+from collections import deque
+
+
+class Transport:
+    """
+    Message queue used by Broker. See AmqpTransport for RabbitMQ and LoopbackTransport for in-memory queues
+    """
+
+    async def connect(self):
+        pass
+
+    async def publish(self, data, routing_key, priority=None):
+        """
+        :param data: message body (bytes)
+        :param routing_key: queue name
+        :param priority: message priority for queues with max priority
+        """
+        raise NotImplementedError
+
+    async def consume(self, queue_name, callback, prefetch_count=1, max_priority=None):
+        """
+        :param callback: coroutine function(message). Message has body, message_id, redelivered and ack().
+                         ack() may return an awaitable, like in aio_pika, see Broker.ack
+        :param prefetch_count: max number of not acknowledged messages
+        :param max_priority: declare priority queue (x-max-priority). Messages with higher priority are delivered first
+        """
+        raise NotImplementedError
+
+    async def cancel(self, queue_name):
+        pass
+
+    async def close(self):
+        pass
+
+
+class LoopbackMessage:
+
+    ids = itertools.count(1)
+
+    def __init__(self, body, queue, message_id=None, redelivered=False, priority=None):
+        self.body = body
+        self.queue = queue
+        self.priority = priority
+        self.message_id = message_id or str(next(LoopbackMessage.ids))
+        self.redelivered = redelivered
+        self.processed = False
+
+    def ack(self):
+        if not self.processed:
+            self.processed = True
+            self.queue.acked(self)
+
+    def reject(self, requeue=False):
+        if not self.processed:
+            self.processed = True
+            self.queue.acked(self)
+            if requeue:
+                self.queue.put(LoopbackMessage(self.body, self.queue, self.message_id, redelivered=True,
+                                               priority=self.priority))
+
+
+class LoopbackQueue:
+
+    def __init__(self):
+        self.messages = deque()
+        self.callback = None
+        self.prefetch_count = 1
+        self.max_priority = None
+        self.unacked = 0
+        self.published = 0
+        self.tasks = set()
+        # Set on ack and finished callback, see changed()
+        self.event = None
+
+    def put(self, message):
+        self.messages.append(message)
+        self.published += 1
+        self.deliver()
+
+    def acked(self, message):
+        self.unacked -= 1
+        self.deliver()
+        self.__notify()
+
+    async def changed(self):
+        """
+        Wait for the next ack or finished callback
+        """
+        if self.event is None:
+            # Created on the event loop which consumes the queue
+            self.event = asyncio.Event()
+        self.event.clear()
+        await self.event.wait()
+
+    def deliver(self):
+        # Like RabbitMQ: deliver while there are less than prefetch_count unacked messages
+        while self.callback is not None and self.messages and self.unacked < self.prefetch_count:
+            self.unacked += 1
+            task = asyncio.ensure_future(self.callback(self.__next()))
+            self.tasks.add(task)
+            task.add_done_callback(self.__done)
+
+    def __next(self):
+        if not self.max_priority:
+            return self.messages.popleft()
+
+        # Priority queue: the first message with the highest priority
+        message = max(self.messages, key=lambda message: min(message.priority or 0, self.max_priority))
+        self.messages.remove(message)
+        return message
+
+    def __done(self, task):
+        self.tasks.discard(task)
+        self.__notify()
+        if not task.cancelled() and task.exception() is not None:
+            logging.error("Loopback consumer error: {}".format(task.exception()))
+
+    def __notify(self):
+        if self.event is not None:
+            self.event.set()
+
+
+class LoopbackTransport(Transport):
+
+    def __init__(self):
+        """
+        In-memory queues in the current process. For tests and benchmarks without RabbitMQ
+
+        Example:
+            transport = LoopbackTransport()
+            sdk = CodexBot(..., transport=transport)
+            await transport.publish(body, sdk.application_name)    # Message from the core
+            transport.queue('core').messages                       # Messages sent to the core
+        """
+        self.queues = {}
+
+    def queue(self, queue_name):
+        queue = self.queues.get(queue_name)
+        if queue is None:
+            queue = self.queues[queue_name] = LoopbackQueue()
+        return queue
+
+    async def publish(self, data, routing_key, priority=None):
+        if isinstance(data, str):
+            data = data.encode()
+        queue = self.queue(routing_key)
+        queue.put(LoopbackMessage(data, queue, priority=priority))
+
+    async def consume(self, queue_name, callback, prefetch_count=1, max_priority=None):
+        queue = self.queue(queue_name)
+        queue.callback = callback
+        queue.prefetch_count = prefetch_count
+        queue.max_priority = max_priority
+        queue.deliver()
+
+    async def cancel(self, queue_name):
+        self.queue(queue_name).callback = None
+
+    async def join(self, queue_name):
+        """
+        Wait until all messages of the consumed queue are acknowledged
+        """
+        queue = self.queue(queue_name)
+        while queue.messages or queue.tasks or queue.unacked:
+            # Callbacks can finish before messages are acknowledged (e.g. by the dispatcher)
+            await queue.changed()
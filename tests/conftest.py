@@ -0,0 +1,52 @@
+import asyncio
+import importlib.util
+import os
+import sys
+
+import pytest
+
+# The SDK is used as a package (a git submodule named sdk), so the checkout is imported under this name
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if 'sdk' not in sys.modules:
+    spec = importlib.util.spec_from_loader('sdk', None, is_package=True)
+    package = importlib.util.module_from_spec(spec)
+    package.__path__ = [ROOT]
+    sys.modules['sdk'] = package
+
+
+@pytest.fixture
+def loop():
+    """
+    Fresh event loop set as the current one, because the SDK uses asyncio.get_event_loop()
+    """
+    event_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(event_loop)
+    yield event_loop
+    event_loop.close()
+    asyncio.set_event_loop(None)
+
+
+@pytest.fixture
+def loopback_bot(loop):
+    """
+    Coroutine function creating CodexBot with LoopbackTransport and in-memory Db. Bots are shut down after the test:
+        sdk = await loopback_bot([('weather', 'Weather forecast', weather)], concurrency=4)
+        await sdk.broker.transport.publish(body, sdk.queue_name)
+    """
+    pytest.importorskip('pymongo')
+    from sdk.codexbot_sdk import CodexBot
+    from sdk.lib.transport import LoopbackTransport
+
+    bots = []
+
+    async def create(commands=None, application_name='loopback_test', transport=None, **options):
+        sdk = await CodexBot.create(application_name, 'localhost', 1337, 'amqp://', {'backend': 'memory'}, 'token',
+                                    transport=transport or LoopbackTransport(), commands=commands, **options)
+        bots.append(sdk)
+        return sdk
+
+    yield create
+
+    for sdk in bots:
+        loop.run_until_complete(sdk.shutdown())
@@ -0,0 +1,58 @@
+from types import SimpleNamespace
+
+from sdk.lib.broadcast import Broadcaster
+from sdk.lib.lanes import BULK
+
+
+class Chats:
+
+    def __init__(self, chats):
+        """
+        Async iterator of chat hashes, like a Db cursor
+        """
+        self.chats = iter(chats)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.chats)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+def fake_sdk(sent):
+    async def send_to_chat(payload, lane=None):
+        if payload['chat_hash'] == 'blocked':
+            raise ConnectionError('Bot is blocked')
+        sent.append((payload['chat_hash'], payload['bot'], lane))
+
+    return SimpleNamespace(send_to_chat=send_to_chat)
+
+
+def test_broadcast_keeps_bot_rate(loop):
+    sent = []
+    broadcaster = Broadcaster(fake_sdk(sent), rate=50, chat_rate=10)
+
+    def message(chat_hash):
+        return None if chat_hash == 'chat_0' else {'text': 'Good morning!'}
+
+    chats = ['chat_{}'.format(index) for index in range(60)] + ['blocked']
+    stats = loop.run_until_complete(broadcaster.broadcast(chats, message, bot='bot'))
+
+    # 50 messages are sent at once, the other 10 at 50 per second
+    assert stats['seconds'] >= 0.15
+    assert (stats['sent'], stats['skipped'], stats['failed']) == (59, 1, 1)
+    assert stats['errors'][0][0] == 'blocked'
+    assert all(bot == 'bot' and lane == BULK for _, bot, lane in sent)
+
+
+def test_broadcast_keeps_chat_rate(loop):
+    sent = []
+    broadcaster = Broadcaster(fake_sdk(sent), rate=50, chat_rate=10)
+
+    stats = loop.run_until_complete(broadcaster.broadcast(Chats(['chat_1', 'chat_1', 'chat_2']), lambda chat_hash: {'text': 'Hi'}, bot='bot'))
+
+    assert 0.08 <= stats['seconds'] < 0.5
+    assert sorted(chat_hash for chat_hash, _, _ in sent) == ['chat_1', 'chat_1', 'chat_2']
@@ -0,0 +1,112 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('pymongo')
+
+from sdk.lib.codec import get_codec
+from sdk.lib.metrics import REGISTRY
+from sdk.lib.transport import LoopbackMessage, LoopbackTransport
+
+APPLICATION_NAME = 'broker_test'
+
+
+def command(chat, params, name='weather'):
+    return get_codec().encode({'command': 'service callback',
+                               'payload': {'command': name, 'chat': chat, 'params': params}})
+
+
+def test_messages_of_a_chat_are_processed_in_order(loop, loopback_bot):
+    handled = {}
+    running = []
+    max_running = []
+
+    async def weather(payload):
+        running.append(payload['chat'])
+        max_running.append(len(running))
+        # Earlier messages take longer, so they would finish last without ordering
+        await asyncio.sleep(0.001 * (5 - payload['params']))
+        running.remove(payload['chat'])
+        handled.setdefault(payload['chat'], []).append(payload['params'])
+
+    async def scenario():
+        sdk = await loopback_bot([('weather', 'Weather forecast', weather)], APPLICATION_NAME, concurrency=4)
+        transport = sdk.broker.transport
+        for index in range(5):
+            for chat in ('chat_1', 'chat_2', 'chat_3'):
+                await transport.publish(command(chat, index), APPLICATION_NAME)
+
+        await asyncio.wait_for(transport.join(APPLICATION_NAME), 5)
+
+    loop.run_until_complete(scenario())
+    assert handled == {chat: [0, 1, 2, 3, 4] for chat in ('chat_1', 'chat_2', 'chat_3')}
+    # Different chats are processed concurrently
+    assert max(max_running) == 3
+
+
+class AsyncAckMessage:
+
+    def __init__(self, message):
+        """
+        Loopback message with awaitable ack(), like aio_pika IncomingMessage
+        """
+        self.message = message
+        self.body = message.body
+        self.message_id = message.message_id
+        self.redelivered = message.redelivered
+
+    async def ack(self):
+        await asyncio.sleep(0)
+        self.message.ack()
+
+
+class AsyncAckTransport(LoopbackTransport):
+
+    async def consume(self, queue_name, callback, prefetch_count=1, max_priority=None):
+        async def wrapped(message):
+            await callback(AsyncAckMessage(message))
+
+        await super().consume(queue_name, wrapped, prefetch_count=prefetch_count, max_priority=max_priority)
+
+
+@pytest.mark.parametrize('concurrency', [1, 4])
+def test_messages_with_awaitable_ack_are_acknowledged(loop, loopback_bot, concurrency):
+    handled = []
+
+    async def weather(payload):
+        handled.append(payload['params'])
+
+    async def scenario():
+        transport = AsyncAckTransport()
+        await loopback_bot([('weather', 'Weather forecast', weather)], APPLICATION_NAME, transport=transport,
+                           concurrency=concurrency, dedup_config=True)
+        # More than prefetch_count: delivery stops if messages aren't acknowledged
+        for index in range(20):
+            await transport.publish(command('chat_{}'.format(index % 3), index), APPLICATION_NAME)
+        await asyncio.wait_for(transport.join(APPLICATION_NAME), 5)
+
+        # Duplicate is acknowledged without processing
+        queue = transport.queue(APPLICATION_NAME)
+        for _ in range(2):
+            queue.put(LoopbackMessage(command('chat_1', 20), queue, message_id='duplicate'))
+            await asyncio.wait_for(transport.join(APPLICATION_NAME), 5)
+
+    loop.run_until_complete(scenario())
+    assert sorted(handled) == list(range(21))
+
+
+def test_reopened_broker_collects_metrics_again(loop, loopback_bot):
+    async def scenario():
+        sdk = await loopback_bot(application_name=APPLICATION_NAME, concurrency=2)
+        broker = sdk.broker
+
+        await broker.stop()
+        assert broker.collect_metrics not in REGISTRY.collectors
+
+        # Like Broker.attach in a forked server worker
+        await broker.open()
+        await broker.open()
+        assert REGISTRY.collectors.count(broker.collect_metrics) == 1
+        assert 'codexbot_broker_in_flight{queue="broker_test"} 0' in REGISTRY.render()
+
+    loop.run_until_complete(scenario())
@@ -0,0 +1,28 @@
+import pytest
+
+from sdk.lib.codec import JsonCodec, available_codecs, get_codec
+
+MESSAGE = {'command': 'service callback',
+           'payload': {'command': 'weather', 'chat': 'chat_1', 'bot': None, 'params': 'Санкт-Петербург',
+                       'update_id': 857463521, 'sent_at': 1.5}}
+
+
+@pytest.mark.parametrize('codec', available_codecs(), ids=lambda codec: codec.name)
+def test_codecs_are_compatible_with_json(codec):
+    encoded = codec.encode(MESSAGE)
+
+    assert isinstance(encoded, bytes)
+    assert JsonCodec.decode(encoded) == MESSAGE
+    assert codec.decode(JsonCodec.encode(MESSAGE)) == MESSAGE
+
+
+def test_fastest_codec_is_default():
+    assert get_codec() is available_codecs()[0]
+    assert get_codec('json') is JsonCodec
+
+
+def test_orjson_passes_unsupported_data_to_json():
+    pytest.importorskip('orjson')
+    from sdk.lib.codec import OrjsonCodec
+
+    assert OrjsonCodec.decode(OrjsonCodec.encode({1: 'chat', 'big': 2 ** 70})) == {'1': 'chat', 'big': 2 ** 70}
@@ -0,0 +1,48 @@
+import asyncio
+import time
+
+import pytest
+
+from sdk.lib.cpu_pool import CpuPool
+
+
+def square(value):
+    return value * value
+
+
+def sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def test_run_returns_result(loop):
+    pool = CpuPool(workers=2)
+
+    async def scenario():
+        try:
+            return await asyncio.gather(*[pool.run(square, value) for value in range(10)])
+        finally:
+            await pool.close()
+
+    assert loop.run_until_complete(scenario()) == [value * value for value in range(10)]
+
+
+def test_timed_out_task_keeps_its_slot(loop):
+    pool = CpuPool(workers=1, max_pending=1)
+
+    async def scenario():
+        try:
+            with pytest.raises(asyncio.TimeoutError):
+                await pool.run(sleep, 0.5, timeout=0.05)
+
+            # The worker is still busy, so the pool is full
+            assert pool.pending == 1
+
+            started = time.monotonic()
+            assert await pool.run(square, 3, timeout=5) == 9
+            return time.monotonic() - started
+        finally:
+            await pool.close()
+
+    assert loop.run_until_complete(scenario()) >= 0.3
+    assert pool.pending == 0
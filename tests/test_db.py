@@ -0,0 +1,171 @@
+import asyncio
+import threading
+
+import pytest
+
+pytest.importorskip('pymongo')
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from sdk.lib.db import AsyncDb, CachedDb, WriteBehindDb
+from sdk.lib.memory_db import MemoryDb
+
+
+class ThreadCheckingDb(MemoryDb):
+
+    def __init__(self):
+        """
+        Remembers threads which ran queries
+        """
+        super().__init__()
+        self.threads = set()
+
+    def find_one(self, collection, params):
+        self.threads.add(threading.get_ident())
+        return super().find_one(collection, params)
+
+
+class CountingDb(MemoryDb):
+
+    def __init__(self):
+        super().__init__()
+        self.reads = 0
+        self.bulk_writes = []
+
+    def find_one(self, collection, params):
+        self.reads += 1
+        return super().find_one(collection, params)
+
+    def bulk_write(self, collection, operations, ordered=True):
+        self.bulk_writes.append(len(operations))
+        return super().bulk_write(collection, operations, ordered)
+
+
+@pytest.fixture
+def async_db():
+    # MongoClient doesn't connect until the first query, so it's replaced before any
+    db = AsyncDb('test', pool_size=2)
+    db.sync.close()
+    db.sync = ThreadCheckingDb()
+    yield db
+    db.close()
+
+
+def test_async_db_runs_queries_in_its_pool(loop, async_db):
+    async def scenario():
+        await async_db.insert('settings', [{'chat': chat, 'city': 'Paris'} for chat in range(5)])
+        found = [await async_db.find_one('settings', {'chat': chat}) for chat in range(5)]
+        batches = []
+        async for batch in async_db.find_batches('settings', {}, batch_size=2):
+            batches.append(len(batch))
+        return found, batches
+
+    found, batches = loop.run_until_complete(scenario())
+    assert [document['chat'] for document in found] == list(range(5))
+    assert batches == [2, 2, 1]
+    assert threading.get_ident() not in async_db.sync.threads
+
+
+def test_cached_find_one_is_invalidated_by_writes():
+    db = CachedDb(CountingDb(), collections={'settings': {'size': 10, 'ttl': 60}})
+    db.insert('settings', {'chat': 1, 'city': 'Paris'})
+
+    # Changing a returned document doesn't change the cached one
+    db.find_one('settings', {'chat': 1})['city'] = 'Changed'
+    assert db.find_one('settings', {'chat': 1})['city'] == 'Paris'
+    assert db.db.reads == 1
+
+    db.update('settings', {'chat': 1}, {'$set': {'city': 'London'}})
+    assert db.find_one('settings', {'chat': 1})['city'] == 'London'
+    assert db.db.reads == 2
+
+    # Not configured collections aren't cached
+    db.find_one('users', {'id': 1})
+    db.find_one('users', {'id': 1})
+    assert db.db.reads == 4
+    assert db.stats()['settings']['hits'] == 1
+
+
+def test_cached_collection_is_invalidated_by_bulk_write():
+    db = CachedDb(MemoryDb())
+    db.insert('settings', {'chat': 1, 'city': 'Paris'})
+    assert db.find_one('settings', {'chat': 1})['city'] == 'Paris'
+
+    db.bulk_write('settings', [UpdateOne({'chat': 1}, {'$set': {'city': 'London'}})])
+    assert db.find_one('settings', {'chat': 1})['city'] == 'London'
+
+
+def test_cache_key_keeps_value_types():
+    object_id = ObjectId()
+    db = CachedDb(MemoryDb())
+    db.insert('settings', {'_id': object_id, 'city': 'Paris'})
+
+    assert db.find_one('settings', {'_id': object_id})['city'] == 'Paris'
+    assert db.find_one('settings', {'_id': str(object_id)}) is None
+
+
+def test_async_read_during_write_is_not_cached(loop, async_db):
+    db = CachedDb(async_db)
+
+    async def scenario():
+        await db.insert('settings', {'chat': 1, 'city': 'Paris'})
+        read = asyncio.ensure_future(db.find_one('settings', {'chat': 1}))
+        await db.update('settings', {'chat': 1}, {'$set': {'city': 'London'}})
+        await read
+        return await db.find_one('settings', {'chat': 1})
+
+    assert loop.run_until_complete(scenario())['city'] == 'London'
+
+
+def test_find_batches_sees_queued_writes(loop):
+    db = CachedDb(WriteBehindDb(MemoryDb(), batch_size=100))
+
+    async def scenario():
+        for index in range(5):
+            db.update('schedules', {'id': index}, {'$set': {'id': index}}, upsert=True)
+        try:
+            return [len(batch) for batch in db.find_batches('schedules', {}, batch_size=2)]
+        finally:
+            db.close()
+
+    assert loop.run_until_complete(scenario()) == [2, 2, 1]
+
+
+def test_write_behind_combines_writes_and_flushes_before_reads(loop):
+    db = WriteBehindDb(CountingDb(), batch_size=4, flush_interval=60)
+
+    async def scenario():
+        for chat in range(6):
+            db.insert('settings', {'chat': chat, 'city': 'Paris'})
+        # The first 4 are written as one batch
+        assert db.db.bulk_writes == [4]
+
+        db.update('settings', {'chat': 5}, {'$set': {'city': 'London'}})
+        assert db.find_one('settings', {'chat': 5})['city'] == 'London'
+        assert db.db.bulk_writes == [4, 3]
+        db.close()
+
+    loop.run_until_complete(scenario())
+    assert db.stats() == {'queued': 0, 'flushed': 7, 'failed': 0}
+
+
+def test_async_write_behind_flushes_periodically(loop, async_db):
+    db = WriteBehindDb(async_db, batch_size=100, flush_interval=0.01)
+
+    async def scenario():
+        for chat in range(3):
+            await db.insert('settings', {'chat': chat})
+        assert db.stats()['queued'] == 3
+
+        await asyncio.sleep(0.05)
+        assert db.stats()['flushed'] == 3
+
+        await db.remove('settings', {'chat': 0})
+        chats = []
+        async for batch in db.find_batches('settings', {}):
+            chats.extend(document['chat'] for document in batch)
+        db.close()
+        return chats
+
+    assert loop.run_until_complete(scenario()) == [1, 2]
@@ -0,0 +1,85 @@
+import pytest
+
+pytest.importorskip('pymongo')
+
+from sdk.lib.codec import get_codec
+from sdk.lib.dedup import Deduplicator
+from sdk.lib.memory_db import MemoryDb
+
+APPLICATION_NAME = 'dedup_test'
+
+
+class Message:
+
+    def __init__(self, body, message_id=None, redelivered=False):
+        self.body = body
+        self.message_id = message_id
+        self.redelivered = redelivered
+        self.acked = False
+
+    def ack(self):
+        self.acked = True
+
+
+def command(chat):
+    return get_codec().encode({'command': 'service callback',
+                               'payload': {'command': 'weather', 'chat': chat, 'params': ''}})
+
+
+@pytest.fixture
+def bot(loop, loopback_bot):
+    calls = []
+
+    async def weather(payload):
+        calls.append(payload['chat'])
+
+    sdk = loop.run_until_complete(loopback_bot([('weather', 'Weather forecast', weather)], APPLICATION_NAME,
+                                               dedup_config=True))
+    return sdk, calls
+
+
+def test_same_command_sent_again_is_processed(loop, bot):
+    sdk, calls = bot
+
+    for _ in range(2):
+        message = Message(command('chat_1'))
+        loop.run_until_complete(sdk.broker.callback(message))
+        assert message.acked
+
+    assert calls == ['chat_1', 'chat_1']
+
+
+def test_redelivered_copy_is_skipped(loop, bot):
+    sdk, calls = bot
+
+    loop.run_until_complete(sdk.broker.callback(Message(command('chat_1'))))
+    redelivered = Message(command('chat_1'), redelivered=True)
+    loop.run_until_complete(sdk.broker.callback(redelivered))
+
+    assert redelivered.acked
+    assert calls == ['chat_1']
+
+
+def test_message_with_the_same_id_is_skipped(loop, bot):
+    sdk, calls = bot
+
+    loop.run_until_complete(sdk.broker.callback(Message(command('chat_1'), message_id='id_1')))
+    loop.run_until_complete(sdk.broker.callback(Message(command('chat_2'), message_id='id_1')))
+    loop.run_until_complete(sdk.broker.callback(Message(command('chat_3'), message_id='id_2')))
+
+    assert calls == ['chat_1', 'chat_3']
+
+
+def test_persistent_keys_survive_restart(loop):
+    db = MemoryDb()
+    message = Message(command('chat_1'))
+    key = Deduplicator.key(message)
+
+    async def scenario():
+        await Deduplicator(persistent=True).remember(key, db)
+
+        restarted = Deduplicator(persistent=True)
+        assert not await restarted.seen(key, redelivered=False, db=db, content=True)
+        assert await restarted.seen(key, redelivered=True, db=db, content=True)
+
+    loop.run_until_complete(scenario())
@@ -0,0 +1,66 @@
+import os
+import threading
+import time
+
+import pytest
+
+from sdk.lib.error_reporter import ErrorReporter
+
+
+def fail(reporter, exception):
+    try:
+        raise exception
+    except Exception:
+        reporter.catch()
+
+
+def test_same_errors_are_reported_once_with_count():
+    reports = []
+    reporter = ErrorReporter(send=reports.append, rate=1000)
+
+    for _ in range(3):
+        fail(reporter, ValueError('bad value'))
+    fail(reporter, KeyError('key'))
+    reporter.stop()
+
+    assert sorted((report['type'], report['count']) for report in reports) == [('KeyError', 1), ('ValueError', 3)]
+    assert 'bad value' in next(report['traceback'] for report in reports if report['type'] == 'ValueError')
+
+
+def test_catch_does_not_wait_for_slow_send():
+    sending = threading.Event()
+
+    def slow_send(report):
+        sending.set()
+        time.sleep(0.2)
+
+    reporter = ErrorReporter(send=slow_send, rate=1000)
+    fail(reporter, ValueError('first'))
+    assert sending.wait(1)
+
+    started = time.perf_counter()
+    fail(reporter, KeyError('second'))
+    assert time.perf_counter() - started < 0.1
+    reporter.stop()
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='fork is not available')
+def test_forked_process_reports_errors():
+    read, write = os.pipe()
+    reporter = ErrorReporter(send=lambda report: os.write(write, report['type'].encode()), rate=1000)
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            fail(reporter, KeyError('key'))
+            reporter.stop()
+        finally:
+            os._exit(0)
+
+    os.waitpid(pid, 0)
+    os.close(write)
+    try:
+        assert os.read(read, 100) == b'KeyError'
+    finally:
+        os.close(read)
+        reporter.stop()
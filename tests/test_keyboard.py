@@ -0,0 +1,22 @@
+from sdk.lib.keyboard import KeyboardTemplate
+
+
+def test_placeholders_are_filled_with_prefixed_callback_data():
+    pages = KeyboardTemplate([[{'text': '<', 'callback_data': 'page {prev}'},
+                               {'text': '>', 'callback_data': 'page {next}'}],
+                              [{'text': 'Close', 'callback_data': 'close'}]])
+
+    assert pages.render({'prev': 1, 'next': 3}, token='token') == [
+        [{'text': '<', 'callback_data': 'token page 1'}, {'text': '>', 'callback_data': 'token page 3'}],
+        [{'text': 'Close', 'callback_data': 'token close'}]
+    ]
+
+
+def test_text_with_literal_braces_is_static():
+    keyboard = KeyboardTemplate([[{'text': ':-}', 'callback_data': '{"action": "smile"}'},
+                                  {'text': '{ start', 'callback_data': 'start'},
+                                  {'text': '{{escaped}} {count}', 'callback_data': 'count'}]])
+
+    assert keyboard.render({'count': 2}) == [[{'text': ':-}', 'callback_data': '{"action": "smile"}'},
+                                              {'text': '{ start', 'callback_data': 'start'},
+                                              {'text': '{escaped} 2', 'callback_data': 'count'}]]
@@ -0,0 +1,65 @@
+import asyncio
+
+from sdk.lib.dispatcher import OrderedDispatcher
+from sdk.lib.lanes import BULK, INTERACTIVE, WeightedRoundRobin
+from sdk.lib.transport import LoopbackTransport
+
+
+def test_round_robin_doesnt_starve_bulk_lane():
+    lanes = WeightedRoundRobin({INTERACTIVE: 4, BULK: 1})
+
+    picked = [lanes.next([INTERACTIVE, BULK]) for _ in range(10)]
+
+    assert picked.count(BULK) == 2
+    assert picked[:5].count(BULK) == 1
+    assert lanes.next([BULK]) == BULK
+
+
+def test_interactive_jobs_overtake_queued_bulk_ones(loop):
+    dispatcher = OrderedDispatcher(concurrency=1, max_in_flight=100, weights={INTERACTIVE: 4, BULK: 1})
+    finished = []
+
+    def job(name):
+        async def run():
+            await asyncio.sleep(0)
+            finished.append(name)
+        return run
+
+    async def scenario():
+        # Every job has its own chat, so they wait only for the worker slot
+        for index in range(5):
+            await dispatcher.submit('bulk_{}'.format(index), job('b'), BULK)
+        for index in range(4):
+            await dispatcher.submit('interactive_{}'.format(index), job('i'), INTERACTIVE)
+        await dispatcher.join()
+
+    loop.run_until_complete(scenario())
+    # The first bulk job took the free slot, then slots are given in order i i b i i
+    assert ''.join(finished) == 'biibiibbb'
+
+
+def test_replies_to_bulk_commands_have_bulk_priority(loop, loopback_bot):
+    from sdk.lib.codec import get_codec
+    from sdk.lib.lanes import PRIORITIES
+
+    transport = LoopbackTransport()
+    codec = get_codec()
+
+    async def scenario():
+        async def reply(payload):
+            await sdk.send_text_to_chat(payload['chat'], payload['command'])
+
+        sdk = await loopback_bot([('report', 'Heavy report', reply, {'lane': BULK}),
+                                  ('weather', 'Weather forecast', reply)], transport=transport, concurrency=2)
+        for command in ('report', 'weather'):
+            await transport.publish(codec.encode({'command': 'service callback',
+                                                  'payload': {'command': command, 'chat': 'chat_1', 'params': ''}}),
+                                    sdk.queue_name)
+        await transport.join(sdk.queue_name)
+
+    loop.run_until_complete(scenario())
+    priorities = {codec.decode(message.body)['payload']['text']: message.priority
+                  for message in transport.queue('core').messages
+                  if codec.decode(message.body)['command'] == 'send to service'}
+
+    assert priorities == {'report': PRIORITIES[BULK], 'weather': PRIORITIES[INTERACTIVE]}
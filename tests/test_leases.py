@@ -0,0 +1,64 @@
+import time
+
+import pytest
+
+pytest.importorskip('pymongo')
+
+from sdk.lib.leases import PartitionLeases
+from sdk.lib.memory_db import MemoryDb
+
+
+def create_leases(db, replica_id, updates=None):
+    async def on_update(gained, lost):
+        if updates is not None:
+            updates.append((gained, lost))
+
+    return PartitionLeases(db, partitions=10, ttl=30, on_update=on_update, replica_id=replica_id)
+
+
+def test_partitions_are_split_between_live_replicas(loop):
+    db = MemoryDb()
+    updates = []
+    replicas = [create_leases(db, 'replica_0', updates)] + [create_leases(db, 'replica_{}'.format(index))
+                                                          for index in (1, 2)]
+
+    async def scenario():
+        # Surplus is released on the next renewal after new replicas appear
+        for _ in range(3):
+            for replica in replicas:
+                await replica.renew()
+
+        owned = [replica.owned for replica in replicas]
+        # Nobody owns more than the fair share: ceil(10 / 3)
+        assert all(0 < len(partitions) <= 4 for partitions in owned)
+        assert set().union(*owned) == set(range(10))
+
+        # Expired replica and its leases are taken over
+        dead = replicas.pop()
+        db.update(PartitionLeases.REPLICAS_COLLECTION, {'_id': dead.replica_id}, {'$set': {'expires_at': 0}})
+        db.update(PartitionLeases.LEASES_COLLECTION, {'owner': dead.replica_id}, {'$set': {'expires_at': 0}},
+                  multi=True)
+        for replica in replicas:
+            await replica.renew()
+        assert len(replicas[0].owned) + len(replicas[1].owned) == 10
+
+        # Stopped replica releases its leases at once
+        await replicas[0].stop()
+        await replicas[1].renew()
+        assert replicas[1].owned == set(range(10))
+
+    loop.run_until_complete(scenario())
+
+    gained = set().union(*(gained for gained, _ in updates))
+    lost = set().union(*(lost for _, lost in updates))
+    assert gained and gained == lost
+
+
+def test_live_lease_is_not_taken(loop):
+    db = MemoryDb()
+    db.insert(PartitionLeases.LEASES_COLLECTION, [{'_id': partition, 'owner': 'other', 'expires_at': time.time() + 30}
+                                                  for partition in range(10)])
+    replica = create_leases(db, 'replica')
+
+    loop.run_until_complete(replica.renew())
+    assert not replica.owned
@@ -0,0 +1,35 @@
+import logging
+
+import pytest
+
+from sdk.lib.logging import Logging, RepeatFilter
+
+
+@pytest.fixture
+def root(monkeypatch):
+    # Logging configures the process once, so every test starts from scratch
+    root = logging.getLogger()
+    monkeypatch.setattr(Logging, 'configured', False)
+    monkeypatch.setattr(Logging, 'handler', None)
+    monkeypatch.setattr(root, 'level', root.level)
+    return root
+
+
+def test_rate_limit_is_applied_to_own_handler(root, monkeypatch):
+    # pytest adds its capture handlers when the test starts
+    monkeypatch.setattr(root, 'handlers', [])
+
+    Logging(level=logging.INFO, rate=10)
+
+    assert root.handlers == [Logging.handler]
+    assert any(isinstance(item, RepeatFilter) for item in Logging.handler.filters)
+
+
+def test_application_handlers_are_kept_without_limits(root, monkeypatch):
+    handler = logging.NullHandler()
+    monkeypatch.setattr(root, 'handlers', [handler])
+
+    Logging(level=logging.INFO, rate=10)
+
+    assert root.handlers == [handler]
+    assert not handler.filters
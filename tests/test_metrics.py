@@ -0,0 +1,22 @@
+from sdk.lib.metrics import Registry
+
+
+def test_removed_collector_is_not_called():
+    registry = Registry()
+    jobs = registry.gauge('jobs', 'Scheduled jobs', ['application'])
+    calls = []
+
+    def collect():
+        calls.append(True)
+        jobs.set(3, application='bot')
+
+    registry.add_collector(collect)
+    assert 'jobs{application="bot"} 3' in registry.render()
+
+    registry.remove_collector(collect)
+    jobs.remove(application='bot')
+    assert 'jobs{' not in registry.render()
+    assert len(calls) == 1
+
+    # Removing twice is harmless, e.g. when stop() is called again
+    registry.remove_collector(collect)
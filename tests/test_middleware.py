@@ -0,0 +1,32 @@
+import asyncio
+
+from sdk.lib.middleware import ConcurrencyLimit, compose
+
+
+def test_messages_over_the_limit_are_shed(loop):
+    rejected = []
+    handled = []
+
+    async def fallback(payload):
+        rejected.append(payload['chat'])
+
+    async def handler(payload):
+        await asyncio.sleep(0.01)
+        handled.append(payload['chat'])
+
+    pipeline = compose([ConcurrencyLimit(1, max_waiting=1, fallback=fallback, name='weather')], handler)
+
+    async def scenario():
+        await asyncio.gather(*[pipeline({'chat': chat}) for chat in range(4)])
+
+    loop.run_until_complete(scenario())
+    assert handled == [0, 1]
+    assert rejected == [2, 3]
+
+
+def test_concurrency_option_without_concurrent_broker_is_reported(loop, loopback_bot, caplog):
+    async def weather(payload):
+        pass
+
+    loop.run_until_complete(loopback_bot([('weather', 'Weather forecast', weather, {'concurrency': 5})]))
+    assert 'Concurrency option of weather has no effect' in caplog.text
@@ -0,0 +1,62 @@
+import asyncio
+
+from sdk.lib.publisher import Publisher
+
+
+class Broker:
+
+    def __init__(self, fail=()):
+        """
+        Confirms publishes on the next loop iteration. Messages in fail are rejected
+        """
+        self.fail = fail
+        self.sent = []
+        self.publishing = 0
+        self.max_publishing = 0
+
+    async def send(self, data, routing_key, priority=None):
+        self.publishing += 1
+        self.max_publishing = max(self.max_publishing, self.publishing)
+        await asyncio.sleep(0)
+        self.publishing -= 1
+        if data in self.fail:
+            raise ConnectionError('Nack')
+        self.sent.append((data, routing_key))
+
+
+def test_messages_are_published_in_batches_with_confirms(loop):
+    broker = Broker(fail=('message 3',))
+    publisher = Publisher(broker.send, max_batch_size=4, flush_interval=10)
+
+    async def scenario():
+        confirms = [await publisher.publish('message {}'.format(index)) for index in range(8)]
+        await publisher.flush()
+        return confirms
+
+    confirms = loop.run_until_complete(scenario())
+
+    assert broker.sent == [('message {}'.format(index), 'core') for index in range(8) if index != 3]
+    # Publishes are pipelined, so a batch waits for one round of confirms instead of one per message
+    assert broker.max_publishing >= 4
+    assert publisher.stats()['batches'] == 2
+    assert isinstance(confirms[3].exception(), ConnectionError)
+    assert all(confirm.result() is None for index, confirm in enumerate(confirms) if index != 3)
+
+
+def test_publish_waits_when_queue_is_full(loop):
+    broker = Broker()
+    publisher = Publisher(broker.send, max_batch_size=2, flush_interval=10, max_queue_size=2)
+
+    async def scenario():
+        for index in range(2):
+            await publisher.publish('message {}'.format(index))
+        third = asyncio.ensure_future(publisher.publish('message 2'))
+        await asyncio.sleep(0)
+        assert not third.done() and publisher.queue_size == 2
+
+        await publisher.flush()
+        await third
+        await publisher.flush()
+
+    loop.run_until_complete(scenario())
+    assert [data for data, _ in broker.sent] == ['message 0', 'message 1', 'message 2']
@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('aio_pika')
+
+from sdk.lib.publisher import Publisher
+from sdk.lib.rabbitmq import ConnectionManager
+
+
+class FakeExchange:
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def publish(self, message, routing_key):
+        # Confirms of a channel come back later, in any order between channels
+        self.channel.published.append((routing_key, message.body))
+        await asyncio.sleep(0)
+
+
+class FakeChannel:
+
+    def __init__(self):
+        self.published = []
+        self.is_closed = False
+        self.default_exchange = FakeExchange(self)
+
+
+class FakeConnection:
+
+    is_closed = False
+
+    def __init__(self):
+        self.channels = []
+
+    async def channel(self, publisher_confirms=False):
+        await asyncio.sleep(0)
+        channel = FakeChannel()
+        self.channels.append(channel)
+        return channel
+
+
+def test_batch_to_one_queue_keeps_order_on_one_channel(loop):
+    manager = ConnectionManager('amqp://test/', publish_channels=4)
+    manager.connection = FakeConnection()
+    publisher = Publisher(manager.publish, routing_key='core', max_batch_size=50)
+
+    async def scenario():
+        futures = [await publisher.publish('message {}'.format(index).encode()) for index in range(200)]
+        await asyncio.gather(*futures)
+
+    loop.run_until_complete(scenario())
+
+    used = [channel for channel in manager.connection.channels if channel.published]
+    assert len(used) == 1
+    assert [body for _, body in used[0].published] == ['message {}'.format(index).encode() for index in range(200)]
+
+
+def test_routing_keys_are_spread_over_the_pool(loop):
+    manager = ConnectionManager('amqp://test/', publish_channels=4)
+    manager.connection = FakeConnection()
+
+    async def scenario():
+        await asyncio.gather(*[manager.publish(b'message', 'queue_{}'.format(index)) for index in range(20)])
+        return [await manager.publish_channel('queue_{}'.format(index)) for index in range(20)]
+
+    channels = loop.run_until_complete(scenario())
+
+    assert 1 < len(manager.connection.channels) <= 4
+    assert len(set(map(id, channels))) == len(manager.connection.channels)
@@ -0,0 +1,178 @@
+import asyncio
+import logging
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('apscheduler')
+pytest.importorskip('pymongo')
+
+from sdk.lib.memory_db import MemoryDb
+from sdk.lib.metrics import REGISTRY
+from sdk.lib.scheduler import Scheduler
+
+TRIGGER = {'minute': '0', 'hour': '*/6'}
+
+
+def say_hello_to_all(jobs_args):
+    pass
+
+
+async def create_scheduler(db, application_name='test'):
+    # AsyncIOScheduler is started in the running event loop, like the lazy CodexBot.scheduler
+    scheduler = Scheduler(SimpleNamespace(event_loop=asyncio.get_event_loop(), db=db, hawk=None, logging=logging,
+                                          application_name=application_name))
+    await scheduler.ensure_indexes()
+    return scheduler
+
+
+def members(scheduler):
+    return {job_id for batch in scheduler.batches.values() for job_id in batch.members}
+
+
+def test_batched_jobs_are_split_between_replicas(loop):
+    db = MemoryDb()
+
+    async def scenario():
+        replicas = [await create_scheduler(db) for _ in range(2)]
+        for index, replica in enumerate(replicas):
+            replica.restore_sharded(say_hello_to_all, replica_id='replica_{}'.format(index))
+            replica.restore_batched(say_hello_to_all)
+        await asyncio.sleep(0)
+
+        # Second replica takes its share after the first one releases the surplus
+        for replica in replicas + replicas:
+            await replica.leases.renew()
+
+        for chat in range(200):
+            replicas[0].add_batched(say_hello_to_all, {'chat': 'chat_{}'.format(chat)}, ['chat_{}'.format(chat)],
+                                    TRIGGER)
+
+        # Owners pick up jobs added on other replicas
+        for replica in replicas:
+            await replica.leases.renew()
+
+        first, second = members(replicas[0]), members(replicas[1])
+        assert first and second
+        assert not first & second
+        assert len(first | second) == 200
+
+        # Batch id is the same in every process
+        assert set(replicas[0].batches) == set(replicas[1].batches)
+
+        # Removal on a replica which doesn't own the job
+        job_id = next(iter(second))
+        replicas[0].remove({'chat': job_id})
+        await replicas[1].leases.renew()
+        assert job_id not in members(replicas[1])
+        assert db.find_one(Scheduler.COLLECTION_NAME, {'id': job_id}) is None
+
+        # Partitions of a stopped replica are taken over with their batched jobs
+        await replicas[1].stop()
+        await replicas[0].leases.renew()
+        assert len(members(replicas[0])) == 199
+
+        await replicas[0].stop()
+
+    loop.run_until_complete(scenario())
+
+
+def test_restored_batch_has_the_same_id(loop):
+    db = MemoryDb()
+
+    async def scenario():
+        scheduler = await create_scheduler(db)
+        scheduler.add_batched(say_hello_to_all, {'chat': 'chat_1', 'bot': 'bot'}, ['chat_1'], TRIGGER)
+        batch_ids = set(scheduler.batches)
+        await scheduler.stop()
+
+        restarted = await create_scheduler(db)
+        stats = restarted.restore_batched(say_hello_to_all)
+
+        assert stats['jobs'] == 1
+        assert set(restarted.batches) == batch_ids
+        assert members(restarted) == {'bot:chat_1'}
+        await restarted.stop()
+
+    loop.run_until_complete(scenario())
+
+
+def test_jobs_gauge_is_labelled_and_removed_on_stop(loop):
+    db = MemoryDb()
+
+    async def scenario():
+        first, second = await create_scheduler(db, 'first'), await create_scheduler(db, 'second')
+        first.add(say_hello_to_all, {'chat': 1, 'bot': 1}, [1], TRIGGER)
+
+        rendered = REGISTRY.render()
+        assert 'codexbot_scheduler_jobs{application="first"} 1' in rendered
+        assert 'codexbot_scheduler_jobs{application="second"} 0' in rendered
+
+        collectors = len(REGISTRY.collectors)
+        await first.stop()
+        await second.stop()
+        assert len(REGISTRY.collectors) == collectors - 2
+        assert 'codexbot_scheduler_jobs{' not in REGISTRY.render()
+
+    loop.run_until_complete(scenario())
+
+
+def test_sharded_jobs_run_on_one_replica(loop):
+    db = MemoryDb()
+
+    async def scenario():
+        replicas = [await create_scheduler(db) for _ in range(2)]
+        for index, replica in enumerate(replicas):
+            replica.restore_sharded(say_hello_to_all, replica_id='replica_{}'.format(index))
+        await asyncio.sleep(0)
+        for replica in replicas + replicas:
+            await replica.leases.renew()
+
+        for chat in range(50):
+            replicas[0].add(say_hello_to_all, {'chat': 'chat_{}'.format(chat)}, ['chat_{}'.format(chat)], TRIGGER)
+        for replica in replicas:
+            await replica.leases.renew()
+
+        jobs = [{job.id for job in replica.scheduler.get_jobs()} for replica in replicas]
+        assert jobs[0] and jobs[1]
+        assert not jobs[0] & jobs[1]
+        assert len(jobs[0] | jobs[1]) == 50
+
+        for replica in replicas:
+            await replica.stop()
+
+    loop.run_until_complete(scenario())
+
+
+def test_attached_scheduler_renews_leases_on_new_loop(loop):
+    db = MemoryDb()
+
+    async def setup():
+        scheduler = await create_scheduler(db)
+        scheduler.restore_sharded(say_hello_to_all, lease_ttl=0.03, replica_id='replica')
+        return scheduler
+
+    # Like a forked server worker: the loop of the parent process doesn't run anymore
+    scheduler = loop.run_until_complete(setup())
+    worker_loop = asyncio.new_event_loop()
+
+    def heartbeat():
+        replica = db.find_one('application_schedules_replicas', {'_id': 'replica'})
+        return replica['expires_at'] if replica is not None else None
+
+    async def worker():
+        before = heartbeat()
+        scheduler.attach(worker_loop)
+        await asyncio.sleep(0.05)
+        after = heartbeat()
+        await scheduler.stop()
+        return before, after
+
+    try:
+        asyncio.set_event_loop(worker_loop)
+        before, after = worker_loop.run_until_complete(worker())
+    finally:
+        asyncio.set_event_loop(loop)
+        worker_loop.close()
+
+    assert after is not None and (before is None or after > before)
@@ -0,0 +1,160 @@
+import asyncio
+import json
+import os
+import signal
+import socket
+import time
+import urllib.request
+from types import SimpleNamespace
+
+import pytest
+
+aiohttp = pytest.importorskip('aiohttp')
+
+import aiohttp.web
+from aiohttp.test_utils import TestClient, TestServer, make_mocked_request
+
+from sdk.lib import server
+from sdk.lib.server import Request, Server, http_response
+
+
+def mocked_request(body, content_type, method='POST', path='/hook?from=core'):
+    return Request(make_mocked_request(method, path, headers={'Content-Type': content_type}), body)
+
+
+def test_request_body_is_parsed_once_on_first_access(monkeypatch):
+    loads = []
+    original_loads = json.loads
+
+    def counting_loads(text):
+        loads.append(text)
+        return original_loads(text)
+
+    monkeypatch.setattr(server.json, 'loads', counting_loads)
+    request = mocked_request(b'{"chat": "chat_1"}', 'application/json')
+
+    assert request['query']['from'] == 'core'
+    assert not loads
+
+    assert request['json'] == {'chat': 'chat_1'}
+    assert request.json == {'chat': 'chat_1'}
+    assert len(loads) == 1
+
+
+def test_request_works_as_dict():
+    request = mocked_request('city=Paris&units='.encode(), 'application/x-www-form-urlencoded')
+
+    assert dict(request['post']) == {'city': 'Paris', 'units': ''}
+    assert request['text'] == 'city=Paris&units='
+    # Invalid JSON is an empty dict, like before
+    assert request.get('json') == {}
+    assert sorted(request) == sorted(Request.KEYS)
+    with pytest.raises(KeyError):
+        request['body']
+
+
+class Widgets:
+
+    def __init__(self):
+        self.sdk = SimpleNamespace(hawk=None)
+        self.calls = 0
+
+    @http_response(cache_ttl=30, gzip_min_size=100)
+    async def widget(self, request):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        return {'text': 'Weather in {}. '.format(request['query'].get('city')) * 20, 'content-type': 'text/html'}
+
+
+def test_cached_response_is_computed_once_and_revalidated(loop):
+    widgets = Widgets()
+    application = aiohttp.web.Application()
+    application.router.add_route('GET', '/widget', widgets.widget)
+
+    async def scenario():
+        async with TestClient(TestServer(application)) as client:
+            responses = await asyncio.gather(*[client.get('/widget?city=Paris') for _ in range(3)])
+            assert [response.status for response in responses] == [200, 200, 200]
+            assert widgets.calls == 1
+
+            response = responses[0]
+            assert response.headers['Cache-Control'] == 'public, max-age=30'
+            assert response.headers['Content-Encoding'] == 'gzip'
+            assert (await response.text()).startswith('Weather in Paris.')
+
+            not_modified = await client.get('/widget?city=Paris', headers={'If-None-Match': response.headers['ETag']})
+            assert not_modified.status == 304
+
+            await client.get('/widget?city=London')
+            assert widgets.calls == 2
+
+    loop.run_until_complete(scenario())
+
+
+def test_static_files_have_cache_control(loop, tmp_path):
+    (tmp_path / 'app.js').write_text('console.log(1)')
+    server = Server(loop)
+    server.add_static('/static', str(tmp_path), max_age=3600)
+
+    async def scenario():
+        async with TestClient(TestServer(server.web_server)) as client:
+            response = await client.get('/static/app.js')
+            assert response.headers['Cache-Control'] == 'public, max-age=3600'
+
+            not_modified = await client.get('/static/app.js',
+                                            headers={'If-Modified-Since': response.headers['Last-Modified']})
+            assert not_modified.status == 304
+
+    loop.run_until_complete(scenario())
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def get(url, timeout=10):
+    # Workers need some time to start
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                return response.read().decode()
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='fork is not available')
+def test_forked_worker_serves_requests_on_its_loop():
+    port = free_port()
+
+    def on_worker_start(index, event_loop):
+        # Like the broker consumer of the first worker: must run on the loop of the server
+        started.append(event_loop)
+
+    async def loop_check(request):
+        running = started and asyncio.get_event_loop() is started[0]
+        return aiohttp.web.Response(text='same loop' if running else 'other loop')
+
+    started = []
+    server = Server(asyncio.new_event_loop(), port=port)
+    server.set_routes([('GET', '/loop', loop_check)])
+
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            server.start(workers=2, on_worker_start=on_worker_start)
+            status = 0
+        finally:
+            os._exit(status)
+
+    try:
+        assert get('http://127.0.0.1:{}/loop'.format(port)) == 'same loop'
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        _, status = os.waitpid(pid, 0)
+    assert status == 0
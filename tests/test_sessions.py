@@ -0,0 +1,135 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+pytest.importorskip('pymongo')
+
+from sdk.lib.memory_db import MemoryDb
+from sdk.lib.sessions import SessionStore
+
+
+class FailingDb(MemoryDb):
+
+    def __init__(self, during_write=None):
+        """
+        bulk_write fails once and calls during_write before that, like a session changed while awaiting Db
+        """
+        super().__init__()
+        self.during_write = during_write
+        self.failed = False
+
+    def bulk_write(self, collection, operations, ordered=True):
+        if not self.failed:
+            self.failed = True
+            if self.during_write is not None:
+                self.during_write()
+            raise ConnectionError('Db is unavailable')
+        return super().bulk_write(collection, operations, ordered)
+
+
+def test_failed_flush_is_written_by_the_next_one(loop):
+    store = SessionStore(FailingDb(), flush_interval=60)
+
+    async def scenario():
+        await store.start('bot', 'chat', 'user', 'city', {'units': 'C'})
+        await store.flush()
+        assert list(store.dirty) == ['bot:chat:user']
+
+        await store.flush()
+        assert not store.dirty
+        await store.close()
+
+    loop.run_until_complete(scenario())
+    assert store.db.find_one('sessions', {'_id': 'bot:chat:user'})['data'] == {'units': 'C'}
+
+
+def test_failed_flush_keeps_sessions_changed_meanwhile(loop):
+    store = SessionStore(flush_interval=60)
+
+    async def scenario():
+        session = await store.start('bot', 'chat', 'user', 'city')
+        store.db = FailingDb(during_write=lambda: store.finish(session))
+        await store.flush()
+        await store.close()
+
+    loop.run_until_complete(scenario())
+    assert store.db.find_one('sessions', {'_id': 'bot:chat:user'}) is None
+
+
+def test_answer_with_bot_goes_to_dialog_started_without_bot(loop):
+    store = SessionStore(MemoryDb(), flush_interval=60)
+    answers = []
+
+    async def city(payload, session):
+        answers.append((payload['text'], session.data))
+
+    async def call(handler, payload, session):
+        await handler(payload, session)
+
+    async def scenario():
+        store.set_step_handler('city', city)
+        await store.start(None, 'chat', 'user', 'city', {'units': 'C'})
+        assert await store.route({'bot': 'bot', 'chat': 'chat', 'user': 'user', 'text': 'Paris'}, call)
+        assert not await store.route({'bot': 'bot', 'chat': 'chat', 'user': 'user', 'text': 'again'}, call)
+        await store.close()
+
+    loop.run_until_complete(scenario())
+    assert answers == [('Paris', {'units': 'C'})]
+
+
+def test_expired_session_with_naive_datetime_is_not_loaded(loop):
+    db = MemoryDb()
+    # pymongo returns naive UTC datetimes
+    db.insert('sessions', {'_id': 'bot:chat:old', 'step': 'city', 'data': {},
+                           'updated_at': datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(hours=2)})
+    db.insert('sessions', {'_id': 'bot:chat:new', 'step': 'city', 'data': {},
+                           'updated_at': datetime.now(timezone.utc).replace(tzinfo=None)})
+    store = SessionStore(db, ttl=3600)
+
+    async def scenario():
+        return await store.get('bot', 'chat', 'old'), await store.get('bot', 'chat', 'new')
+
+    old, new = loop.run_until_complete(scenario())
+    assert old is None
+    assert new.step == 'city'
+
+
+class CountingDb(MemoryDb):
+
+    def __init__(self):
+        super().__init__()
+        self.reads = 0
+
+    def find_one(self, collection, params):
+        self.reads += 1
+        return super().find_one(collection, params)
+
+
+@pytest.mark.parametrize('persistent, reads', [(True, 2), (False, 0)])
+def test_answers_outside_dialogs_dont_read_db_every_time(loop, persistent, reads):
+    store = SessionStore(CountingDb(), persistent=persistent, flush_interval=60)
+    answers = []
+
+    async def city(payload, session):
+        answers.append(payload['text'])
+
+    async def call(handler, payload, session):
+        await handler(payload, session)
+
+    async def scenario():
+        store.set_step_handler('city', city)
+        for _ in range(5):
+            assert not await store.route({'bot': 'bot', 'chat': 'chat', 'user': 'user', 'text': 'Hi'}, call)
+        assert store.db.reads == reads
+
+        # Known missing session is forgotten when a dialog starts
+        await store.start('bot', 'chat', 'user', 'city')
+        if persistent:
+            # Written and evicted from memory: loaded from Db again
+            await store.flush()
+            store.cache.clear()
+        assert await store.route({'bot': 'bot', 'chat': 'chat', 'user': 'user', 'text': 'Paris'}, call)
+        await store.close()
+
+    loop.run_until_complete(scenario())
+    assert answers == ['Paris']
@@ -0,0 +1,41 @@
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip('pymongo')
+
+from sdk.codexbot_sdk import CodexBot
+from sdk.lib.transport import LoopbackTransport
+
+DELAY = 0.2
+
+
+class SlowTransport(LoopbackTransport):
+
+    async def connect(self):
+        await asyncio.sleep(DELAY)
+
+
+class SlowDbBot(CodexBot):
+
+    def init_db(self, db_config):
+        # Like MongoClient creation and pymongo import, it runs in a thread
+        time.sleep(DELAY)
+        return super().init_db(db_config)
+
+
+def test_db_and_broker_are_connected_concurrently(loop):
+    async def scenario():
+        sdk = await SlowDbBot.create('startup_test', 'localhost', 1337, 'amqp://', {'backend': 'memory'}, 'token',
+                                     transport=SlowTransport())
+        await sdk.shutdown()
+        return sdk
+
+    sdk = loop.run_until_complete(scenario())
+    timings = sdk.startup_timings
+
+    assert timings['db'] >= DELAY and timings['broker'] >= DELAY
+    assert timings['total'] < 2 * DELAY
+    # Scheduler and HTTP server are created on first use
+    assert 'scheduler' not in timings and 'server' not in timings
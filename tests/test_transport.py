@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+
+from sdk.lib.transport import LoopbackTransport
+
+
+def test_join_waits_for_messages_acknowledged_after_callback(loop):
+    transport = LoopbackTransport()
+    received = []
+
+    async def callback(message):
+        # Acknowledged later, like by the ordered dispatcher
+        received.append(message)
+
+    async def scenario():
+        await transport.consume('queue', callback, prefetch_count=10)
+        for index in range(3):
+            await transport.publish('message {}'.format(index), 'queue')
+
+        join = asyncio.ensure_future(transport.join('queue'))
+        await asyncio.sleep(0.01)
+        assert not join.done()
+
+        for message in received:
+            message.ack()
+        await asyncio.wait_for(join, 1)
+
+    loop.run_until_complete(scenario())
+    assert [message.body for message in received] == [b'message 0', b'message 1', b'message 2']
+
+
+def test_reply_goes_to_core_queue(loop, loopback_bot):
+    from sdk.lib.codec import get_codec
+
+    transport = LoopbackTransport()
+    codec = get_codec()
+
+    async def scenario():
+        async def weather(payload):
+            await sdk.send_text_to_chat(payload['chat'], 'Sunny')
+
+        sdk = await loopback_bot([('weather', 'Weather forecast', weather)], transport=transport)
+        await transport.publish(codec.encode({'command': 'service callback',
+                                              'payload': {'command': 'weather', 'chat': 'chat_1', 'params': ''}}),
+                                sdk.queue_name)
+        await transport.join(sdk.queue_name)
+
+    loop.run_until_complete(scenario())
+    sent = [codec.decode(message.body) for message in transport.queue('core').messages]
+
+    assert sent[0]['command'] == 'register commands'
+    assert sent[1]['command'] == 'send to service'
+    assert sent[1]['payload']['text'] == 'Sunny'
+
+
+def test_throughput_benchmark_runs(loop, capsys):
+    pytest.importorskip('pymongo')
+    from sdk.benchmarks import throughput
+
+    throughput.run(50, concurrency=4, chats=5, batched=True)
+    assert 'user answer' in capsys.readouterr().out